@@ -0,0 +1,15 @@
+# Settings of the commands of the app read by splunklib.searchcommands, in addition to commands.conf.spec
+
+[<stanza name>]
+
+flush_interval = <integer>
+* Seconds after which the records buffered by the command are sent to splunkd as a partial chunk.
+* 0 disables the time based flush.
+* The flush_interval option of the command overrides this setting.
+* Defaults to 2 for the generating commands (insee, pnaf, sirene, xl2diff), unset for the others.
+
+flush_size = <integer>
+* Bytes of buffered records after which they are sent to splunkd as a partial chunk, at most 268435456.
+* 0 disables the size based flush.
+* The flush_size option of the command overrides this setting.
+* Defaults to 4194304 for the generating commands (insee, pnaf, sirene, xl2diff), unset for the others.
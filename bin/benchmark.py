@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+    Offline benchmark of insee, pnaf and xl2 on sessions recorded with record=true.
+
+    Each session recorded by splunklib (<Command>-<time>.getinfo.input.gz in the recordings directory) is replayed
+    repeat times against its command in a process of its own, outside Splunk. The best run gives the records and MB
+    per second and the time of each stage reported by the command in the Job Inspector, the peak RSS is the largest
+    of the runs. With --baseline the results are compared with a stored baseline and the exit status is 1 when a
+    session is slower or uses more memory than the tolerance allows, --save stores them as the new baseline.
+
+    The API is never requested: insee sessions are replayed with replay=true from the journal of their day, recorded
+    with journal=true, and pnaf sessions must read their establishments from the local store or the journal of insee.
+
+    Nothing outside of a run is written: each run has its own SPLUNK_HOME, holding a copy of the journal, the store
+    and the snapshot of prospects it reads, and its own export directory. The options of insee that write to the
+    export, the store, the modification snapshot, the journal or the checkpoints are removed from its sessions.
+
+    usage: python benchmark.py [--repeat n] [--baseline file [--save] [--tolerance ratio]] [recording ...]
+"""
+
+from __future__ import print_function
+
+import argparse
+import csv
+import gzip
+import importlib
+import io
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from splunklib import six
+from splunklib.searchcommands import environment
+
+
+RECORDINGS_DIRECTORY = os.path.join(environment.splunk_home, 'var', 'run', 'splunklib.searchcommands', 'recordings')
+INSEE_DIRECTORY = os.path.join(environment.splunk_home, 'var', 'run', 'splunk', 'insee')
+BASELINE_FILENAME = os.path.join(environment.splunk_home, 'var', 'run', 'splunk', 'insee', 'benchmark.json')
+
+# Command classes and their modules
+COMMANDS = {'INSEECommand': 'insee', 'PNAFCommand': 'pnaf', 'XL2Command': 'xl2'}
+
+# Files of INSEE_DIRECTORY read by the sessions of each command, copied in the SPLUNK_HOME of each run
+INPUTS = {'INSEECommand': ['journal'],
+          'PNAFCommand': ['journal', 'sirene.db', 'sirene.db-wal', 'prospects.json'],
+          'XL2Command': []}
+
+# Options of insee removed from the replayed sessions, replay=true is added
+STRIPPED = ('export', 'store', 'modifications', 'journal', 'resume', 'replay')
+
+HEADER = re.compile(br'chunked\s+1.0\s*,\s*(\d+)\s*,\s*(\d+)\s*\n')
+MB = 1024.0 * 1024.0
+
+
+class ExceptionBenchmark(Exception):
+    pass
+
+
+class OfflineAPI(object):
+    """
+        Stands for the requests module of a replayed command, so that a session never reaches the API.
+    """
+    def __getattr__(self, name):
+        raise ExceptionBenchmark('The session requests the API: record insee with journal=true and replay pnaf from '
+                                 'the store or the journal of insee')
+
+
+def read_chunks(f):
+    """Yield the metadata and the body of each chunk of a recorded input or output."""
+    while True:
+        line = f.readline()
+        if not line:
+            return
+        # The metadata of the getinfo response is followed by a newline
+        if not line.strip():
+            continue
+        match = HEADER.match(line)
+        if match is None:
+            raise ExceptionBenchmark('Not a chunked protocol recording')
+        metadata = f.read(int(match.group(1)))
+        body = f.read(int(match.group(2)))
+        yield json.loads(metadata.decode('utf-8')) if metadata else dict(), body
+
+
+def count_rows(body):
+    if not body:
+        return 0
+    body = io.BytesIO(body) if six.PY2 else io.StringIO(body.decode('utf-8'), newline='')
+    # The first row holds the field names
+    return sum(1 for _ in csv.reader(body)) - 1
+
+
+def write_chunk(f, metadata, body):
+    metadata = json.dumps(metadata, separators=(',', ':')).encode('utf-8') if metadata else b''
+    f.write(('chunked 1.0,%d,%d\n' % (len(metadata), len(body))).encode('ascii'))
+    f.write(metadata)
+    f.write(body)
+
+
+def prepare_input(recording, class_name, filename):
+    """Write the input of a session, set offline, and return its number of records and bytes."""
+    rows = 0
+    size = 0
+    with gzip.open(recording, 'rb') as f, open(filename, 'wb') as output:
+        for metadata, body in read_chunks(f):
+            searchinfo = metadata.get('searchinfo')
+            if class_name == 'INSEECommand' and searchinfo:
+                # The pages of the day are read from the journal instead of the API, and nothing is written
+                for attr in 'args', 'raw_args':
+                    args = [arg for arg in searchinfo.get(attr, []) if arg.split('=')[0] not in STRIPPED]
+                    searchinfo[attr] = args + ['replay=true']
+            write_chunk(output, metadata, body)
+            rows += count_rows(body)
+            size += len(body)
+    return rows, size
+
+
+def read_output(filename):
+    """Return the number of records and bytes of the output of a session and the metrics of its stages."""
+    rows = 0
+    size = 0
+    stages = OrderedDict()
+    errors = list()
+    with open(filename, 'rb') as f:
+        for metadata, body in read_chunks(f):
+            inspector = metadata.get('inspector') or dict()
+            for name, value in inspector.items():
+                if name.startswith('metric.'):
+                    values = stages.setdefault(name[len('metric.'):], [0.0, 0, 0, 0])
+                    for i, v in enumerate(value):
+                        values[i] += v
+            errors.extend(text for level, text in inspector.get('messages', []) if level in ('ERROR', 'FATAL'))
+            rows += count_rows(body)
+            size += len(body)
+    return rows, size, stages, errors
+
+
+def prepare_home(directory, class_name):
+    """Create the SPLUNK_HOME of a run with a copy of the files its session reads, and its export directory."""
+    home = os.path.join(directory, 'splunk')
+    os.makedirs(os.path.join(home, 'var', 'log', 'splunk'))
+    os.makedirs(os.path.join(home, 'var', 'run', 'splunk', 'insee'))
+    os.makedirs(os.path.join(directory, 'export'))
+    for name in INPUTS[class_name]:
+        source = os.path.join(INSEE_DIRECTORY, name)
+        target = os.path.join(home, 'var', 'run', 'splunk', 'insee', name)
+        if os.path.isdir(source):
+            shutil.copytree(source, target)
+        elif os.path.exists(source):
+            shutil.copy2(source, target)
+    return home
+
+
+def check_isolation(directory):
+    """Raise an exception unless every file of the commands is in the directory of the run."""
+    paths = [('SPLUNK_HOME', environment.splunk_home)]
+    for name, module in sorted(sys.modules.items()):
+        if module is not None and name.startswith('sirenelib.'):
+            paths.extend(('%s.%s' % (name, attr), getattr(module, attr)) for attr in dir(module)
+                         if attr.endswith(('_DIRECTORY', '_FILENAME')))
+    for name, path in paths:
+        if not os.path.abspath(path).startswith(os.path.join(directory, '')):
+            raise ExceptionBenchmark('{0} is {1}, outside of the run in {2}'.format(name, path, directory))
+
+
+def run_session(module_name, class_name, input_filename, output_filename, directory):
+    """Run a command on the input of a session in this process and print its elapsed time and peak RSS."""
+    from sirenelib import export
+    export.OUTPUT_DIRECTORY = os.path.join(directory, 'export')
+    module = importlib.import_module(module_name)
+    check_isolation(directory)
+    command_class = getattr(module, class_name)
+    module.requests = OfflineAPI()
+    if class_name == 'PNAFCommand':
+        command_class.get_api_token = lambda self: 'benchmark'
+        command_class.get_status = lambda self: None
+
+    with open(input_filename, 'rb') as ifile:
+        # The record writer writes str, bytes on Python 2
+        if six.PY2:
+            ofile = open(output_filename, 'wb')
+        else:
+            ofile = io.open(output_filename, 'w', encoding='utf-8', newline='')
+        start = time.time()
+        try:
+            command_class().process([module_name + '.py'], ifile, ofile)
+        except SystemExit:
+            pass
+        elapsed = time.time() - start
+        ofile.close()
+
+    # ru_maxrss is in kilobytes on Linux, the children are the worker processes of xl2
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    print(json.dumps({'elapsed': elapsed, 'peak_rss_mb': rss / 1024.0}))
+
+
+def benchmark(recording, repeat):
+    name = os.path.basename(recording)[:-len('.input.gz')]
+    class_name = name.split('-')[0]
+    module_name = COMMANDS[class_name]
+    directory = tempfile.mkdtemp()
+    try:
+        input_filename = os.path.join(directory, 'input')
+        output_filename = os.path.join(directory, 'output')
+        rows_in, size_in = prepare_input(recording, class_name, input_filename)
+
+        best = None
+        peak_rss_mb = 0.0
+        for _ in range(repeat):
+            run_directory = tempfile.mkdtemp(dir=directory)
+            env = dict(os.environ, SPLUNK_HOME=prepare_home(run_directory, class_name))
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run', module_name, class_name,
+                                        input_filename, output_filename, run_directory], stdout=subprocess.PIPE,
+                                       env=env)
+            out, _ = process.communicate()
+            shutil.rmtree(run_directory)
+            if process.returncode:
+                raise ExceptionBenchmark('The replay of {0} failed with status {1}'.format(name, process.returncode))
+            run = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+            rows_out, size_out, stages, errors = read_output(output_filename)
+            if errors:
+                raise ExceptionBenchmark('The replay of {0} failed: {1}'.format(name, errors[0]))
+            peak_rss_mb = max(peak_rss_mb, run['peak_rss_mb'])
+            if best is None or run['elapsed'] < best[0]:
+                best = run['elapsed'], rows_out, size_out, stages
+    finally:
+        shutil.rmtree(directory)
+
+    elapsed, rows_out, size_out, stages = best
+    # Generating commands are measured on their output, xl2 on its input
+    rows = max(rows_in, rows_out)
+    return OrderedDict([('session', name),
+                        ('command', module_name),
+                        ('elapsed', round(elapsed, 3)),
+                        ('records', rows),
+                        ('records_per_second', round(rows / elapsed, 1) if elapsed else 0),
+                        ('mb_per_second', round((size_in + size_out) / MB / elapsed, 2) if elapsed else 0),
+                        ('peak_rss_mb', round(peak_rss_mb, 1)),
+                        ('stages', OrderedDict((stage, round(values[0], 3)) for stage, values in stages.items()))])
+
+
+def compare(result, baseline, tolerance):
+    """Return the regressions of a session against its baseline."""
+    regressions = list()
+    if result['records_per_second'] < baseline['records_per_second'] * (1 - tolerance):
+        regressions.append('records_per_second %.1f < %.1f' % (result['records_per_second'],
+                                                             baseline['records_per_second']))
+    if result['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + tolerance):
+        regressions.append('peak_rss_mb %.1f > %.1f' % (result['peak_rss_mb'], baseline['peak_rss_mb']))
+    return regressions
+
+
+def report(result, baseline=None):
+    print('%s: %s, %d records in %.3f s, %.1f records/s, %.2f MB/s, peak RSS %.1f MB' % (
+        result['session'], result['command'], result['records'], result['elapsed'], result['records_per_second'],
+        result['mb_per_second'], result['peak_rss_mb']))
+    for stage, seconds in result['stages'].items():
+        line = '  %-14s %9.3f s' % (stage, seconds)
+        previous = baseline['stages'].get(stage) if baseline else None
+        if previous:
+            line += '  (baseline %.3f s, %+.0f%%)' % (previous, (seconds - previous) * 100 / previous)
+        print(line)
+
+
+def find_recordings(paths):
+    recordings = list()
+    for path in paths or [RECORDINGS_DIRECTORY]:
+        if os.path.isdir(path):
+            recordings.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.input.gz')))
+        else:
+            recordings.append(path)
+    # Sessions of other commands are left out
+    return [r for r in recordings if os.path.basename(r).split('-')[0] in COMMANDS]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Replay recorded sessions of insee, pnaf and xl2 offline')
+    parser.add_argument('recordings', nargs='*', help='recorded inputs or directories, the recordings of '
+                                                      'splunklib by default')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each session, the best one is kept')
+    parser.add_argument('--baseline', help='baseline to compare with, {0} with --save'.format(BASELINE_FILENAME))
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='regression allowed, as a ratio')
+    parser.add_argument('--run', nargs=5, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run:
+        run_session(*args.run)
+        return 0
+
+    baseline_filename = args.baseline or (BASELINE_FILENAME if args.save else None)
+    baselines = dict()
+    if baseline_filename and os.path.exists(baseline_filename):
+        with open(baseline_filename) as f:
+            baselines = json.load(f)
+
+    recordings = find_recordings(args.recordings)
+    if not recordings:
+        print('no recorded session of insee, pnaf or xl2')
+        return 1
+
+    regressions = 0
+    results = OrderedDict()
+    for recording in recordings:
+        result = benchmark(recording, args.repeat)
+        results[result['session']] = result
+        baseline = baselines.get(result['session'])
+        report(result, baseline)
+        if baseline and not args.save:
+            for regression in compare(result, baseline, args.tolerance):
+                print('  REGRESSION %s' % regression)
+                regressions += 1
+
+    if args.save:
+        baselines.update(results)
+        directory = os.path.dirname(baseline_filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(baseline_filename, 'w') as f:
+            json.dump(baselines, f, indent=2)
+        print('baseline saved to %s' % baseline_filename)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -7,8 +7,22 @@ import requests
 from datetime import date, timedelta, datetime
 from requests.auth import HTTPBasicAuth
 from splunklib.searchcommands import dispatch, GeneratingCommand, Configuration, Option, validators
-from splunklib import six
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from functools import partial
+from sirenelib.checkpoint import Checkpoint
+from sirenelib.export import HEADER, MODIFICATIONS, XL2Export
+from sirenelib.fields import Fields, etablissement_fields
+from sirenelib.journal import Journal
+from sirenelib.ledger import Ledger
+from sirenelib.metrics import StageMetrics
+from sirenelib.modifications import ExceptionModifications, ModificationSnapshot
+from sirenelib.planner import HarvestPlan
+from sirenelib.profiler import profiled
+from sirenelib.ratelimit import RateBudget
+from sirenelib.store import SireneStore
+from sirenelib.threads import threaded
+from sirenelib.validators import Date
+import csv
 import json
 import os
 
@@ -41,24 +55,12 @@ class ExceptionTranslation(Exception):
     pass
 
 
-class Date(validators.Validator):
-    """
-        Validates Date option values.
-    """
-    def __call__(self, value):
-        if value is None:
-            return None
+class ExceptionDateParameter(Exception):
+    pass
 
-        try:
-            datetime.strptime(value, '%Y-%m-%d')
-            return value
-        except ValueError:
-            raise ValueError('Unrecognized date value: {0}. Should be AAAA-MM-JJ'.format(value))
 
-    def format(self, value):
-        if value is None:
-            return None
-        return six.text_type(value)
+class ExceptionFieldsParameter(Exception):
+    pass
 
 
 @Configuration(type='events')
@@ -67,16 +69,65 @@ class INSEECommand(GeneratingCommand):
 
     ##Syntax
 
-    | insee [dtr=date_to_retrieve] [proxy=true] [debug=true]
+    | insee [dtr=date_to_retrieve] [dtr_start=first_date dtr_end=last_date] [workers=n] [proxy=true] [debug=true]
+    [export=xl2] [resume=true] [journal=true] [replay=true] [catchup=true] [store=true] [modifications=true] [plan=true]
+    [fields="column,column"] [metrics=true] [profile=true [profile_memory=true]]
 
     ##Description
 
     Request the Sirene API
 
+    With export=xl2 the XL2 file is written by the command itself and a single summary event is returned
+
+    With resume=true the harvest continues after the last page completed by an interrupted search of the same day
+
+    With dtr_start and dtr_end every day of the range is retrieved, up to workers days are requested in parallel and
+    the days are generated or exported in date order
+
+    With journal=true the pages received from the API are stored on disk, replay=true reads them back without any
+    API call
+
+    With catchup=true the days missing from the ledger of exported days are retrieved, oldest first, within the
+    daily quota
+
+    With store=true the updated establishments are written to the local Sirene store, which also resolves the
+    headquarters it knows without requesting the API
+
+    With modifications=true the M* indicators are set by comparing each establishment with its last exported version,
+    kept in a local snapshot
+
+    With plan=true nothing is harvested: the establishments of each day are counted with a facet of the API and an
+    event per day estimates the pages, requests and duration of the harvest under the rate limit and the daily quota
+
+    With fields only the listed XL2 columns are computed, returned and requested from the API, every column is
+    produced without it
+
+    The time spent and the counts of each stage of the harvest are reported in the Job Inspector, metrics=true also
+    returns them in a last summary event
+
+    With profile=true the harvest is run under cProfile, the profile is written next to insee.log and the functions
+    with the most time and the peak memory are returned as messages of the job. profile_memory=true also traces the
+    allocations, on Python 3
+
     """
     dtr = Option(require=False, validate=Date())
+    dtr_start = Option(require=False, validate=Date())
+    dtr_end = Option(require=False, validate=Date())
+    workers = Option(require=False, validate=validators.Integer(minimum=1, maximum=8), default=1)
     debug = Option(require=False, validate=validators.Boolean())
     proxy = Option(require=False, validate=validators.Boolean())
+    export = Option(require=False, validate=validators.Set('xl2'))
+    resume = Option(require=False, validate=validators.Boolean())
+    journal = Option(require=False, validate=validators.Boolean())
+    replay = Option(require=False, validate=validators.Boolean())
+    catchup = Option(require=False, validate=validators.Boolean())
+    metrics = Option(require=False, validate=validators.Boolean())
+    profile = Option(require=False, validate=validators.Boolean())
+    profile_memory = Option(require=False, validate=validators.Boolean())
+    store = Option(require=False, validate=validators.Boolean())
+    modifications = Option(require=False, validate=validators.Boolean())
+    plan = Option(require=False, validate=validators.Boolean())
+    fields = Option(require=False, validate=validators.List())
 
     # https://www.sirene.fr/sirene/public/variable/tefet
     LIBTEFET = {'NN': 'Unités non employeuses',
@@ -127,8 +178,100 @@ class INSEECommand(GeneratingCommand):
 
             }
 
+    # Fields of the API read by translate_siret for each XL2 column, the other columns are constant or computed
+    CHAMPS_NOM = ['categorieJuridiqueUniteLegale', 'sexeUniteLegale', 'nomUsageUniteLegale', 'nomUniteLegale',
+           'prenomUsuelUniteLegale', 'denominationUniteLegale']
+    CHAMPS_VOIE = ['numeroVoieEtablissement', 'typeVoieEtablissement', 'libelleVoieEtablissement']
+    CHAMPS_PAYS = ['codePaysEtrangerEtablissement', 'libellePaysEtrangerEtablissement']
+    CHAMPS = {'L1_NORMALISEE': CHAMPS_NOM,
+              'L3_NORMALISEE': CHAMPS_VOIE,
+              'L6_NORMALISEE': ['codePostalEtablissement', 'libelleCommuneEtablissement'],
+              'L7_NORMALISEE': CHAMPS_PAYS,
+              'L1_DECLAREE': CHAMPS_NOM,
+              'L3_DECLAREE': CHAMPS_VOIE,
+              'L7_DECLAREE': CHAMPS_PAYS,
+              'NUMVOIE': ['numeroVoieEtablissement'],
+              'INDREP': ['indiceRepetitionEtablissement'],
+              'TYPVOIE': ['typeVoieEtablissement'],
+              'LIBVOIE': ['libelleVoieEtablissement'],
+              'CODPOS': ['codePostalEtablissement'],
+              'CEDEX': ['codeCedexEtablissement'],
+              'DEPET': ['codeCommuneEtablissement'],
+              'COMET': ['codeCommuneEtablissement'],
+              'LIBCOM': ['libelleCommuneEtablissement'],
+              'ENSEIGNE': ['enseigne1Etablissement'],
+              'APET700': ['activitePrincipaleEtablissement'],
+              'LIBAPET': ['activitePrincipaleEtablissement'],
+              'TEFET': ['trancheEffectifsEtablissement'],
+              'LIBTEFET': ['trancheEffectifsEtablissement'],
+              'DEFET': ['anneeEffectifsEtablissement'],
+              'DCRET': ['dateCreationEtablissement'],
+              'NOMEN_LONG': ['categorieJuridiqueUniteLegale', 'nomUniteLegale', 'nomUsageUniteLegale',
+                             'denominationUniteLegale', 'prenom1UniteLegale', 'prenom2UniteLegale',
+                             'prenom3UniteLegale', 'prenom4UniteLegale'],
+              'SIGLE': ['sigleUniteLegale'],
+              'NOM': ['nomUniteLegale'],
+              'PRENOM': ['prenom1UniteLegale'],
+              'CIVILITE': ['sexeUniteLegale'],
+              'RNA': ['identifiantAssociationUniteLegale'],
+              'RPEN': CHAMPS_PAYS[:1] + ['codeCommuneEtablissement'],
+              'DEPCOMEN': CHAMPS_PAYS[:1] + ['codeCommuneEtablissement'],
+              'NJ': ['categorieJuridiqueUniteLegale'],
+              'LIBNJ': ['categorieJuridiqueUniteLegale'],
+              'APEN700': ['activitePrincipaleUniteLegale'],
+              'LIBAPEN': ['activitePrincipaleUniteLegale'],
+              'APRM': ['activitePrincipaleRegistreMetiersEtablissement'],
+              'ESS': ['economieSocialeSolidaireUniteLegale'],
+              'TEFEN': ['trancheEffectifsUniteLegale'],
+              'LIBTEFEN': ['trancheEffectifsUniteLegale'],
+              'DEFEN': ['anneeEffectifsUniteLegale'],
+              'CATEGORIE': ['categorieEntreprise'],
+              'DCREN': ['dateCreationUniteLegale'],
+              'DATEMAJ': ['dateDernierTraitementEtablissement'],
+              'DATEVE': ['dateDernierTraitementEtablissement']}
+    # Fields needed by the harvest whatever the columns: identifiers, headquarters, state and day of the update
+    CHAMPS_HARVEST = ['siren', 'nic', 'siret', 'etablissementSiege', 'nicSiegeUniteLegale',
+                      'etatAdministratifEtablissement', 'dateDernierTraitementEtablissement']
+
     count_in = 0
     count_out = 0
+    # XL2 columns produced and their translation, see get_translation_plan()
+    columns = HEADER
+    translation_plan = None
+    # Pages fetched in advance for each day harvested by a worker
+    queue_size = 4
+    # If we have more than 85 siret, the query is too long and blocked by INSEE
+    sieges_per_request = 85
+    # Headquarters of the last updated pages kept to resolve the branches that follow them
+    siege_window = 2000
+    # Headquarters resolved on the last pages, the least recently used are requested again when needed
+    siege_cache = 10000
+    # Values of the facet on the date of last processing, there is one per processing time of the range
+    facet_size = 10000
+
+    def load_lookup(self, filename):
+        # Same matching as the Splunk lookups: first two columns, case insensitive
+        lookup = dict()
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lookups', filename), 'r') as fd:
+            reader = csv.reader(fd)
+            next(reader)
+            for row in reader:
+                if len(row) >= 2 and row[0]:
+                    lookup.setdefault(row[0].lower(), row[1])
+        return lookup
+
+    def set_lookups(self):
+        self.csv_naf = self.load_lookup('naf.csv')
+        self.csv_nj = self.load_lookup('nj.csv')
+        self.csv_pays = self.load_lookup('pays.csv')
+
+    def apply_lookups(self, new_siret):
+        # Replaces the lookups of the XL2 search: codes are replaced by their label
+        new_siret['LIBAPET'] = self.csv_naf.get(new_siret['LIBAPET'].lower(), '')
+        new_siret['LIBAPEN'] = self.csv_naf.get(new_siret['LIBAPEN'].lower(), '')
+        new_siret['LIBNJ'] = self.csv_nj.get(new_siret['LIBNJ'].lower(), '')
+        new_siret['L7_NORMALISEE'] = self.csv_pays.get(new_siret['L7_NORMALISEE'].lower(), new_siret['L7_NORMALISEE'])
+        return new_siret
 
     def set_configuration(self):
         # Open the configuration file
@@ -164,7 +307,18 @@ class INSEECommand(GeneratingCommand):
         self.endpoint_token = conf['endpoint_token']
         self.endpoint_etablissement = conf['endpoint_etablissement']
         self.endpoint_informations = conf['endpoint_informations']
-        self.bearer_token = self.get_api_token()
+        # Number of days the journals of pages are kept
+        self.journal_retention = int(conf.get('journal_retention', 30))
+        # Requests per minute allowed by the API, shared by all the workers
+        self.rate_budget = RateBudget(int(conf.get('rate_limit', 30)))
+        # Requests per day that catchup=true may use, and number of days it looks back
+        self.daily_quota = int(conf['daily_quota']) if conf.get('daily_quota') else None
+        self.catchup_days = int(conf.get('catchup_days', 30))
+
+        # A replay does not request the API
+        if not self.replay:
+            with self.stage_metrics.timer('token'):
+                self.bearer_token = self.get_api_token()
 
     def get_api_token(self):
         payload = {'grant_type': 'client_credentials'}
@@ -191,7 +345,10 @@ class INSEECommand(GeneratingCommand):
     def get_status(self):
         # Initialize
         headers = {'Authorization': 'Bearer ' + self.bearer_token}
+        start = time.time()
+        waited = 0
 
+        self.rate_budget.acquire()
         if self.proxy:
             r = requests.get(self.endpoint_informations, headers=headers,
                              proxies=self.proxies)
@@ -204,7 +361,8 @@ class INSEECommand(GeneratingCommand):
         while r.status_code == 429:
             # We made too many requests. We wait for the next rounded minute
             current_second = datetime.now().time().strftime('%S')
-            time.sleep(60 - int(current_second) + 1)
+            waited += self.stage_metrics.sleep('wait_429', 60 - int(current_second) + 1)
+            self.rate_budget.acquire()
             if self.proxy:
                 r = requests.get(self.endpoint_informations, headers=headers,
                                  proxies=self.proxies)
@@ -212,10 +370,12 @@ class INSEECommand(GeneratingCommand):
                 r = requests.get(self.endpoint_informations, headers=headers)
             if self.debug:
                 self.logger.debug('  status response %s\n%s', r.headers, r.text)
+        self.stage_metrics.add('status', time.time() - start - waited)
 
         if r.headers['Content-Type'] and 'application/json' in r.headers['Content-Type']:
             if r.status_code == 200:
-                return r.json()
+                with self.stage_metrics.timer('decode'):
+                    return r.json()
             elif r.status_code == 401:
                 self.logger.error('  invalid bearer token %s in status request', self.bearer_token)
             elif r.status_code == 406:
@@ -226,7 +386,8 @@ class INSEECommand(GeneratingCommand):
             self.logger.error('  error during status retrieval. Code received : %d', r.status_code)
         raise ExceptionStatus('Error during information retrieval')
 
-    def get_siret(self, q=None, nombre=None, curseur=None, champs=None, gzip=False):
+    def get_siret(self, q=None, nombre=None, curseur=None, champs=None, gzip=False, journal=None, tri=None,
+                  facette=None, facette_nombre=None, masquer=False):
         # Initialize
         payload = dict()
         if champs:
@@ -237,13 +398,25 @@ class INSEECommand(GeneratingCommand):
             payload['nombre'] = nombre
         if curseur:
             payload['curseur'] = curseur
+        if tri:
+            payload['tri'] = tri
+        if facette:
+            payload['facette.champ'] = facette
+        if facette_nombre:
+            payload['facette.nombre'] = facette_nombre
+        if masquer:
+            # Fields without value are left out of the response
+            payload['masquerValeursNulles'] = 'true'
 
         headers = {'Authorization': 'Bearer ' + self.bearer_token}
 
         if gzip:
             # Request GZip content
             headers['Accept-Encoding'] = 'gzip'
+        start = time.time()
+        waited = 0
 
+        self.rate_budget.acquire()
         if self.proxy:
             r = requests.get(self.endpoint_etablissement, headers=headers, params=payload,
                              proxies=self.proxies)
@@ -256,7 +429,8 @@ class INSEECommand(GeneratingCommand):
         while r.status_code == 429:
             # We made too many requests. We wait for the next rounded minute
             current_second = datetime.now().time().strftime('%S')
-            time.sleep(60 - int(current_second) + 1)
+            waited += self.stage_metrics.sleep('wait_429', 60 - int(current_second) + 1)
+            self.rate_budget.acquire()
             if self.proxy:
                 r = requests.get(self.endpoint_etablissement, headers=headers, params=payload,
                                  proxies=self.proxies)
@@ -269,7 +443,8 @@ class INSEECommand(GeneratingCommand):
         while r.status_code == 500:
             # In case we get a 500 we prefer to retry our request before raising an error
             internal_error_counter += 1
-            time.sleep(60)
+            waited += self.stage_metrics.sleep('retry_500', 60)
+            self.rate_budget.acquire()
             if self.proxy:
                 r = requests.get(self.endpoint_etablissement, headers=headers, params=payload,
                                  proxies=self.proxies)
@@ -279,10 +454,15 @@ class INSEECommand(GeneratingCommand):
                 self.logger.debug('  siret response %s\n%s', r.headers, r.text)
             if internal_error_counter == 10:
                 break
+        # The gzip content is inflated by requests while it is received
+        self.stage_metrics.add('fetch', time.time() - start - waited, output_count=len(r.content))
 
         if r.headers['Content-Type'] and 'application/json' in r.headers['Content-Type']:
             if r.status_code == 200:
-                return r.json()
+                if journal:
+                    journal(r.content)
+                with self.stage_metrics.timer('decode'):
+                    return r.json()
             elif r.status_code == 400:
                 self.logger.error('  invalid parameters in query: %s', r.json()['header']['message'])
             elif r.status_code == 401:
@@ -300,16 +480,54 @@ class INSEECommand(GeneratingCommand):
 
         raise ExceptionSiret('Error during siret retrieval')
 
-    def get_updated_siret_records(self, date, curseur):
+    def get_columns(self):
+        """Return the XL2 columns to produce, from the fields option, every column without it."""
+        if not self.fields:
+            return HEADER
+        unknown = [field for field in self.fields if field not in HEADER]
+        if unknown:
+            self.logger.error('  unknown XL2 columns in fields: %s', ', '.join(unknown))
+            raise ExceptionFieldsParameter('Unknown XL2 columns in fields: ' + ', '.join(unknown))
+        if self.export == 'xl2':
+            self.logger.error('  fields cannot be set with export=xl2')
+            raise ExceptionFieldsParameter('fields cannot be set with export=xl2')
+        columns = set(self.fields)
+
+        # The identifiers are always produced, the indicators compare every column they cover
+        columns.update(['SIREN', 'NIC'])
+        if self.modifications:
+            for flag, covered in MODIFICATIONS:
+                columns.add(flag)
+                columns.update(covered)
+        return [column for column in HEADER if column in columns]
+
+    def get_champs(self, columns=HEADER):
+        """Return the champs of the updated siret requests, None when complete establishments are kept."""
+        # The journal and the local store are read again by replay, pnaf and sirene, which need every field
+        if self.journal or self.store:
+            return None
+        champs = set(self.CHAMPS_HARVEST)
+        for column in columns:
+            champs.update(self.CHAMPS.get(column, []))
+        return ','.join(sorted(champs))
+
+    def get_updated_siret_records(self, date, curseur, page_journal=None):
         # Which fields do we need
-        champs = 'siren,nic,siret,complementAdresseEtablissement,numeroVoieEtablissement,indiceRepetitionEtablissement,' \
-                 'typeVoieEtablissement,libelleVoieEtablissement,codePostalEtablissement,libelleCedexEtablissement,' \
-                 'codeCommuneEtablissement,libelleCommuneEtablissement'
+        champs = self.get_champs(self.columns)
 
         # Build the filter
         q = 'dateDernierTraitementEtablissement:' + date
 
-        j = self.get_siret(q=q, curseur=curseur, nombre=1000, gzip=True)
+        if self.replay:
+            j = page_journal.read_page(curseur)
+            if j is None:
+                self.logger.error('  page of cursor %s is missing from the journal', curseur)
+                raise ExceptionUpdatedSiret('Error during journal replay')
+        else:
+            journal = partial(page_journal.record, kind='siret', key=curseur) if page_journal is not None else None
+            # Sorted by SIREN, a headquarters usually comes in the same page as its branches
+            j = self.get_siret(q=q, curseur=curseur, nombre=1000, champs=champs, gzip=True, journal=journal,
+                               tri='siren,nic', masquer=True)
         try:
             header = j['header']
             etablissements = j['etablissements']
@@ -330,21 +548,24 @@ class INSEECommand(GeneratingCommand):
         for i in xrange(0, len(l), n):
             yield l[i:i + n]
 
-    def get_etablissements_siege(self, siret_to_retrieve):
+    def get_etablissements_siege(self, siret_to_retrieve, page_journal=None):
         # Which fields do we need
         champs = 'siren,nic,siret,etablissementSiege,codeCommuneEtablissement,codePaysEtrangerEtablissement'
 
         # Retrieve 85 records at each request
-        # If we have more than 85 siret, the query is too long and blocked by INSEE
-        step = 85
+        step = self.sieges_per_request
         sieges = dict()
         for chunk in list(self.chunks(siret_to_retrieve, step)):
             q = ''
             for siret in chunk:
                 q += 'siret:' + siret + ' OR '
             q = q[:-4]
+            if self.replay:
+                sieges.update(page_journal.read_sieges(chunk))
+                continue
             try:
-                j = self.get_siret(q=q, nombre=step, champs=champs, gzip=True)
+                journal = partial(page_journal.record, kind='siege', sirets=chunk) if page_journal is not None else None
+                j = self.get_siret(q=q, nombre=step, champs=champs, gzip=True, journal=journal, masquer=True)
             except ExceptionSiret:
                 continue
             try:
@@ -362,18 +583,25 @@ class INSEECommand(GeneratingCommand):
 
         return sieges
 
-    def generate_siret(self, siret, siret_siege):
-        new_siret = OrderedDict()
+    def get_translation_plan(self, columns=HEADER):
+        """
+            Return the translation of each XL2 column to produce, in the order of HEADER.
+
+            A translation is a function of the fields of an establishment: siret, u (legal unit), a (address), p
+            (current period) and sieges (headquarters resolved so far). Values used by several columns are computed
+            once per establishment, and the columns that are not produced are not computed at all.
+        """
         v = lambda t: '' if t is None else t.encode('utf-8')
-        try:
-            u = siret['uniteLegale']
-            a = siret['adresseEtablissement']
-            # This field is unused
-            a2 = siret['adresse2Etablissement']
-            p = siret['periodesEtablissement'][0]
-
-            new_siret['SIREN'] = v(siret['siren'])
-            new_siret['NIC'] = v(siret['nic'])
+
+        def cached(name, compute):
+            def translation(t):
+                if name not in t:
+                    t[name] = compute(t)
+                return t[name]
+            return translation
+
+        def nom(t):
+            u = t['u']
             # Physical person
             sul = None
             if v(u['categorieJuridiqueUniteLegale']) == '1000':
@@ -388,80 +616,22 @@ class INSEECommand(GeneratingCommand):
                 else:
                     nul = v(u['nomUniteLegale'])
                 puul = v(u['prenomUsuelUniteLegale'])
-                new_siret['L1_NORMALISEE'] = ' '.join(filter(None, [sul, puul, nul]))
-            else:
-                new_siret['L1_NORMALISEE'] = v(u['denominationUniteLegale'])
-            new_siret['L2_NORMALISEE'] = ''
-            nve = v(a['numeroVoieEtablissement'])
-            tve = v(a['typeVoieEtablissement'])
-            lve = v(a['libelleVoieEtablissement'])
-            new_siret['L3_NORMALISEE'] = ' '.join(filter(None, [nve, tve, lve]))
-            new_siret['L4_NORMALISEE'] = ''
-            new_siret['L5_NORMALISEE'] = ''
-            cpe = v(a['codePostalEtablissement'])
-            lce = v(a['libelleCommuneEtablissement'])
-            new_siret['L6_NORMALISEE'] = ' '.join(filter(None, [cpe, lce]))
+                return ' '.join(filter(None, [sul, puul, nul]))
+            return v(u['denominationUniteLegale'])
+
+        def voie(t):
+            a = t['a']
+            return ' '.join(filter(None, [v(a['numeroVoieEtablissement']), v(a['typeVoieEtablissement']),
+                                          v(a['libelleVoieEtablissement'])]))
+
+        def pays(t):
+            a = t['a']
             if a['codePaysEtrangerEtablissement'] and a['libellePaysEtrangerEtablissement']:
-                new_siret['L7_NORMALISEE'] = a['libellePaysEtrangerEtablissement'].encode('utf-8')
-            else:
-                new_siret['L7_NORMALISEE'] = 'FRANCE'.encode('utf-8')
-            new_siret['L1_DECLAREE'] = new_siret['L1_NORMALISEE']
-            new_siret['L2_DECLAREE'] = ''
-            new_siret['L3_DECLAREE'] = new_siret['L3_NORMALISEE']
-            new_siret['L4_DECLAREE'] = ''
-            new_siret['L5_DECLAREE'] = ''
-            new_siret['L6_DECLAREE'] = ''
-            new_siret['L7_DECLAREE'] = new_siret['L7_NORMALISEE']
-            new_siret['NUMVOIE'] = v(a['numeroVoieEtablissement'])
-            new_siret['INDREP'] = v(a['indiceRepetitionEtablissement'])
-            new_siret['TYPVOIE'] = v(a['typeVoieEtablissement'])
-            new_siret['LIBVOIE'] = v(a['libelleVoieEtablissement'])
-            new_siret['CODPOS'] = v(a['codePostalEtablissement'])
-            new_siret['CEDEX'] = v(a['codeCedexEtablissement'])
-            new_siret['RPET'] = ''
-            new_siret['LIBREG'] = ''
-            new_siret['DEPET'] = v(a['codeCommuneEtablissement'])[:2]
-            new_siret['ARRONET'] = ''
-            new_siret['CTONET'] = ''
-            new_siret['COMET'] = v(a['codeCommuneEtablissement'])
-            new_siret['LIBCOM'] = v(a['libelleCommuneEtablissement'])
-            new_siret['DU'] = ''
-            new_siret['TU'] = ''
-            new_siret['UU'] = ''
-            new_siret['EPCI'] = ''
-            new_siret['TCD'] = ''
-            new_siret['ZEMET'] = ''
-            if siret['etablissementSiege']:
-                new_siret['SIEGE'] = 1
-            else:
-                new_siret['SIEGE'] = 0
-            new_siret['ENSEIGNE'] = v(p['enseigne1Etablissement'])
-            new_siret['IND_PUBLIPO'] = ''
-            new_siret['DIFFCOM'] = 'O'.encode('utf-8')
-            new_siret['AMINTRET'] = date.today().strftime('%Y%m')
-            new_siret['NATETAB'] = ''
-            new_siret['LIBNATETAB'] = ''
-            new_siret['APET700'] = v(p['activitePrincipaleEtablissement']).replace('.', '')
-            new_siret['LIBAPET'] = v(p['activitePrincipaleEtablissement'])
-            new_siret['DAPET'] = ''
-            new_siret['TEFET'] = v(siret['trancheEffectifsEtablissement'])
-            if siret['trancheEffectifsEtablissement']:
-                new_siret['LIBTEFET'] = self.LIBTEFET[siret['trancheEffectifsEtablissement']]
-            else:
-                new_siret['LIBTEFET'] = ''
-            new_siret['EFETCENT'] = ''
-            new_siret['DEFET'] = v(siret['anneeEffectifsEtablissement'])
-            new_siret['ORIGINE'] = ''
-            new_siret['DCRET'] = v(siret['dateCreationEtablissement']).replace('-', '')
-            new_siret['DDEBACT'] = ''
-            new_siret['ACTIVNAT'] = ''
-            new_siret['LIEUACT'] = ''
-            new_siret['ACTISURF'] = ''
-            new_siret['SAISONAT'] = ''
-            new_siret['MODET'] = ''
-            new_siret['PRODET'] = ''
-            new_siret['PRODPART'] = ''
-            new_siret['AUXILT'] = ''
+                return a['libellePaysEtrangerEtablissement'].encode('utf-8')
+            return 'FRANCE'.encode('utf-8')
+
+        def nomen_long(t):
+            u = t['u']
             # Physical person
             if v(u['categorieJuridiqueUniteLegale']) == '1000':
                 nul = v(u['nomUniteLegale'])
@@ -471,121 +641,130 @@ class INSEECommand(GeneratingCommand):
                 p4ul = v(u['prenom4UniteLegale'])
                 pul = ' '.join(filter(None, [p1ul, p2ul, p3ul, p4ul]))
                 if v(u['nomUsageUniteLegale']):
-                    new_siret['NOMEN_LONG'] = nul + '*' + v(u['nomUsageUniteLegale']) + '/' + pul + '/'
-                else:
-                    new_siret['NOMEN_LONG'] = nul + '*' + pul + '/'
-            else:
-                new_siret['NOMEN_LONG'] = v(u['denominationUniteLegale'])
-            new_siret['SIGLE'] = v(u['sigleUniteLegale'])
-            new_siret['NOM'] = v(u['nomUniteLegale'])
-            new_siret['PRENOM'] = v(u['prenom1UniteLegale'])
-            new_siret['CIVILITE'] = ''
-            if v(u['sexeUniteLegale']) == 'F':
-                new_siret['CIVILITE'] = 2
-            elif v(u['sexeUniteLegale']) == 'M':
-                new_siret['CIVILITE'] = 1
-            new_siret['RNA'] = v(u['identifiantAssociationUniteLegale'])
-            new_siret['NICSIEGE'] = v(u['nicSiegeUniteLegale'])
-            if siret['etablissementSiege']:
-                if v(a['codePaysEtrangerEtablissement']):
-                    cce = v(a['codePaysEtrangerEtablissement'])
-                else:
-                    cce = v(a['codeCommuneEtablissement'])
-                department = cce[:3]
-                rpen = ''
+                    return nul + '*' + v(u['nomUsageUniteLegale']) + '/' + pul + '/'
+                return nul + '*' + pul + '/'
+            return v(u['denominationUniteLegale'])
+
+        def civilite(t):
+            if v(t['u']['sexeUniteLegale']) == 'F':
+                return 2
+            elif v(t['u']['sexeUniteLegale']) == 'M':
+                return 1
+            return ''
+
+        def region(cce):
+            department = cce[:3]
+            rpen = ''
+            for key, value in self.RPEN.items():
+                if department in value:
+                    rpen = key
+            if rpen == '':
+                department = cce[:2]
                 for key, value in self.RPEN.items():
                     if department in value:
                         rpen = key
-                if rpen == '':
-                    department = cce[:2]
-                    for key, value in self.RPEN.items():
-                        if department in value:
-                            rpen = key
-            else:
-                rpen = ''
-                cce = ''
+            return rpen
+
+        def siege(t):
+            # RPEN and DEPCOMEN come from the address of the headquarters
+            siret, u, a = t['siret'], t['u'], t['a']
+            if not siret['etablissementSiege']:
                 try:
-                    siege = siret_siege[v(siret['siren']) + v(u['nicSiegeUniteLegale'])]
-                except KeyError as e:
+                    s = t['sieges'][v(siret['siren']) + v(u['nicSiegeUniteLegale'])]
+                except KeyError:
                     self.logger.info('  siret %s has an invalid headquarter %s',
                                      v(siret['siret']), v(siret['siren']) + v(u['nicSiegeUniteLegale']))
-                else:
-                    if v(siege['adresseEtablissement']['codePaysEtrangerEtablissement']):
-                        cce = v(siege['adresseEtablissement']['codePaysEtrangerEtablissement'])
-                    else:
-                        cce = v(siege['adresseEtablissement']['codeCommuneEtablissement'])
-                    department = cce[:3]
-                    rpen = ''
-                    for key, value in self.RPEN.items():
-                        if department in value:
-                            rpen = key
-                    if rpen == '':
-                        department = cce[:2]
-                        for key, value in self.RPEN.items():
-                            if department in value:
-                                rpen = key
-            new_siret['RPEN'] = rpen
-            new_siret['DEPCOMEN'] = cce
-            new_siret['ADR_MAIL'] = ''
-            new_siret['NJ'] = v(u['categorieJuridiqueUniteLegale'])
-            new_siret['LIBNJ'] = v(u['categorieJuridiqueUniteLegale'])
-            new_siret['APEN700'] = v(u['activitePrincipaleUniteLegale']).replace('.', '')
-            new_siret['LIBAPEN'] = v(u['activitePrincipaleUniteLegale'])
-            new_siret['DAPEN'] = ''
-            new_siret['APRM'] = v(siret['activitePrincipaleRegistreMetiersEtablissement'])
-            new_siret['ESS'] = v(u['economieSocialeSolidaireUniteLegale'])
-            new_siret['DATEESS'] = ''
-            new_siret['TEFEN'] = v(u['trancheEffectifsUniteLegale'])
-            if u['trancheEffectifsUniteLegale']:
-                new_siret['LIBTEFEN'] = self.LIBTEFET[u['trancheEffectifsUniteLegale']]
+                    return '', ''
+                a = Fields(s.get('adresseEtablissement') or dict())
+            if v(a['codePaysEtrangerEtablissement']):
+                cce = v(a['codePaysEtrangerEtablissement'])
             else:
-                new_siret['LIBTEFEN'] = ''
-            new_siret['EFENCENT'] = ''
-            new_siret['DEFEN'] = v(u['anneeEffectifsUniteLegale'])
-            new_siret['CATEGORIE'] = v(u['categorieEntreprise'])
-            new_siret['DCREN'] = v(u['dateCreationUniteLegale'])
-            new_siret['AMINTREN'] = date.today().strftime('%Y%m')
-            new_siret['MONOACT'] = ''
-            new_siret['MODEN'] = ''
-            new_siret['PRODEN'] = ''
-            new_siret['ESAANN'] = ''
-            new_siret['TCA'] = ''
-            new_siret['ESAAPEN'] = ''
-            new_siret['ESASEC1N'] = ''
-            new_siret['ESASEC2N'] = ''
-            new_siret['ESASEC3N'] = ''
-            new_siret['ESASEC4N'] = ''
-            if v(p['etatAdministratifEtablissement']) == 'A':
-                new_siret['VMAJ'] = 'C'
+                cce = v(a['codeCommuneEtablissement'])
+            return region(cce), cce
+
+        def tranche(value):
+            return self.LIBTEFET[value] if value else ''
+
+        def etat(t, active, closed):
+            value = v(t['p']['etatAdministratifEtablissement'])
+            return active if value == 'A' else closed if value == 'F' else ''
+
+        nom = cached('nom', nom)
+        voie = cached('voie', voie)
+        pays = cached('pays', pays)
+        siege = cached('siege', siege)
+        translations = {
+            'SIREN': lambda t: v(t['siret']['siren']),
+            'NIC': lambda t: v(t['siret']['nic']),
+            'L1_NORMALISEE': nom,
+            'L3_NORMALISEE': voie,
+            'L6_NORMALISEE': lambda t: ' '.join(filter(None, [v(t['a']['codePostalEtablissement']),
+                                                               v(t['a']['libelleCommuneEtablissement'])])),
+            'L7_NORMALISEE': pays,
+            'L1_DECLAREE': nom,
+            'L3_DECLAREE': voie,
+            'L7_DECLAREE': pays,
+            'NUMVOIE': lambda t: v(t['a']['numeroVoieEtablissement']),
+            'INDREP': lambda t: v(t['a']['indiceRepetitionEtablissement']),
+            'TYPVOIE': lambda t: v(t['a']['typeVoieEtablissement']),
+            'LIBVOIE': lambda t: v(t['a']['libelleVoieEtablissement']),
+            'CODPOS': lambda t: v(t['a']['codePostalEtablissement']),
+            'CEDEX': lambda t: v(t['a']['codeCedexEtablissement']),
+            'DEPET': lambda t: v(t['a']['codeCommuneEtablissement'])[:2],
+            'COMET': lambda t: v(t['a']['codeCommuneEtablissement']),
+            'LIBCOM': lambda t: v(t['a']['libelleCommuneEtablissement']),
+            'SIEGE': lambda t: 1 if t['siret']['etablissementSiege'] else 0,
+            'ENSEIGNE': lambda t: v(t['p']['enseigne1Etablissement']),
+            'DIFFCOM': lambda t: 'O'.encode('utf-8'),
+            'AMINTRET': lambda t: date.today().strftime('%Y%m'),
+            'APET700': lambda t: v(t['p']['activitePrincipaleEtablissement']).replace('.', ''),
+            'LIBAPET': lambda t: v(t['p']['activitePrincipaleEtablissement']),
+            'TEFET': lambda t: v(t['siret']['trancheEffectifsEtablissement']),
+            'LIBTEFET': lambda t: tranche(t['siret']['trancheEffectifsEtablissement']),
+            'DEFET': lambda t: v(t['siret']['anneeEffectifsEtablissement']),
+            'DCRET': lambda t: v(t['siret']['dateCreationEtablissement']).replace('-', ''),
+            'NOMEN_LONG': nomen_long,
+            'SIGLE': lambda t: v(t['u']['sigleUniteLegale']),
+            'NOM': lambda t: v(t['u']['nomUniteLegale']),
+            'PRENOM': lambda t: v(t['u']['prenom1UniteLegale']),
+            'CIVILITE': civilite,
+            'RNA': lambda t: v(t['u']['identifiantAssociationUniteLegale']),
+            'NICSIEGE': lambda t: v(t['u']['nicSiegeUniteLegale']),
+            'RPEN': lambda t: siege(t)[0],
+            'DEPCOMEN': lambda t: siege(t)[1],
+            'NJ': lambda t: v(t['u']['categorieJuridiqueUniteLegale']),
+            'LIBNJ': lambda t: v(t['u']['categorieJuridiqueUniteLegale']),
+            'APEN700': lambda t: v(t['u']['activitePrincipaleUniteLegale']).replace('.', ''),
+            'LIBAPEN': lambda t: v(t['u']['activitePrincipaleUniteLegale']),
+            'APRM': lambda t: v(t['siret']['activitePrincipaleRegistreMetiersEtablissement']),
+            'ESS': lambda t: v(t['u']['economieSocialeSolidaireUniteLegale']),
+            'TEFEN': lambda t: v(t['u']['trancheEffectifsUniteLegale']),
+            'LIBTEFEN': lambda t: tranche(t['u']['trancheEffectifsUniteLegale']),
+            'DEFEN': lambda t: v(t['u']['anneeEffectifsUniteLegale']),
+            'CATEGORIE': lambda t: v(t['u']['categorieEntreprise']),
+            'DCREN': lambda t: v(t['u']['dateCreationUniteLegale']),
+            'AMINTREN': lambda t: date.today().strftime('%Y%m'),
+            'VMAJ': lambda t: etat(t, 'C', 'O'),
+            'DATEMAJ': lambda t: v(t['siret']['dateDernierTraitementEtablissement']),
+            'EVE': lambda t: etat(t, 'CE', 'O'),
+            'DATEVE': lambda t: v(t['siret']['dateDernierTraitementEtablissement'])[:10].replace('-', '')}
+
+        # The other columns are not provided by the API
+        return [(column, translations.get(column, lambda t: '')) for column in HEADER if column in columns]
+
+    def translate_siret(self, siret, siret_siege):
+        new_siret = OrderedDict()
+        if self.translation_plan is None:
+            self.translation_plan = self.get_translation_plan()
+        try:
+            # Fields left out by masquerValeursNulles or champs read as None
+            t = dict(zip(('siret', 'u', 'a', 'a2', 'p'), etablissement_fields(siret)), sieges=siret_siege)
+            if t['p']['etatAdministratifEtablissement'] == 'A':
                 self.count_in += 1
-            elif v(p['etatAdministratifEtablissement']) == 'F':
-                new_siret['VMAJ'] = 'O'
+            elif t['p']['etatAdministratifEtablissement'] == 'F':
                 self.count_out += 1
-            new_siret['VMAJ1'] = ''
-            new_siret['VMAJ2'] = ''
-            new_siret['VMAJ3'] = ''
-            new_siret['DATEMAJ'] = v(siret['dateDernierTraitementEtablissement'])
-            if v(p['etatAdministratifEtablissement']) == 'A':
-                new_siret['EVE'] = 'CE'
-            elif v(p['etatAdministratifEtablissement']) == 'F':
-                new_siret['EVE'] = 'O'
-            new_siret['DATEVE'] = v(siret['dateDernierTraitementEtablissement'])[:10].replace('-', '')
-            new_siret['TYPCREH'] = ''
-            new_siret['DREACTET'] = ''
-            new_siret['DREACTEN'] = ''
-            new_siret['MADRESSE'] = ''
-            new_siret['MENSEIGNE'] = ''
-            new_siret['MAPET'] = ''
-            new_siret['MPRODET'] = ''
-            new_siret['MAUXILT'] = ''
-            new_siret['MNOMEN'] = ''
-            new_siret['MSIGLE'] = ''
-            new_siret['MNICSIEGE'] = ''
-            new_siret['MNJ'] = ''
-            new_siret['MAPEN'] = ''
-            new_siret['MPRODEN'] = ''
-            new_siret['SIRETPS'] = ''
-            new_siret['TEL'] = ''
+            for column, translation in self.translation_plan:
+                new_siret[column] = translation(t)
         except KeyError as e:
             self.logger.error('  missing key in siret received from API: %s', e)
             if self.debug:
@@ -593,29 +772,386 @@ class INSEECommand(GeneratingCommand):
                 self.logger.debug('  new_siret object: %s', new_siret)
             raise ExceptionTranslation('Error during siret translation')
 
+        return new_siret
+
+    def generate_siret(self, new_siret):
         raw = ''.join(k + '=' + '\"{0}\"'.format(v) + ' ' for k, v in new_siret.items())
         return raw
 
+    def get_days(self):
+        if self.catchup and self.dtr:
+            self.logger.error('  dtr cannot be set with catchup')
+            raise ExceptionDateParameter('dtr cannot be set with catchup')
+        # A range of days has been set
+        if self.dtr_start or self.dtr_end:
+            if not self.dtr_start or not self.dtr_end:
+                self.logger.error('  dtr_start and dtr_end must be set together')
+                raise ExceptionDateParameter('dtr_start and dtr_end must be set together')
+            if self.dtr:
+                self.logger.error('  dtr cannot be set with dtr_start and dtr_end')
+                raise ExceptionDateParameter('dtr cannot be set with dtr_start and dtr_end')
+            start = datetime.strptime(self.dtr_start, '%Y-%m-%d').date()
+            end = datetime.strptime(self.dtr_end, '%Y-%m-%d').date()
+            if end < start:
+                self.logger.error('  dtr_end %s is before dtr_start %s', self.dtr_end, self.dtr_start)
+                raise ExceptionDateParameter('dtr_end is before dtr_start')
+            return [(start + timedelta(i)).strftime('%Y-%m-%d') for i in xrange((end - start).days + 1)]
+        # Date to retrieve has been set
+        if self.dtr:
+            return [self.dtr]
+        # Day before yesterday
+        return [(date.today() - timedelta(1)).strftime('%Y-%m-%d')]
+
+    def get_last_day(self, status_object):
+        # Last day processed by INSEE for the establishments, yesterday when the status does not tell
+        if status_object:
+            for collection in status_object.get('datesDernieresMisesAJourDesDonnees', []):
+                if u'tablissement' in (collection.get('collection') or u'') and \
+                        collection.get('dateDernierTraitementMaximum'):
+                    return collection['dateDernierTraitementMaximum'][:10]
+        return (date.today() - timedelta(1)).strftime('%Y-%m-%d')
+
+    def get_catchup_days(self, status_object, quota=True):
+        """Return the days missing from the ledger, oldest first, that fit in the remaining daily quota."""
+        last_day = self.get_last_day(status_object)
+        if self.dtr_start:
+            first, last = self.dtr_start, min(self.dtr_end, last_day)
+        else:
+            first = (datetime.strptime(last_day, '%Y-%m-%d').date() - timedelta(self.catchup_days - 1)).strftime(
+                '%Y-%m-%d')
+            last = last_day
+        days = self.ledger.missing(first, last) if first <= last else []
+        self.logger.info('  catchup: %d days missing between %s and %s', len(days), first, last)
+
+        if quota and self.daily_quota and days:
+            remaining = self.daily_quota - self.ledger.used_today()
+            count = max(0, remaining // self.ledger.cost())
+            if count < len(days):
+                self.logger.info('  catchup: %d requests left in the daily quota, %d days postponed from %s',
+                                 remaining, len(days) - count, days[count])
+                days = days[:count]
+
+        return days
+
+    def get_day_counts(self, days):
+        """Return the number of establishments updated each day and whether they come from a single facet."""
+        # A date stands for its midnight, so the range ends before the midnight that follows the last day
+        end = (datetime.strptime(days[-1], '%Y-%m-%d') + timedelta(1)).strftime('%Y-%m-%d')
+        q = 'dateDernierTraitementEtablissement:[%s TO %s}' % (days[0], end)
+        try:
+            j = self.get_siret(q=q, nombre=1, facette='dateDernierTraitementEtablissement',
+                               facette_nombre=self.facet_size)
+            counts = dict()
+            for modalite in j['facettes'][0]['modalites']:
+                day = modalite['valeur'][:10]
+                counts[day] = counts.get(day, 0) + modalite['nombre']
+            # A truncated facet does not cover every establishment of the range
+            if sum(counts.values()) == j['header']['total']:
+                return dict((day, counts.get(day, 0)) for day in days), True
+        except (ExceptionSiret, KeyError, IndexError):
+            pass
+
+        self.logger.info('  date facet is not available, the establishments are counted day by day')
+        counts = dict()
+        for day in days:
+            try:
+                counts[day] = self.get_siret(q='dateDernierTraitementEtablissement:' + day, nombre=1)['header']['total']
+            except ExceptionSiret:
+                # The API answers 404 for a day without any update
+                counts[day] = 0
+        return counts, False
+
+    def generate_plan(self, days):
+        """Yield the estimate of the harvest of each day and of the whole harvest."""
+        counts, facet = self.get_day_counts(days)
+        plan = HarvestPlan(self.rate_budget.per_minute, workers=self.workers,
+                           requests_per_page=self.ledger.requests_per_page(), daily_quota=self.daily_quota,
+                           used_today=self.ledger.used_today())
+        for day in days:
+            entry = plan.add(day, counts[day], facet)
+            self.logger.info('  plan: %s, %d siret, %d requests', day, entry['records'], entry['requests'])
+            entry['_time'] = time.time()
+            yield entry
+        summary = plan.summary()
+        self.logger.info('  plan: %d requests in %.1f minutes', summary['requests'], summary['minutes'])
+        summary['_time'] = time.time()
+        yield summary
+
+    def prepare_day(self, day_to_retrieve):
+        """Return the harvest of a day: its checkpoint, export, journal and the progress to resume from."""
+        harvest = {'dtr': day_to_retrieve, 'curseur': '*', 'pages': 0, 'event': 1, 'received': 0, 'count_in': 0,
+                   'count_out': 0, 'complete': False, 'export': None, 'journal': None, 'requests': 0}
+
+        # Progress is saved after each page so that resume=true continues from the last completed page
+        checkpoint = Checkpoint(day_to_retrieve, self.logger)
+        state = checkpoint.load() if self.resume or self.export == 'xl2' else None
+        if state is None:
+            checkpoint.start()
+        harvest['checkpoint'] = checkpoint
+
+        # The XL2 file is directly written by the command
+        # An interrupted export of the same day is resumed at the cursor of its last committed page
+        if self.export == 'xl2':
+            xl2_export = XL2Export(day_to_retrieve, self.logger)
+            manifest = xl2_export.read_manifest()
+            if manifest and manifest['curseur']:
+                xl2_export.resume(manifest)
+                # The export is the reference, the headquarters of the checkpoint are kept whatever its page
+                if not state or state['curseur'] != manifest['curseur']:
+                    state = {'curseur': manifest['curseur'], 'pages': 0, 'events': manifest['records'],
+                             'received': manifest['records'], 'count_in': 0, 'count_out': 0,
+                             'complete': manifest['complete']}
+            else:
+                xl2_export.start(self._metadata.searchinfo.sid)
+                state = None
+            harvest['export'] = xl2_export
+
+        if state:
+            harvest.update(curseur=state['curseur'], pages=state['pages'], event=state['events'] + 1,
+                           received=state['received'], count_in=state['count_in'], count_out=state['count_out'],
+                           complete=state['complete'])
+            self.logger.info('  resume dtr %s after page %d and %d events', day_to_retrieve.encode('utf-8'),
+                             state['pages'], state['events'])
+        elif self.resume:
+            self.logger.info('  no checkpoint to resume for dtr %s, start from the first page',
+                             day_to_retrieve.encode('utf-8'))
+
+        # Pages are replayed from the journal of the day or recorded in it
+        if self.replay:
+            harvest['journal'] = Journal(day_to_retrieve, self.logger)
+            self.logger.info('  replay %d pages of the journal', len(harvest['journal']))
+        elif self.journal:
+            harvest['journal'] = Journal(day_to_retrieve, self.logger)
+            # A harvest from the first page replaces the journal of the day
+            if not state:
+                harvest['journal'].reset()
+
+        return harvest
+
+    def fetch_updated_pages(self, harvest):
+        """Yield the pages of updated siret of a day: total, next cursor and updated siret."""
+        curseur = harvest['curseur']
+        complete = harvest['complete']
+        while not complete:
+            total, curseur_suivant, updated_siret_list = self.get_updated_siret_records(harvest['dtr'], curseur,
+                                                                                        harvest['journal'])
+            yield total, curseur_suivant, updated_siret_list
+
+            # We get the same curseur so we get all updated siret
+            complete = curseur_suivant == curseur
+            curseur = curseur_suivant
+
+    def resolve_sieges(self, harvest, page, window, known_sieges):
+        """
+            Return a page with the headquarters of its branches, taken from the headquarters already resolved, the
+            window, the local store or the API.
+        """
+        total, curseur_suivant, updated_siret_list = page
+        start = time.time()
+        # Headquarters are only used by the RPEN and DEPCOMEN columns
+        if 'RPEN' not in self.columns and 'DEPCOMEN' not in self.columns:
+            if not self.replay:
+                harvest['requests'] += 1
+            return total, curseur_suivant, updated_siret_list, dict()
+
+        siret_to_retrieve = list()
+        window_sieges = dict()
+        page_sieges = dict()
+        wanted = set()
+        for siret in updated_siret_list:
+            if not siret['etablissementSiege']:
+                siege = siret['siren'] + siret['uniteLegale']['nicSiegeUniteLegale']
+                if siege in wanted:
+                    continue
+                wanted.add(siege)
+                if siege in known_sieges:
+                    # Most recently used
+                    page_sieges[siege] = known_sieges[siege] = known_sieges.pop(siege)
+                elif siege in window:
+                    window_sieges[siege] = window[siege]
+                else:
+                    siret_to_retrieve.append(siege)
+        if window_sieges:
+            self.logger.info('  %d headquarters found in the updated pages', len(window_sieges))
+
+        # Headquarters of the local store are up to date when it is maintained daily
+        local_sieges = dict()
+        if self.store and not self.replay:
+            local_sieges = self.sirene_store.get_sieges(siret_to_retrieve)
+            siret_to_retrieve = [siret for siret in siret_to_retrieve if siret not in local_sieges]
+            self.logger.info('  %d headquarters found in the local store', len(local_sieges))
+            # They are journaled as a page of headquarters, so that a replay resolves them without the store
+            if local_sieges and harvest['journal'] is not None:
+                body = {'etablissements': [dict(siege, siret=siret) for siret, siege in local_sieges.items()]}
+                harvest['journal'].record(json.dumps(body).encode('utf-8'), kind='siege', sirets=list(local_sieges))
+
+        # We retrieve the remaining headquarters
+        sieges = self.get_etablissements_siege(siret_to_retrieve, harvest['journal'])
+        sieges.update(local_sieges)
+        sieges.update(window_sieges)
+        for siege, etablissement in sieges.items():
+            page_sieges[siege] = known_sieges[siege] = Checkpoint.compact_siege(etablissement)
+        while len(known_sieges) > self.siege_cache:
+            known_sieges.popitem(last=False)
+        if not self.replay:
+            harvest['requests'] += 1 + len(list(self.chunks(siret_to_retrieve, self.sieges_per_request)))
+        # Includes the requests of the headquarters
+        self.stage_metrics.add('headquarters', time.time() - start, 1, len(updated_siret_list), len(sieges))
+
+        return total, curseur_suivant, updated_siret_list, page_sieges
+
+    def fetch_pages(self, harvest):
+        """
+            Yield the pages of a day with their headquarters: total, next cursor, updated siret and headquarters.
+
+            Pages are sorted by SIREN, so the headquarters updated the same day arrive next to their branches. The
+            headquarters of the last siege_window updated siret are kept, and each page is resolved once the next one
+            has been received, so that a headquarters on the following page is found without any request. The last
+            siege_cache headquarters resolved are kept for the branches of the next pages, starting from the ones
+            reloaded by the checkpoint.
+        """
+        known_sieges = harvest['checkpoint'].sieges
+        window = OrderedDict()
+        pending = None
+        for page in self.fetch_updated_pages(harvest):
+            for siret in page[2]:
+                if siret['etablissementSiege']:
+                    window[siret['siret']] = siret
+            while len(window) > self.siege_window:
+                window.popitem(last=False)
+            if pending is not None:
+                yield self.resolve_sieges(harvest, pending, window, known_sieges)
+            pending = page
+        if pending is not None:
+            yield self.resolve_sieges(harvest, pending, window, known_sieges)
+
+    def fetch_days(self, days):
+        """
+            Yield the harvest of each day with its pages, in date order.
+
+            With more than one worker, the pages of the next days are fetched by threads while the current day is
+            generated. Each thread keeps at most queue_size pages ahead of the main thread.
+        """
+        if self.workers == 1 or len(days) == 1:
+            for day in days:
+                harvest = self.prepare_day(day)
+                yield harvest, self.fetch_pages(harvest)
+            return
+
+        days = deque(days)
+        running = deque()
+        while days or running:
+            while days and len(running) < self.workers:
+                harvest = self.prepare_day(days.popleft())
+                running.append((harvest, threaded([self.fetch_pages(harvest)], self.queue_size)))
+            yield running.popleft()
+
+    def harvest_day(self, harvest, pages):
+        day_to_retrieve = harvest['dtr']
+        checkpoint = harvest['checkpoint']
+        xl2_export = harvest['export']
+        event = harvest['event']
+        page_count = harvest['pages']
+        received_siret = harvest['received']
+        self.count_in = harvest['count_in']
+        self.count_out = harvest['count_out']
+        curseur = harvest['curseur']
+
+        # Log the requested date to help debugging
+        self.logger.info('  dtr: %s', day_to_retrieve.encode('utf-8'))
+
+        first_call = True
+        for _, curseur_suivant, updated_siret_list, sieges in pages:
+            page_count += 1
+
+            if first_call:
+                self.logger.info('  retrieved a total of %d siret to update', _)
+                first_call = False
+                # The snapshot grows once for the day, not while its establishments are applied
+                if self.modifications:
+                    self.modification_snapshot.reserve(_)
+            self.logger.info('  retrieved %d siret to update in this window', len(updated_siret_list))
+            received_siret += len(updated_siret_list)
+            self.logger.info('  retrieved %d siret / %d', received_siret, _)
+
+            checkpoint.add_sieges(sieges)
+            # A replay does not bring anything newer than the store
+            if self.store and not self.replay:
+                self.sirene_store.upsert(updated_siret_list)
+            # Time spent translating the page and writing its records, to the export or to Splunk
+            translation = 0.0
+            writing = 0.0
+            for siret in updated_siret_list:
+                start = time.time()
+                new_siret = self.translate_siret(siret, sieges)
+                if self.modifications:
+                    self.modification_snapshot.apply(new_siret, day_to_retrieve)
+                if xl2_export:
+                    record = self.apply_lookups(new_siret)
+                    translated = time.time()
+                    xl2_export.write(record)
+                else:
+                    raw_data = self.generate_siret(new_siret)
+                    translated = time.time()
+                    yield {'_time': translated, 'event_no': event, '_raw': raw_data}
+                translation += translated - start
+                writing += time.time() - translated
+                event += 1
+            self.stage_metrics.add('translation', translation, len(updated_siret_list), len(updated_siret_list),
+                                   len(updated_siret_list))
+            self.stage_metrics.add('write', writing, len(updated_siret_list), len(updated_siret_list),
+                                   len(updated_siret_list))
+            self.generated += len(updated_siret_list)
+            # The events of the page are sent before waiting for the next one
+            self.flush_partial()
+
+            # We get the same curseur so we get all updated siret
+            complete = curseur_suivant == curseur
+
+            if xl2_export:
+                xl2_export.commit(curseur_suivant, complete)
+            checkpoint.save(dtr=day_to_retrieve, curseur=curseur_suivant, pages=page_count, events=event - 1,
+                            received=received_siret, total=_, count_in=self.count_in, count_out=self.count_out,
+                            complete=complete)
+
+            curseur = curseur_suivant
+
+        self.logger.info('  generated %d events', event-1)
+        self.logger.info('  found %d SIRET to create', self.count_in)
+        self.logger.info('  found %d SIRET to delete', self.count_out)
+
+        if self.modifications:
+            self.modification_snapshot.flush()
+
+        zip_filename = None
+        if xl2_export:
+            zip_filename = xl2_export.close()
+            yield {'dtr': day_to_retrieve, 'file': zip_filename, 'records': xl2_export.records}
+
+        if self.journal and not self.replay:
+            harvest['journal'].compact()
+
+        # Only a day harvested from the API and exported completely is skipped by catchup=true, the other harvests
+        # only use the quota
+        if self.replay:
+            pass
+        elif xl2_export:
+            self.ledger.add(day_to_retrieve, records=event - 1, pages=page_count, requests=harvest['requests'],
+                            filename=zip_filename if xl2_export.records else None)
+        else:
+            self.ledger.count(harvest['requests'])
+
+        checkpoint.remove()
+
+    @profiled
     def generate(self):
         try:
+            self.stage_metrics = StageMetrics()
+            self.generated = 0
             self.set_configuration()
 
-            # CSV header
-            csv_header = ['SIREN', 'NIC', 'L1_NORMALISEE', 'L2_NORMALISEE', 'L3_NORMALISEE', 'L4_NORMALISEE', 'L5_NORMALISEE',
-             'L6_NORMALISEE', 'L7_NORMALISEE', 'L1_DECLAREE', 'L2_DECLAREE', 'L3_DECLAREE', 'L4_DECLAREE', 'L5_DECLAREE',
-             'L6_DECLAREE', 'L7_DECLAREE', 'NUMVOIE', 'INDREP', 'TYPVOIE', 'LIBVOIE', 'CODPOS', 'CEDEX', 'RPET', 'LIBREG',
-             'DEPET', 'ARRONET', 'CTONET', 'COMET', 'LIBCOM', 'DU', 'TU', 'UU', 'EPCI', 'TCD', 'ZEMET', 'SIEGE', 'ENSEIGNE',
-             'IND_PUBLIPO', 'DIFFCOM', 'AMINTRET', 'NATETAB', 'LIBNATETAB', 'APET700', 'LIBAPET', 'DAPET', 'TEFET',
-             'LIBTEFET', 'EFETCENT', 'DEFET', 'ORIGINE', 'DCRET', 'DDEBACT', 'ACTIVNAT', 'LIEUACT', 'ACTISURF', 'SAISONAT',
-             'MODET', 'PRODET', 'PRODPART', 'AUXILT', 'NOMEN_LONG', 'SIGLE', 'NOM', 'PRENOM', 'CIVILITE', 'RNA', 'NICSIEGE',
-             'RPEN', 'DEPCOMEN', 'ADR_MAIL', 'NJ', 'LIBNJ', 'APEN700', 'LIBAPEN', 'DAPEN', 'APRM', 'ESS', 'DATEESS',
-             'TEFEN', 'LIBTEFEN', 'EFENCENT', 'DEFEN', 'CATEGORIE', 'DCREN', 'AMINTREN', 'MONOACT', 'MODEN', 'PRODEN',
-             'ESAANN', 'TCA', 'ESAAPEN', 'ESASEC1N', 'ESASEC2N', 'ESASEC3N', 'ESASEC4N', 'VMAJ', 'VMAJ1', 'VMAJ2', 'VMAJ3',
-             'DATEMAJ', 'EVE', 'DATEVE', 'TYPCREH', 'DREACTET', 'DREACTEN', 'MADRESSE', 'MENSEIGNE', 'MAPET', 'MPRODET',
-             'MAUXILT', 'MNOMEN', 'MSIGLE', 'MNICSIEGE', 'MNJ', 'MAPEN', 'MPRODEN', 'SIRETPS', 'TEL']
-
             # Get status
-            status_object = self.get_status()
+            status_object = None if self.replay else self.get_status()
             if status_object:
                 if 'versionService' in status_object:
                     self.logger.info('  versionService %s', status_object['versionService'].encode('utf-8'))
@@ -639,57 +1175,57 @@ class INSEECommand(GeneratingCommand):
                             msg += ' '
                         self.logger.info('  %s', msg.encode('utf-8'))
 
-            # Date to retrieve has been set
-            if self.dtr:
-                day_to_retrieve = self.dtr
-            # Day before yesterday
-            else:
-                day_to_retrieve = (date.today() - timedelta(1)).strftime('%Y-%m-%d')
-
-            # Log the requested date to help debugging
-            self.logger.info('  dtr: %s', day_to_retrieve.encode('utf-8'))
+            # Completed days are recorded in the ledger
+            self.ledger = Ledger(self.logger)
+            if self.store:
+                self.sirene_store = SireneStore(self.logger)
+            # Last exported version of each establishment, compared to set the M* indicators
+            if self.modifications:
+                self.modification_snapshot = ModificationSnapshot(self.logger)
+
+            if self.plan and self.replay:
+                self.logger.error('  plan cannot be set with replay')
+                raise ExceptionConfiguration('plan cannot be set with replay')
+            days = self.get_days()
+            if self.catchup:
+                # The plan shows every missing day and where the daily quota is exhausted
+                days = self.get_catchup_days(status_object, quota=not self.plan)
+            if len(days) > 1:
+                self.logger.info('  dtr range: %s to %s, %d days with %d workers', days[0], days[-1], len(days),
+                                 self.workers)
             # Log the username to help debugging
             self.logger.info('  Splunk username: %s', self._metadata.searchinfo.username.encode('utf-8'))
 
-            event = 1
-            curseur = '*'
-            first_call = True
-            received_siret = 0
-            while True:
-                _, curseur_suivant, updated_siret_list = self.get_updated_siret_records(day_to_retrieve, curseur)
-
-                if first_call:
-                    self.logger.info('  retrieved a total of %d siret to update', _)
-                    first_call = False
-                self.logger.info('  retrieved %d siret to update in this window', len(updated_siret_list))
-                received_siret += len(updated_siret_list)
-                self.logger.info('  retrieved %d siret / %d', received_siret, _)
-
-                siret_to_retrieve = list()
-                for siret in updated_siret_list:
-                    if not siret['etablissementSiege']:
-                        if siret['siren'] + siret['uniteLegale']['nicSiegeUniteLegale'] not in siret_to_retrieve:
-                            siret_to_retrieve.append(siret['siren'] + siret['uniteLegale']['nicSiegeUniteLegale'])
-
-                # We retrieve all headquarters
-                siret_siege = self.get_etablissements_siege(siret_to_retrieve)
-                for siret in updated_siret_list:
-                    raw_data = self.generate_siret(siret, siret_siege)
-                    yield {'_time': time.time(), 'event_no': event, '_raw': raw_data}
-                    event += 1
-
-                # We get the same curseur so we get all updated siret
-                if curseur_suivant == curseur:
-                    break
-
-                curseur = curseur_suivant
-
-            self.logger.info('  generated %d events', event-1)
-            self.logger.info('  found %d SIRET to create', self.count_in)
-            self.logger.info('  found %d SIRET to delete', self.count_out)
+            # Only the columns used by the search are computed and requested from the API
+            self.columns = self.get_columns()
+            self.translation_plan = self.get_translation_plan(self.columns)
+            if len(self.columns) < len(HEADER):
+                self.logger.info('  %d XL2 columns produced', len(self.columns))
+
+            if self.plan:
+                if days:
+                    for record in self.generate_plan(days):
+                        yield record
+                return
+
+            if self.export == 'xl2':
+                self.set_lookups()
+            if self.journal and not self.replay:
+                Journal.purge(self.logger, self.journal_retention)
+
+            # Days are generated one after the other, in date order
+            for harvest, pages in self.fetch_days(days):
+                for record in self.harvest_day(harvest, pages):
+                    yield record
+
+            self.stage_metrics.log(self.logger)
+            self.stage_metrics.write(self)
+            if self.metrics:
+                yield self.stage_metrics.summary(self.generated)
 
         except (ExceptionTranslation, ExceptionHeadquarters, ExceptionUpdatedSiret, ExceptionSiret, ExceptionStatus,
-                ExceptionToken, ExceptionConfiguration):
+                ExceptionToken, ExceptionConfiguration, ExceptionDateParameter, ExceptionModifications,
+                ExceptionFieldsParameter):
             raise
 
         # This is a bad practise, but we want a specific message in log file
@@ -7,8 +7,17 @@ import requests
 from datetime import date, timedelta, datetime
 from requests.auth import HTTPBasicAuth
 from splunklib.searchcommands import dispatch, GeneratingCommand, Configuration, Option, validators
-from splunklib import six
 from collections import OrderedDict
+from sirenelib.journal import Journal
+from sirenelib.fields import etablissement_fields
+from sirenelib.metrics import StageMetrics
+from sirenelib.planner import HarvestPlan
+from sirenelib.profiler import profiled
+from sirenelib.prospects import ProspectSnapshot
+from sirenelib.ratelimit import RateBudget
+from sirenelib.store import SireneStore
+from sirenelib.threads import threaded
+from sirenelib.validators import Date
 import json
 import os
 
@@ -45,21 +54,50 @@ class ExceptionDateParameter(Exception):
     pass
 
 
+class ExceptionSnapshot(Exception):
+    pass
+
+
 @Configuration(type='events')
 class PNAFCommand(GeneratingCommand):
     """ Synopsis
 
     ##Syntax
 
-    | pnaf [proxy=true] [debug=true]
+    | pnaf [proxy=true] [debug=true] [workers=n] [mode=delta [dtr=date_to_retrieve]] [store=true] [plan=true]
+    [metrics=true] [profile=true [profile_memory=true]]
 
     ##Description
 
     Request the Sirene API for the prospect
 
+    The NAF codes are split in partitions of close sizes, from the counts of a facet on the prospect query. Each
+    partition is harvested on its own cursor, up to workers partitions at the same time
+
+    With mode=delta only the prospects created, modified or closed on a day are returned, from the establishments
+    updated that day and the snapshot of the previous harvests. The days skipped since the last delta are applied
+    first, in order, and a day already applied is refused
+
+    With store=true the prospects are read from the local Sirene store maintained by insee instead of the API
+
+    With plan=true nothing is harvested: an event per partition of NAF codes estimates the pages, requests and
+    duration of a full harvest under the rate limit
+
+    Stages are timed in the Job Inspector as for insee, and metrics=true sums them up in a last event
+
+    profile=true and profile_memory=true profile the harvest, as they do for insee
+
     """
     debug = Option(require=False, validate=validators.Boolean())
     proxy = Option(require=False, validate=validators.Boolean())
+    workers = Option(require=False, validate=validators.Integer(minimum=1, maximum=8), default=1)
+    mode = Option(require=False, validate=validators.Set('full', 'delta'), default='full')
+    dtr = Option(require=False, validate=Date())
+    store = Option(require=False, validate=validators.Boolean())
+    plan = Option(require=False, validate=validators.Boolean())
+    metrics = Option(require=False, validate=validators.Boolean())
+    profile = Option(require=False, validate=validators.Boolean())
+    profile_memory = Option(require=False, validate=validators.Boolean())
 
     # https://www.sirene.fr/sirene/public/variable/tefet
     LIBTEFET = {'NN': 'Unités non employeuses',
@@ -112,6 +150,12 @@ class PNAFCommand(GeneratingCommand):
 
     count_in = 0
     count_out = 0
+    # Longest list of NAF codes in a single query
+    naf_per_request = 100
+    # Pages received in advance from the partitions
+    queue_size = 8
+    # False when the counts of the prospects could not be read from the NAF facet
+    prospect_facet = True
 
     def set_configuration(self):
         # Open the configuration file
@@ -152,7 +196,10 @@ class PNAFCommand(GeneratingCommand):
         self.endpoint_etablissement = conf['endpoint_etablissement']
         self.endpoint_informations = conf['endpoint_informations']
         self.prospects = conf['prospects']
-        self.bearer_token = self.get_api_token()
+        # Requests per minute allowed by the API, shared by all the partitions
+        self.rate_budget = RateBudget(int(conf.get('rate_limit', 30)))
+        with self.stage_metrics.timer('token'):
+            self.bearer_token = self.get_api_token()
 
     def get_api_token(self):
         payload = {'grant_type': 'client_credentials'}
@@ -179,7 +226,10 @@ class PNAFCommand(GeneratingCommand):
     def get_status(self):
         # Initialize
         headers = {'Authorization': 'Bearer ' + self.bearer_token}
+        start = time.time()
+        waited = 0
 
+        self.rate_budget.acquire()
         if self.proxy:
             r = requests.get(self.endpoint_informations, headers=headers,
                              proxies=self.proxies)
@@ -192,7 +242,8 @@ class PNAFCommand(GeneratingCommand):
         while r.status_code == 429:
             # We made too many requests. We wait for the next rounded minute
             current_second = datetime.now().time().strftime('%S')
-            time.sleep(60 - int(current_second) + 1)
+            waited += self.stage_metrics.sleep('wait_429', 60 - int(current_second) + 1)
+            self.rate_budget.acquire()
             if self.proxy:
                 r = requests.get(self.endpoint_informations, headers=headers,
                                  proxies=self.proxies)
@@ -200,10 +251,12 @@ class PNAFCommand(GeneratingCommand):
                 r = requests.get(self.endpoint_informations, headers=headers)
             if self.debug:
                 self.logger.debug('  status response %s\n%s', r.headers, r.text)
+        self.stage_metrics.add('status', time.time() - start - waited)
 
         if r.headers['Content-Type'] and 'application/json' in r.headers['Content-Type']:
             if r.status_code == 200:
-                return r.json()
+                with self.stage_metrics.timer('decode'):
+                    return r.json()
             elif r.status_code == 401:
                 self.logger.error('  invalid bearer token %s in status request', self.bearer_token)
             elif r.status_code == 406:
@@ -214,11 +267,16 @@ class PNAFCommand(GeneratingCommand):
             self.logger.error('  error during status retrieval. Code received : %d', r.status_code)
         raise ExceptionStatus('Error during information retrieval')
 
-    def post_siret(self, q=None, nombre=None, curseur=None, champs=None, date=None, gzip=False):
+    def post_siret(self, q=None, nombre=None, curseur=None, champs=None, date=None, gzip=False, facette=None,
+                   facette_nombre=None):
         # Initialize
         payload = dict()
         if champs:
             payload['champs'] = champs
+        if facette:
+            payload['facette.champ'] = facette
+        if facette_nombre:
+            payload['facette.nombre'] = facette_nombre
         if q:
             payload['q'] = q
         if nombre:
@@ -237,7 +295,10 @@ class PNAFCommand(GeneratingCommand):
         if gzip:
             # Request GZip content
             headers['Accept-Encoding'] = 'gzip'
+        start = time.time()
+        waited = 0
 
+        self.rate_budget.acquire()
         if self.proxy:
             r = requests.post(self.endpoint_etablissement, headers=headers, data=payload, proxies=self.proxies)
         else:
@@ -249,7 +310,8 @@ class PNAFCommand(GeneratingCommand):
         while r.status_code == 429:
             # We made too many requests. We wait for the next rounded minute
             current_second = datetime.now().time().strftime('%S')
-            time.sleep(60 - int(current_second) + 1)
+            waited += self.stage_metrics.sleep('wait_429', 60 - int(current_second) + 1)
+            self.rate_budget.acquire()
             if self.proxy:
                 r = requests.post(self.endpoint_etablissement, headers=headers, data=payload, proxies=self.proxies)
             else:
@@ -261,7 +323,8 @@ class PNAFCommand(GeneratingCommand):
         while r.status_code == 500:
             # In case we get a 500 we prefer to retry our request before raising an error
             internal_error_counter += 1
-            time.sleep(60)
+            waited += self.stage_metrics.sleep('retry_500', 60)
+            self.rate_budget.acquire()
             if self.proxy:
                 r = requests.post(self.endpoint_etablissement, headers=headers, data=payload, proxies=self.proxies)
             else:
@@ -270,10 +333,13 @@ class PNAFCommand(GeneratingCommand):
                 self.logger.debug('  POST siret response %s\n%s', r.headers, r.text)
             if internal_error_counter == 10:
                 break
+        # The gzip content is inflated by requests while it is received
+        self.stage_metrics.add('fetch', time.time() - start - waited, output_count=len(r.content))
 
         if r.headers['Content-Type'] and 'application/json' in r.headers['Content-Type']:
             if r.status_code == 200:
-                return r.json()
+                with self.stage_metrics.timer('decode'):
+                    return r.json()
             elif r.status_code == 400:
                 self.logger.error('  invalid parameters in POST query: %s', r.json()['header']['message'])
             elif r.status_code == 401:
@@ -314,7 +380,10 @@ class PNAFCommand(GeneratingCommand):
         if gzip:
             # Request GZip content
             headers['Accept-Encoding'] = 'gzip'
+        start = time.time()
+        waited = 0
 
+        self.rate_budget.acquire()
         if self.proxy:
             r = requests.get(self.endpoint_etablissement, headers=headers, params=payload,
                              proxies=self.proxies)
@@ -327,7 +396,8 @@ class PNAFCommand(GeneratingCommand):
         while r.status_code == 429:
             # We made too many requests. We wait for the next rounded minute
             current_second = datetime.now().time().strftime('%S')
-            time.sleep(60 - int(current_second) + 1)
+            waited += self.stage_metrics.sleep('wait_429', 60 - int(current_second) + 1)
+            self.rate_budget.acquire()
             if self.proxy:
                 r = requests.get(self.endpoint_etablissement, headers=headers, params=payload,
                                  proxies=self.proxies)
@@ -340,7 +410,8 @@ class PNAFCommand(GeneratingCommand):
         while r.status_code == 500:
             # In case we get a 500 we prefer to retry our request before raising an error
             internal_error_counter += 1
-            time.sleep(60)
+            waited += self.stage_metrics.sleep('retry_500', 60)
+            self.rate_budget.acquire()
             if self.proxy:
                 r = requests.get(self.endpoint_etablissement, headers=headers, params=payload,
                                  proxies=self.proxies)
@@ -350,10 +421,13 @@ class PNAFCommand(GeneratingCommand):
                 self.logger.debug('  GET siret response %s\n%s', r.headers, r.text)
             if internal_error_counter == 10:
                 break
+        # The gzip content is inflated by requests while it is received
+        self.stage_metrics.add('fetch', time.time() - start - waited, output_count=len(r.content))
 
         if r.headers['Content-Type'] and 'application/json' in r.headers['Content-Type']:
             if r.status_code == 200:
-                return r.json()
+                with self.stage_metrics.timer('decode'):
+                    return r.json()
             elif r.status_code == 400:
                 self.logger.error('  invalid parameters in GET query: %s', r.json()['header']['message'])
             elif r.status_code == 401:
@@ -371,17 +445,69 @@ class PNAFCommand(GeneratingCommand):
 
         raise ExceptionSiret('Error during siret GET retrieval')
 
-    def get_prospects(self, curseur):
+    @staticmethod
+    def get_prospects_query(prospects):
+        # Build the filter
+        naf = ''
+        for prospect in prospects:
+            naf += 'activitePrincipaleEtablissement:' + prospect + ' OR '
+        return 'periode(etatAdministratifEtablissement:A AND (' + naf[:-4] + '))'
+
+    def get_prospect_counts(self):
+        """Return the number of active establishments of each prospect NAF code, from a facet of the API."""
+        counts = dict()
+        try:
+            for partition in self.chunks(self.prospects, self.naf_per_request):
+                j = self.post_siret(q=self.get_prospects_query(partition), nombre=1,
+                                    date=date.today().strftime('%Y-%m-%d'), facette='activitePrincipaleEtablissement',
+                                    facette_nombre=len(partition))
+                for modalite in j['facettes'][0]['modalites']:
+                    counts[modalite['valeur']] = modalite['nombre']
+        except (ExceptionSiret, KeyError, IndexError):
+            # Without counts the codes are split evenly
+            self.logger.info('  NAF facet is not available, prospects are split by number of codes')
+            self.prospect_facet = False
+            return dict((prospect, 1) for prospect in self.prospects)
+
+        return dict((prospect, counts.get(prospect, 0)) for prospect in self.prospects)
+
+    def get_partitions(self, counts):
+        """Split the NAF codes in partitions of close sizes with at most naf_per_request codes each."""
+        minimum = -(-len(counts) // self.naf_per_request)
+        # A partition without any establishment would receive a 404 from the API
+        number = max(minimum, min(self.workers, len([c for c in counts.values() if c])))
+        partitions = [[0, []] for _ in xrange(max(number, 1))]
+        # The largest codes are placed first, each in the smallest partition that is not full
+        for prospect in sorted(counts, key=lambda p: counts[p], reverse=True):
+            partition = min((p for p in partitions if len(p[1]) < self.naf_per_request), key=lambda p: p[0])
+            partition[0] += counts[prospect]
+            partition[1].append(prospect)
+        for size, prospects in partitions:
+            self.logger.info('  partition of %d NAF codes and %d prospect siret', len(prospects), size)
+        return [prospects for _, prospects in partitions if prospects]
+
+    def generate_plan(self):
+        """Yield the estimate of the harvest of each partition of NAF codes and of the whole harvest."""
+        counts = self.get_prospect_counts()
+        # Each page of a partition is a single request, prospects do not need their headquarters
+        plan = HarvestPlan(self.rate_budget.per_minute, workers=self.workers)
+        for number, prospects in enumerate(self.get_partitions(counts), 1):
+            entry = plan.add('partition %d' % number, sum(counts[p] for p in prospects), self.prospect_facet)
+            entry['naf'] = ','.join(prospects)
+            entry['_time'] = time.time()
+            yield entry
+        summary = plan.summary()
+        self.logger.info('  plan: %d requests in %.1f minutes', summary['requests'], summary['minutes'])
+        summary['_time'] = time.time()
+        yield summary
+
+    def get_prospects(self, curseur, prospects=None):
         # Which fields do we need
         champs = 'siren,nic,siret,complementAdresseEtablissement,numeroVoieEtablissement,indiceRepetitionEtablissement,' \
                  'typeVoieEtablissement,libelleVoieEtablissement,codePostalEtablissement,libelleCedexEtablissement,' \
                  'codeCommuneEtablissement,libelleCommuneEtablissement'
 
-        # Build the filter
-        naf = ''
-        for prospect in self.prospects:
-            naf += 'activitePrincipaleEtablissement:' + prospect + ' OR '
-        q = 'periode(etatAdministratifEtablissement:A AND (' + naf[:-4] + '))'
+        q = self.get_prospects_query(prospects or self.prospects)
 
         j = self.post_siret(q=q, curseur=curseur, nombre=1000, date=date.today().strftime('%Y-%m-%d'), gzip=True)
         try:
@@ -398,7 +524,7 @@ class PNAFCommand(GeneratingCommand):
 
         return total, curseur_suivant, etablissements
 
-    def get_updated_siret_records(self, date, curseur):
+    def get_updated_siret_records(self, date, curseur, page_journal=None):
         # Which fields do we need
         champs = 'siren,nic,siret,complementAdresseEtablissement,numeroVoieEtablissement,indiceRepetitionEtablissement,' \
                  'typeVoieEtablissement,libelleVoieEtablissement,codePostalEtablissement,libelleCedexEtablissement,' \
@@ -407,7 +533,10 @@ class PNAFCommand(GeneratingCommand):
         # Build the filter
         q = 'dateDernierTraitementEtablissement:' + date
 
-        j = self.get_siret(q=q, curseur=curseur, nombre=1000, gzip=True)
+        # Pages already received by insee for the same day are read from its journal
+        j = page_journal.read_page(curseur) if page_journal is not None else None
+        if j is None:
+            j = self.get_siret(q=q, curseur=curseur, nombre=1000, gzip=True)
         try:
             header = j['header']
             etablissements = j['etablissements']
@@ -435,6 +564,7 @@ class PNAFCommand(GeneratingCommand):
         # Retrieve 85 records at each request
         # If we have more than 85 siret, the query is too long and blocked by INSEE
         step = 85
+        start = time.time()
         sieges = dict()
         for chunk in list(self.chunks(siret_to_retrieve, step)):
             q = ''
@@ -457,18 +587,123 @@ class PNAFCommand(GeneratingCommand):
                 raise ExceptionHeadquarters('Error during headquarters retrieval')
 
         self.logger.info('  retrieved %d of %d headquarters', len(sieges), len(siret_to_retrieve))
+        self.stage_metrics.add('headquarters', time.time() - start, 1, len(siret_to_retrieve), len(sieges))
 
         return sieges
 
+    def fetch_partition(self, prospects):
+        """Yield the pages of a partition of NAF codes: total and establishments."""
+        curseur = '*'
+        first_call = True
+        while True:
+            total, curseur_suivant, siret_list = self.get_prospects(curseur, prospects)
+            if first_call:
+                self.logger.info('  retrieved a total of %d prospect siret for %d NAF codes', total, len(prospects))
+                first_call = False
+            yield total, siret_list
+
+            # We get the same curseur so we get all updated siret
+            if curseur_suivant == curseur:
+                break
+
+            curseur = curseur_suivant
+
+    def fetch_partitions(self, partitions):
+        """Yield the pages of all the partitions as they are received, with the total of their partition."""
+        if len(partitions) == 1:
+            for page in self.fetch_partition(partitions[0]):
+                yield page
+            return
+
+        # Partitions are started workers at a time, the pages are merged in a single queue
+        for page in threaded([self.fetch_partition(p) for p in partitions], self.queue_size, self.workers):
+            yield page
+
+    def fetch_store(self):
+        """Yield the active prospects of the local store by pages of 1000 establishments."""
+        sirene_store = SireneStore(self.logger)
+        page = list()
+        for etablissement in sirene_store.find(naf_list=self.prospects, etat='A'):
+            page.append(etablissement)
+            if len(page) == 1000:
+                yield None, page
+                page = list()
+        yield None, page
+        sirene_store.close()
+
+    def generate_delta(self, snapshot, days):
+        """Yield the prospects created, modified or closed on each day in order and update the snapshot."""
+        prospects = set(self.prospects)
+        event = 1
+        for day in days:
+            # The journal of insee is used when the day has been harvested completely
+            page_journal = Journal(day, self.logger)
+            if page_journal.complete:
+                self.logger.info('  read the updated siret of %s from the journal of insee', day)
+            else:
+                page_journal = None
+
+            received_siret = 0
+            curseur = '*'
+            while True:
+                _, curseur_suivant, updated_siret_list = self.get_updated_siret_records(day, curseur, page_journal)
+                received_siret += len(updated_siret_list)
+                self.logger.info('  retrieved %d siret / %d', received_siret, _)
+
+                # Time spent translating the page and yielding its records
+                translation = 0.0
+                writing = 0.0
+                written = 0
+                for siret in updated_siret_list:
+                    start = time.time()
+                    p = etablissement_fields(siret)[4]
+                    prospect = p['etatAdministratifEtablissement'] == 'A' and \
+                        p['activitePrincipaleEtablissement'] in prospects
+                    raw_data = self.generate_siret(siret) if prospect else None
+                    # A closed establishment or a NAF code that is no longer a prospect
+                    mouvement = snapshot.mouvement(siret['siret'], raw_data)
+                    if mouvement == 'ferme':
+                        raw_data = self.generate_siret(siret)
+                    translated = time.time()
+                    translation += translated - start
+                    if mouvement:
+                        yield {'_time': translated, 'event_no': event,
+                               '_raw': raw_data + 'Mouvement="%s" ' % mouvement}
+                        writing += time.time() - translated
+                        written += 1
+                        event += 1
+                self.stage_metrics.add('translation', translation, len(updated_siret_list),
+                                       len(updated_siret_list), written)
+                self.stage_metrics.add('write', writing, written, written, written)
+                # The events of the page are sent before waiting for the next one
+                self.flush_partial()
+
+                # We get the same curseur so we get all updated siret
+                if curseur_suivant == curseur:
+                    break
+
+                curseur = curseur_suivant
+
+            # Saved after each day, an interrupted search resumes from the next one
+            snapshot.save(self.prospects, day)
+
+        self.logger.info('  generated %d events', event-1)
+        for record in self.generate_metrics(event-1):
+            yield record
+
+    def generate_metrics(self, records):
+        """Report the stages in the Job Inspector, and in a last summary event with metrics=true."""
+        self.stage_metrics.log(self.logger)
+        self.stage_metrics.write(self)
+        if self.metrics:
+            yield self.stage_metrics.summary(records)
+
     def generate_siret(self, siret):
         new_siret = OrderedDict()
         v = lambda t: '' if t is None else t.encode('utf-8')
         try:
-            u = siret['uniteLegale']
-            a = siret['adresseEtablissement']
-            # This field is unused
-            a2 = siret['adresse2Etablissement']
-            p = siret['periodesEtablissement'][0]
+            # Fields left out of the pages recorded by insee with masquerValeursNulles read as None, a2 is unused
+            siret, u, a, a2, p = etablissement_fields(siret)
 
             new_siret['Code_INSEE_Commune'] = v(a['codeCommuneEtablissement'])
             new_siret['Code_NAF'] = v(p['activitePrincipaleEtablissement']).replace('.', '')
@@ -516,8 +751,10 @@ class PNAFCommand(GeneratingCommand):
         raw = ''.join(k + '=' + '\"{0}\"'.format(v) + ' ' for k, v in new_siret.items())
         return raw
 
+    @profiled
     def generate(self):
         try:
+            self.stage_metrics = StageMetrics()
             self.set_configuration()
 
             # CSV header
@@ -562,35 +799,73 @@ class PNAFCommand(GeneratingCommand):
             # Log the username to help debugging
             self.logger.info('  Splunk username: %s', self._metadata.searchinfo.username.encode('utf-8'))
 
+            if self.plan:
+                for record in self.generate_plan():
+                    yield record
+                return
+
+            snapshot = ProspectSnapshot(self.logger)
+
+            if self.mode == 'delta':
+                if not snapshot.load() or snapshot.naf != sorted(self.prospects):
+                    self.logger.error('  no prospect snapshot for the NAF codes of the configuration')
+                    raise ExceptionSnapshot('A full harvest is required before mode=delta')
+                # Yesterday when dtr is omitted
+                day = self.dtr if self.dtr else (date.today() - timedelta(1)).strftime('%Y-%m-%d')
+                self.logger.info('  dtr: %s', day.encode('utf-8'))
+                # Days skipped since the last delta are applied first, a day already applied is refused
+                days = snapshot.missing_days(day)
+                if not days:
+                    self.logger.error('  the snapshot already includes the updates until %s', snapshot.dtr)
+                    raise ExceptionSnapshot('The updates of %s are already in the snapshot' % day)
+                if len(days) > 1:
+                    self.logger.info('  apply the updates of %s to %s', days[0], days[-1])
+                for record in self.generate_delta(snapshot, days):
+                    yield record
+                return
+
+            if self.store:
+                pages = self.fetch_store()
+            # A single partition of NAF codes does not need the counts
+            elif self.workers == 1 and len(self.prospects) <= self.naf_per_request:
+                pages = self.fetch_partitions([self.prospects])
+            else:
+                pages = self.fetch_partitions(self.get_partitions(self.get_prospect_counts()))
+
             event = 1
-            curseur = '*'
-            first_call = True
             received_siret = 0
-            while True:
-                _, curseur_suivant, updated_siret_list = self.get_prospects(curseur)
-
-                if first_call:
-                    self.logger.info('  retrieved a total of %d prospect siret', _)
-                    first_call = False
+            for _, updated_siret_list in pages:
                 self.logger.info('  retrieved %d prospect siret in this window', len(updated_siret_list))
                 received_siret += len(updated_siret_list)
-                self.logger.info('  retrieved %d siret / %d', received_siret, _)
+                self.logger.info('  retrieved %d siret', received_siret)
 
+                # Time spent translating the page and yielding its records
+                translation = 0.0
+                writing = 0.0
                 for siret in updated_siret_list:
+                    start = time.time()
                     raw_data = self.generate_siret(siret)
-                    yield {'_time': time.time(), 'event_no': event, '_raw': raw_data}
+                    snapshot.compare(siret['siret'], raw_data)
+                    translated = time.time()
+                    yield {'_time': translated, 'event_no': event, '_raw': raw_data}
+                    translation += translated - start
+                    writing += time.time() - translated
                     event += 1
-
-                # We get the same curseur so we get all updated siret
-                if curseur_suivant == curseur:
-                    break
-
-                curseur = curseur_suivant
-
+                self.stage_metrics.add('translation', translation, len(updated_siret_list), len(updated_siret_list),
+                                       len(updated_siret_list))
+                self.stage_metrics.add('write', writing, len(updated_siret_list), len(updated_siret_list),
+                                       len(updated_siret_list))
+                # The events of the page are sent before waiting for the next one
+                self.flush_partial()
+
+            # The snapshot of a full harvest includes the updates until yesterday
+            snapshot.save(self.prospects, (date.today() - timedelta(1)).strftime('%Y-%m-%d'))
             self.logger.info('  generated %d events', event-1)
+            for record in self.generate_metrics(event-1):
+                yield record
 
         except (ExceptionTranslation, ExceptionHeadquarters, ExceptionUpdatedSiret, ExceptionSiret, ExceptionStatus,
-                ExceptionToken, ExceptionConfiguration):
+                ExceptionToken, ExceptionConfiguration, ExceptionSnapshot):
             raise
 
         # This is a bad practise, but we want a specific message in log file
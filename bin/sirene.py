@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import sys
+import json
+import os
+import time
+from splunklib.searchcommands import dispatch, GeneratingCommand, Configuration, Option, validators
+from sirenelib.export import OUTPUT_DIRECTORY, output_path
+from sirenelib.fields import etablissement_fields
+from sirenelib.stock import ExceptionStock, StockImporter
+from sirenelib.store import SireneStore
+
+
+class ExceptionStore(Exception):
+    pass
+
+
+@Configuration(type='events')
+class SIRENECommand(GeneratingCommand):
+    """ Synopsis
+
+    ##Syntax
+
+    | sirene [siret=siret] [siren=siren] [naf=code] [commune=code] [etat=A|F] [limit=n]
+
+    | sirene stock=StockEtablissement_utf8.zip
+
+    ##Description
+
+    Request the local Sirene store maintained by insee store=true, without any API call
+
+    With stock the zipped stock file of INSEE, named relative to the output directory of the exports, is imported in
+    the store and a single summary event is returned. An interrupted import of the same file continues after the
+    last batch loaded
+
+    """
+    siret = Option(require=False, validate=validators.Match('siret', r'^\d{14}$'))
+    siren = Option(require=False, validate=validators.Match('siren', r'^\d{9}$'))
+    naf = Option(require=False)
+    commune = Option(require=False)
+    etat = Option(require=False, validate=validators.Set('A', 'F'))
+    limit = Option(require=False, validate=validators.Integer(minimum=1), default=10000)
+    stock = Option(require=False)
+
+    def generate(self):
+        try:
+            # Log the username to help debugging
+            self.logger.info('  Splunk username: %s', self._metadata.searchinfo.username.encode('utf-8'))
+
+            if self.stock:
+                stock = output_path(self.stock)
+                if stock is None:
+                    self.logger.error('  stock file %s is not in %s', self.stock, OUTPUT_DIRECTORY)
+                    raise ExceptionStore('Stock file must be a relative path in {0}'.format(OUTPUT_DIRECTORY))
+                if not os.path.isfile(stock):
+                    self.logger.error('  stock file %s does not exist', stock)
+                    raise ExceptionStore('Stock file does not exist')
+                # The indexes are built at the end of the import
+                summary = StockImporter(SireneStore(self.logger, indexes=False), self.logger).run(stock)
+                summary['_time'] = time.time()
+                yield summary
+                return
+
+            sirene_store = SireneStore(self.logger)
+            if not sirene_store.count():
+                self.logger.error('  the local Sirene store is empty')
+                raise ExceptionStore('The local Sirene store is empty, run insee with store=true')
+
+            event = 1
+            for etablissement in sirene_store.find(limit=self.limit, siret=self.siret, siren=self.siren,
+                                                   naf=self.naf, commune=self.commune, etat=self.etat):
+                # Establishments stored by insee are received with masquerValeursNulles
+                _, u, a, _, p = etablissement_fields(etablissement)
+                yield {'_time': time.time(), 'event_no': event, '_raw': json.dumps(etablissement),
+                       'siret': etablissement['siret'],
+                       'siren': etablissement['siren'],
+                       'nic': etablissement['nic'],
+                       'etablissementSiege': etablissement['etablissementSiege'],
+                       'activitePrincipaleEtablissement': p['activitePrincipaleEtablissement'],
+                       'etatAdministratifEtablissement': p['etatAdministratifEtablissement'],
+                       'codeCommuneEtablissement': a['codeCommuneEtablissement'],
+                       'codePaysEtrangerEtablissement': a['codePaysEtrangerEtablissement'],
+                       'denominationUniteLegale': u['denominationUniteLegale'],
+                       'dateDernierTraitementEtablissement': etablissement['dateDernierTraitementEtablissement']}
+                event += 1
+
+            self.logger.info('  generated %d events', event-1)
+
+        except (ExceptionStore, ExceptionStock):
+            raise
+
+        # This is a bad practise, but we want a specific message in log file
+        # This case means that the code is missing an Exception handling
+        except Exception as e:
+            self.logger.error('  unhandled exception has occurred. Traceback is in splunklib.log: %s', e.message)
+            raise
+
+
+dispatch(SIRENECommand, sys.argv, sys.stdin, sys.stdout, __name__)
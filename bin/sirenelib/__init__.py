@@ -0,0 +1,4 @@
+# coding: utf-8
+"""
+    Helpers shared by the insee, pnaf and xl2 search commands.
+"""
@@ -0,0 +1,101 @@
+# coding: utf-8
+"""
+    Checkpoints of the cursor harvest of the Sirene API.
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime
+from splunklib.searchcommands import environment
+from sirenelib.export import write_atomic
+
+
+CHECKPOINT_DIRECTORY = os.path.join(environment.splunk_home, 'var', 'run', 'splunk', 'insee', 'checkpoints')
+# Headquarters reloaded from the .sieges file on resume
+SIEGES_SIZE = 10000
+
+
+class Checkpoint(object):
+    """
+        Progress of a harvest, saved after each page of the API cursor.
+
+        <name>.json holds the next cursor, the page and event counters. The headquarters resolved so far are appended
+        to <name>.sieges, one JSON list per line, and the size of that file is recorded in the checkpoint so that lines
+        written after the last save are dropped on load.
+
+        The headquarters are not kept in memory while they are added. A headquarters used by several pages may be
+        written more than once, only the last sieges_size of the file are reloaded, the most recent last.
+    """
+    def __init__(self, name, logger, directory=CHECKPOINT_DIRECTORY, sieges_size=SIEGES_SIZE):
+        self.name = name
+        self.logger = logger
+        self.filename = os.path.join(directory, name + '.json')
+        self.sieges_filename = os.path.join(directory, name + '.sieges')
+        self.sieges_size = sieges_size
+        self.sieges = OrderedDict()
+        self.fd = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def compact_siege(siege):
+        # Only the fields used to compute RPEN and DEPCOMEN are kept
+        a = siege.get('adresseEtablissement') or dict()
+        return {'adresseEtablissement': {'codeCommuneEtablissement': a.get('codeCommuneEtablissement'),
+                                         'codePaysEtrangerEtablissement': a.get('codePaysEtrangerEtablissement')}}
+
+    def load(self):
+        """Return the saved state and reload the last resolved headquarters, or None when there is no checkpoint."""
+        try:
+            with open(self.filename, 'r') as fd:
+                state = json.load(fd)
+        except (IOError, ValueError):
+            return None
+
+        self.sieges = OrderedDict()
+        self.fd = open(self.sieges_filename, 'ab+')
+        self.fd.truncate(state['sieges_size'])
+        self.fd.seek(0)
+        for line in self.fd:
+            siret, code_commune, code_pays = json.loads(line)
+            self.sieges.pop(siret, None)
+            self.sieges[siret] = {'adresseEtablissement': {'codeCommuneEtablissement': code_commune,
+                                                           'codePaysEtrangerEtablissement': code_pays}}
+            if len(self.sieges) > self.sieges_size:
+                self.sieges.popitem(last=False)
+        self.fd.seek(0, os.SEEK_END)
+
+        self.logger.info('  checkpoint %s loaded: page %d, %d events, %d headquarters', self.filename,
+                         state['pages'], state['events'], len(self.sieges))
+        return state
+
+    def start(self):
+        """Start a new harvest, discarding any previous checkpoint."""
+        self.remove()
+        self.sieges = OrderedDict()
+        self.fd = open(self.sieges_filename, 'wb')
+
+    def add_sieges(self, sieges):
+        for siret, siege in sieges.items():
+            siege = self.compact_siege(siege)
+            a = siege['adresseEtablissement']
+            self.fd.write(json.dumps([siret, a['codeCommuneEtablissement'],
+                                      a['codePaysEtrangerEtablissement']]).encode('utf-8') + b'\n')
+
+    def save(self, **state):
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+        state['sieges_size'] = self.fd.tell()
+        state['updated'] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        write_atomic(self.filename, json.dumps(state).encode('utf-8'))
+
+    def remove(self):
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+        for filename in (self.filename, self.sieges_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
@@ -0,0 +1,159 @@
+# coding: utf-8
+"""
+    Comparison of two XL2 files.
+"""
+
+from __future__ import absolute_import
+
+import csv
+import io
+import os
+import shutil
+import tempfile
+import zlib
+from zipfile import ZipFile
+from splunklib import six
+from sirenelib.export import MODIFICATIONS
+
+
+# Columns computed at the time of the export, they change without any update of the establishment
+IGNORED = set(['AMINTRET', 'AMINTREN'] + [flag for flag, _ in MODIFICATIONS])
+
+
+class ExceptionDiff(Exception):
+    pass
+
+
+def open_csv(filename, mode):
+    # The csv module of Python 2 works on bytes, the one of Python 3 on text
+    if six.PY2:
+        return open(filename, mode + 'b')
+    return io.open(filename, mode, encoding='utf-8', newline='')
+
+
+def read_xl2(filename):
+    """Yield the header then the rows of an XL2 file, sirene_AAAAMMJJ.zip or CSV."""
+    if filename.lower().endswith('.zip'):
+        with ZipFile(filename) as zip_file:
+            members = [name for name in zip_file.namelist() if name.lower().endswith('.csv')]
+            if len(members) != 1:
+                raise ExceptionDiff('{0} must contain a single CSV file'.format(filename))
+            with zip_file.open(members[0]) as fd:
+                if not six.PY2:
+                    fd = io.TextIOWrapper(fd, encoding='utf-8', newline='')
+                for row in csv.reader(fd, delimiter=';', quotechar='"'):
+                    yield row
+    else:
+        with open_csv(filename, 'r') as fd:
+            for row in csv.reader(fd, delimiter=';', quotechar='"'):
+                yield row
+
+
+def uncompressed_size(filename):
+    if filename.lower().endswith('.zip'):
+        with ZipFile(filename) as zip_file:
+            return sum(info.file_size for info in zip_file.infolist())
+    return os.path.getsize(filename)
+
+
+def modification_flags(changed):
+    """Return the XL2 modification indicators of a set of changed columns: '1' when modified, '' otherwise."""
+    return dict((flag, '1' if changed.intersection(columns) else '') for flag, columns in MODIFICATIONS)
+
+
+class XL2Diff(object):
+    """
+        Streams two XL2 files in hash partitions on disk and compares them partition by partition.
+
+        The rows of each file are spread by a CRC32 of their SIRET over partitions files, so that only one partition
+        of the old file is held in memory at a time. The number of partitions is chosen from the size of the files so
+        that a partition stays around partition_size bytes.
+    """
+    partition_size = 32 * 1024 * 1024
+
+    def __init__(self, logger, partitions=None, directory=None):
+        self.logger = logger
+        self.partitions = partitions
+        self.directory = directory
+        self.counters = {'ajout': 0, 'suppression': 0, 'modification': 0, 'identique': 0}
+
+    def partition(self, filename, prefix, work):
+        rows = read_xl2(filename)
+        try:
+            header = next(rows)
+        except StopIteration:
+            raise ExceptionDiff('{0} is empty'.format(filename))
+        if 'SIREN' not in header or 'NIC' not in header:
+            raise ExceptionDiff('{0} is not an XL2 file'.format(filename))
+        siren = header.index('SIREN')
+        nic = header.index('NIC')
+
+        files = [open_csv(os.path.join(work, '%s-%04d.csv' % (prefix, i)), 'w') for i in range(self.partitions)]
+        try:
+            writers = [csv.writer(fd) for fd in files]
+            count = 0
+            for row in rows:
+                siret = row[siren] + row[nic]
+                key = siret if isinstance(siret, bytes) else siret.encode('utf-8')
+                writers[(zlib.crc32(key) & 0xffffffff) % self.partitions].writerow(row)
+                count += 1
+        finally:
+            for fd in files:
+                fd.close()
+        self.logger.info('  %d rows of %s written in %d partitions', count, filename, self.partitions)
+        return header
+
+    def read_partition(self, filename, header, source):
+        """Yield the SIRET and row of a partition of source, a SIRET found twice can not be compared."""
+        siren = header.index('SIREN')
+        nic = header.index('NIC')
+        sirets = set()
+        with open_csv(filename, 'r') as fd:
+            for row in csv.reader(fd):
+                siret = row[siren] + row[nic]
+                if siret in sirets:
+                    self.logger.error('  SIRET %s appears more than once in %s', siret, source)
+                    raise ExceptionDiff('SIRET {0} appears more than once in {1}'.format(siret, source))
+                sirets.add(siret)
+                yield siret, dict(zip(header, row))
+
+    def run(self, old_filename, new_filename):
+        """
+            Yield the differences between two XL2 files: (mouvement, siret, old row, new row, changed columns).
+
+            mouvement is 'ajout', 'suppression' or 'modification'. Rows are dictionaries of the columns of their file.
+            ExceptionDiff is raised when a SIRET appears more than once in a file.
+        """
+        if not self.partitions:
+            size = uncompressed_size(old_filename) + uncompressed_size(new_filename)
+            self.partitions = max(1, size // self.partition_size)
+
+        work = tempfile.mkdtemp(prefix='xl2diff-', dir=self.directory)
+        try:
+            old_header = self.partition(old_filename, 'old', work)
+            new_header = self.partition(new_filename, 'new', work)
+            columns = [c for c in new_header if c in old_header and c not in IGNORED]
+
+            for i in range(self.partitions):
+                old_rows = dict(self.read_partition(os.path.join(work, 'old-%04d.csv' % i), old_header, old_filename))
+                for siret, new_row in self.read_partition(os.path.join(work, 'new-%04d.csv' % i), new_header,
+                                                          new_filename):
+                    old_row = old_rows.pop(siret, None)
+                    if old_row is None:
+                        self.counters['ajout'] += 1
+                        yield 'ajout', siret, None, new_row, set()
+                        continue
+                    changed = set(c for c in columns if old_row[c] != new_row[c])
+                    if changed:
+                        self.counters['modification'] += 1
+                        yield 'modification', siret, old_row, new_row, changed
+                    else:
+                        self.counters['identique'] += 1
+                for siret in sorted(old_rows):
+                    self.counters['suppression'] += 1
+                    yield 'suppression', siret, old_rows[siret], None, set()
+        finally:
+            shutil.rmtree(work)
+
+        self.logger.info('  %(ajout)d added, %(suppression)d removed, %(modification)d changed and %(identique)d '
+                         'identical rows', self.counters)
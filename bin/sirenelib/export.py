@@ -0,0 +1,300 @@
+# coding: utf-8
+"""
+    Writing of the daily XL2 file.
+"""
+
+from __future__ import absolute_import
+
+import csv
+import json
+import os
+import stat
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+from zipfile import ZipFile, ZIP_DEFLATED
+from splunklib import six
+from splunklib.six.moves import cStringIO
+
+
+OUTPUT_DIRECTORY = '/data_out/insee'
+
+HEADER = ['SIREN', 'NIC', 'L1_NORMALISEE', 'L2_NORMALISEE', 'L3_NORMALISEE', 'L4_NORMALISEE', 'L5_NORMALISEE',
+          'L6_NORMALISEE', 'L7_NORMALISEE', 'L1_DECLAREE', 'L2_DECLAREE', 'L3_DECLAREE', 'L4_DECLAREE',
+          'L5_DECLAREE', 'L6_DECLAREE', 'L7_DECLAREE', 'NUMVOIE', 'INDREP', 'TYPVOIE', 'LIBVOIE', 'CODPOS', 'CEDEX',
+          'RPET', 'LIBREG', 'DEPET', 'ARRONET', 'CTONET', 'COMET', 'LIBCOM', 'DU', 'TU', 'UU', 'EPCI', 'TCD', 'ZEMET',
+          'SIEGE', 'ENSEIGNE', 'IND_PUBLIPO', 'DIFFCOM', 'AMINTRET', 'NATETAB', 'LIBNATETAB', 'APET700', 'LIBAPET',
+          'DAPET', 'TEFET', 'LIBTEFET', 'EFETCENT', 'DEFET', 'ORIGINE', 'DCRET', 'DDEBACT', 'ACTIVNAT', 'LIEUACT',
+          'ACTISURF', 'SAISONAT', 'MODET', 'PRODET', 'PRODPART', 'AUXILT', 'NOMEN_LONG', 'SIGLE', 'NOM', 'PRENOM',
+          'CIVILITE', 'RNA', 'NICSIEGE', 'RPEN', 'DEPCOMEN', 'ADR_MAIL', 'NJ', 'LIBNJ', 'APEN700', 'LIBAPEN', 'DAPEN',
+          'APRM', 'ESS', 'DATEESS', 'TEFEN', 'LIBTEFEN', 'EFENCENT', 'DEFEN', 'CATEGORIE', 'DCREN', 'AMINTREN',
+          'MONOACT', 'MODEN', 'PRODEN', 'ESAANN', 'TCA', 'ESAAPEN', 'ESASEC1N', 'ESASEC2N', 'ESASEC3N', 'ESASEC4N',
+          'VMAJ', 'VMAJ1', 'VMAJ2', 'VMAJ3', 'DATEMAJ', 'EVE', 'DATEVE', 'TYPCREH', 'DREACTET', 'DREACTEN',
+          'MADRESSE', 'MENSEIGNE', 'MAPET', 'MPRODET', 'MAUXILT', 'MNOMEN', 'MSIGLE', 'MNICSIEGE', 'MNJ', 'MAPEN',
+          'MPRODEN', 'SIRETPS', 'TEL']
+
+
+# Modification indicators of the XL2 format and the columns each of them covers
+MODIFICATIONS = [('MADRESSE', ['L1_NORMALISEE', 'L2_NORMALISEE', 'L3_NORMALISEE', 'L4_NORMALISEE', 'L5_NORMALISEE',
+                               'L6_NORMALISEE', 'L7_NORMALISEE', 'NUMVOIE', 'INDREP', 'TYPVOIE', 'LIBVOIE', 'CODPOS',
+                               'CEDEX', 'DEPET', 'COMET', 'LIBCOM']),
+                 ('MENSEIGNE', ['ENSEIGNE']),
+                 ('MAPET', ['APET700']),
+                 ('MPRODET', ['PRODET']),
+                 ('MAUXILT', ['AUXILT']),
+                 ('MNOMEN', ['NOMEN_LONG']),
+                 ('MSIGLE', ['SIGLE']),
+                 ('MNICSIEGE', ['NICSIEGE']),
+                 ('MNJ', ['NJ']),
+                 ('MAPEN', ['APEN700']),
+                 ('MPRODEN', ['PRODEN'])]
+
+
+class ExceptionExport(Exception):
+    pass
+
+
+def output_path(name, directory=OUTPUT_DIRECTORY):
+    """Return the path of a file named relative to the output directory, None when it would be outside of it."""
+    if not name or os.path.isabs(name):
+        return None
+    # Symbolic links are resolved too, they must not lead out of the directory either
+    path = os.path.realpath(os.path.join(directory, name))
+    if not path.startswith(os.path.join(os.path.realpath(directory), '')):
+        return None
+    return path
+
+
+def format_header():
+    return ';'.join('"%s"' % x for x in HEADER)
+
+
+def format_row(record):
+    """Return the XL2 line of a record: values between '"' and separated by ';'."""
+    line = ';'.join('"%s"' % record[x] for x in HEADER) + '\n'
+    if isinstance(line, six.text_type):
+        line = line.encode('utf-8')
+    return line
+
+
+def render_chunk(body, days):
+    """
+        Return the XL2 rows of a chunk of Splunk events as (dtr, rows, count, last SIRET) per day, and the number of
+        events outside of the days.
+
+        A single day receives all the events, a range dispatches them by their DATEMAJ. Runs in the worker processes of
+        xl2 workers=n, the rows are written by the command in the order of the chunks.
+    """
+    if not six.PY2:
+        body = body.decode('utf-8')
+    reader = csv.reader(cStringIO(body))
+    fieldnames = next(reader)
+    positions = [fieldnames.index(x) for x in HEADER]
+    siren = fieldnames.index('SIREN')
+    nic = fieldnames.index('NIC')
+    datemaj = fieldnames.index('DATEMAJ')
+
+    blocks = OrderedDict()
+    skipped = 0
+    for values in reader:
+        dtr = days[0] if len(days) == 1 else values[datemaj][:10]
+        if dtr not in days:
+            skipped += 1
+            continue
+        line = ';'.join(['"%s"' % values[p] for p in positions]) + '\n'
+        if isinstance(line, six.text_type):
+            line = line.encode('utf-8')
+        block = blocks.get(dtr)
+        if block is None:
+            block = blocks[dtr] = [list(), 0, None]
+        block[0].append(line)
+        block[1] += 1
+        block[2] = values[siren] + values[nic]
+
+    return [(dtr, b''.join(lines), count, last_siret) for dtr, (lines, count, last_siret) in blocks.items()], skipped
+
+
+def checksum(data, value=0):
+    return zlib.crc32(data, value) & 0xffffffff
+
+
+def write_atomic(filename, data):
+    # The data is written next to its destination and renamed so that readers never see a partial file
+    with open(filename + '.tmp', 'wb') as fd:
+        fd.write(data)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.rename(filename + '.tmp', filename)
+
+
+class XL2Export(object):
+    """
+        Writes the XL2 file of a day.
+
+        Rows are appended to sirc-<dtr>_.csv and committed with a manifest (sirc-<dtr>_.json) holding the row count,
+        the last SIRET, the API cursor and a CRC32 of the committed rows. A rerun of the same day can resume from the
+        manifest: rows written after the last commit are dropped. close() writes the final file with its header,
+        packs it in sirene_<AAAAMMJJ>.zip through a temporary file renamed at the end, and deletes the work files.
+    """
+    def __init__(self, dtr, logger, directory=None):
+        self.dtr = dtr
+        self.logger = logger
+        # The output directory is read when the export is created, so that the benchmark can move it
+        directory = directory or OUTPUT_DIRECTORY
+        self.directory = directory
+        self.part_filename = os.path.join(directory, 'sirc-%s_.csv' % dtr)
+        self.manifest_filename = os.path.join(directory, 'sirc-%s_.json' % dtr)
+        self.zip_filename = os.path.join(directory, 'sirene_' + ''.join(dtr.split('-')) + '.zip')
+        self.fd = None
+        self.records = 0
+        self.size = 0
+        self.checksum = 0
+        self.last_siret = None
+        self.curseur = None
+        self.complete = False
+        self.sid = None
+
+    def read_manifest(self):
+        """Return the manifest of an interrupted export of this day or None."""
+        try:
+            with open(self.manifest_filename, 'r') as fd:
+                manifest = json.load(fd)
+        except (IOError, ValueError):
+            return None
+
+        if manifest.get('dtr') != self.dtr or not os.path.exists(self.part_filename):
+            return None
+
+        if os.path.getsize(self.part_filename) < manifest['size']:
+            self.logger.error('  export file %s is shorter than its manifest', self.part_filename)
+            return None
+
+        # Only the committed rows are verified, the ones written after the last commit are dropped by resume()
+        value = 0
+        remaining = manifest['size']
+        with open(self.part_filename, 'rb') as fd:
+            while remaining > 0:
+                data = fd.read(min(remaining, 1048576))
+                if not data:
+                    break
+                value = checksum(data, value)
+                remaining -= len(data)
+
+        if value != manifest['checksum']:
+            self.logger.error('  export file %s does not match its manifest checksum', self.part_filename)
+            return None
+
+        return manifest
+
+    def start(self, sid=None):
+        """Start a new export of the day, discarding any previous work file."""
+        for filename in (self.part_filename, self.manifest_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+                self.logger.info('  delete filename: %s', filename)
+        self.sid = sid
+        self.fd = open(self.part_filename, 'wb')
+        self.logger.info('  export to filename: %s', self.part_filename)
+
+    def resume(self, manifest, sid=None):
+        """Continue an export from a manifest returned by read_manifest()."""
+        self.records = manifest['records']
+        self.size = manifest['size']
+        self.checksum = manifest['checksum']
+        self.last_siret = manifest['last_siret']
+        self.curseur = manifest['curseur']
+        self.complete = manifest['complete']
+        self.sid = sid if sid else manifest['sid']
+        self.fd = open(self.part_filename, 'r+b')
+        self.fd.truncate(self.size)
+        self.fd.seek(self.size)
+        self.logger.info('  resume export of filename %s after %d records, last siret %s',
+                         self.part_filename, self.records, self.last_siret)
+
+    def write(self, record):
+        line = format_row(record)
+        self.fd.write(line)
+        self.size += len(line)
+        self.checksum = checksum(line, self.checksum)
+        self.records += 1
+        self.last_siret = record['SIREN'] + record['NIC']
+
+    def write_rows(self, rows, count, last_siret):
+        """Append count rows already formatted by render_chunk()."""
+        self.fd.write(rows)
+        self.size += len(rows)
+        self.checksum = checksum(rows, self.checksum)
+        self.records += count
+        self.last_siret = last_siret
+
+    def commit(self, curseur=None, complete=False):
+        """Make the rows written so far durable and record them in the manifest."""
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+        self.curseur = curseur
+        self.complete = complete
+        manifest = {'dtr': self.dtr,
+                    'sid': self.sid,
+                    'records': self.records,
+                    'size': self.size,
+                    'checksum': self.checksum,
+                    'last_siret': self.last_siret,
+                    'curseur': self.curseur,
+                    'complete': self.complete,
+                    'updated': datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}
+        write_atomic(self.manifest_filename, json.dumps(manifest).encode('utf-8'))
+
+    def suspend(self):
+        """Commit the rows and close the work file, the export is continued later with resume()."""
+        self.commit(self.curseur, self.complete)
+        self.fd.close()
+
+    def close(self):
+        self.commit(self.curseur, True)
+        self.fd.close()
+
+        if self.records == 0:
+            os.remove(self.part_filename)
+            os.remove(self.manifest_filename)
+            self.logger.info('  no record exported')
+            return 'Not ZIP file generated. Error during creation.'
+
+        filename = self.dtr + '_' + datetime.now().strftime('%Y%m%d%H%M%S')
+        csv_filename = os.path.join(self.directory, 'sirc-%s.csv.tmp' % filename)
+
+        # Write the final file with its header, the rows are verified against the manifest while they are copied
+        value = 0
+        with open(self.part_filename, 'rb') as fin:
+            with open(csv_filename, 'wb') as fout:
+                self.logger.info('  copy to filename: %s', csv_filename)
+                fout.write(format_header().encode('utf-8'))
+                fout.write(b'\n')
+                while True:
+                    data = fin.read(1048576)
+                    if not data:
+                        break
+                    value = checksum(data, value)
+                    fout.write(data)
+
+        if value != self.checksum:
+            os.remove(csv_filename)
+            self.logger.error('  export file %s does not match its manifest checksum', self.part_filename)
+            raise ExceptionExport('Export file does not match its manifest')
+
+        # ZIP the file
+        with ZipFile(self.zip_filename + '.tmp', mode='w', compression=ZIP_DEFLATED, allowZip64=True) as zip_file:
+            self.logger.info('  zip filename creation: %s', self.zip_filename)
+            zip_file.write(csv_filename, arcname='sirc-%s.csv' % filename)
+        os.rename(self.zip_filename + '.tmp', self.zip_filename)
+
+        # Give RW to the UNIX group
+        os.chmod(self.zip_filename, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP)
+
+        # Delete the work files
+        for filename in (csv_filename, self.part_filename, self.manifest_filename):
+            os.remove(filename)
+            self.logger.info('  delete filename: %s', filename)
+
+        self.logger.info('  wrote %d records in file', self.records)
+
+        return self.zip_filename
@@ -0,0 +1,25 @@
+# coding: utf-8
+"""
+    Objects received from the Sirene API.
+"""
+
+from __future__ import absolute_import
+
+
+class Fields(dict):
+    """
+        Object of the API whose missing fields read as None.
+
+        With masquerValeursNulles=true the API leaves out the fields without value, and the fields that are not in
+        the champs of the request are not returned either.
+    """
+    def __missing__(self, key):
+        return None
+
+
+def etablissement_fields(siret):
+    """Return an establishment, its legal unit, its two addresses and its current period as Fields."""
+    periodes = siret.get('periodesEtablissement') or [dict()]
+    return (Fields(siret), Fields(siret.get('uniteLegale') or dict()),
+            Fields(siret.get('adresseEtablissement') or dict()), Fields(siret.get('adresse2Etablissement') or dict()),
+            Fields(periodes[0]))
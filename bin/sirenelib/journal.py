@@ -0,0 +1,183 @@
+# coding: utf-8
+"""
+    Journal of the pages received from the Sirene API.
+"""
+
+from __future__ import absolute_import
+
+import gzip
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+from io import BytesIO
+from splunklib.searchcommands import environment
+from sirenelib.export import write_atomic
+
+
+JOURNAL_DIRECTORY = os.path.join(environment.splunk_home, 'var', 'run', 'splunk', 'insee', 'journal')
+
+
+def compress(data):
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as fd:
+        fd.write(data)
+    return buf.getvalue()
+
+
+def decompress(data):
+    with gzip.GzipFile(fileobj=BytesIO(data), mode='rb') as fd:
+        return fd.read()
+
+
+class Journal(object):
+    """
+        Raw pages of a day, stored in <directory>/<dtr>/.
+
+        Each page is gzipped in its own file and described by a line of index.jsonl: kind ('siret' for the pages of
+        updated establishments, 'siege' for the headquarters), key (the cursor of a 'siret' page) and sirets (the
+        headquarters requested by a 'siege' page). compact() merges the pages in a single segment-<timestamp>.gz, a
+        multi-member gzip file whose members are located by their offset and length in the index.
+    """
+    def __init__(self, dtr, logger, directory=JOURNAL_DIRECTORY):
+        self.dtr = dtr
+        self.logger = logger
+        self.directory = os.path.join(directory, dtr)
+        self.index_filename = os.path.join(self.directory, 'index.jsonl')
+        self.pages = dict()
+        self.sieges = dict()
+        self.entries = list()
+        self.cache = (None, None)
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'r') as fd:
+                for line in fd:
+                    # A line cut by a crash is ignored, its page is fetched again
+                    try:
+                        self.add_entry(json.loads(line))
+                    except ValueError:
+                        pass
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def complete(self):
+        """True when the day has been harvested completely: compact() only runs at the end of a day."""
+        return bool(self.entries) and all('segment' in entry for entry in self.entries)
+
+    def add_entry(self, entry):
+        self.entries.append(entry)
+        if entry['kind'] == 'siret':
+            self.pages[entry['key']] = entry
+        else:
+            for siret in entry['sirets']:
+                self.sieges[siret] = entry
+
+    def reset(self):
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        self.pages = dict()
+        self.sieges = dict()
+        self.entries = list()
+        self.cache = (None, None)
+
+    def record(self, body, kind, key=None, sirets=None):
+        """Store the body of a page received from the API."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        entry = {'kind': kind, 'key': key, 'sirets': sirets or [],
+                 'file': '%06d.json.gz' % len(self.entries), 'received': datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}
+        with open(os.path.join(self.directory, entry['file']), 'wb') as fd:
+            fd.write(compress(body))
+        with open(self.index_filename, 'ab') as fd:
+            fd.write(json.dumps(entry).encode('utf-8') + b'\n')
+        self.add_entry(entry)
+
+    def read_member(self, entry):
+        # Gzipped bytes of a page, from its own file or from the segment of the day
+        if 'segment' in entry:
+            with open(os.path.join(self.directory, entry['segment']), 'rb') as fd:
+                fd.seek(entry['offset'])
+                return fd.read(entry['length'])
+        with open(os.path.join(self.directory, entry['file']), 'rb') as fd:
+            return fd.read()
+
+    def read(self, entry):
+        # The last page read is kept because headquarters of a page are usually requested together
+        if self.cache[0] is entry:
+            return self.cache[1]
+        page = json.loads(decompress(self.read_member(entry)).decode('utf-8'))
+        self.cache = (entry, page)
+        return page
+
+    def read_page(self, curseur):
+        """Return the page of updated establishments received for a cursor, or None."""
+        entry = self.pages.get(curseur)
+        return self.read(entry) if entry else None
+
+    def read_sieges(self, sirets):
+        """Return the headquarters found in the journal for a list of siret."""
+        sieges = dict()
+        for siret in sirets:
+            entry = self.sieges.get(siret)
+            if entry is None:
+                continue
+            for s in self.read(entry)['etablissements']:
+                if s['siret'] == siret:
+                    sieges[siret] = s
+        return sieges
+
+    def compact(self):
+        """Merge the pages of the day in a single compressed segment."""
+        pages = [entry for entry in self.entries if 'segment' not in entry]
+        if not pages:
+            return
+
+        # Pages replaced by a later one for the same cursor or the same headquarters are dropped
+        live = set(id(entry) for entry in self.pages.values())
+        live.update(id(entry) for entry in self.sieges.values())
+
+        # The segment gets a new name and the new index is the commit point: until it is renamed the previous
+        # index still describes valid files
+        segments = set(entry['segment'] for entry in self.entries if 'segment' in entry)
+        segment = 'segment-%s.gz' % datetime.now().strftime('%Y%m%d%H%M%S%f')
+        entries = list()
+        with open(os.path.join(self.directory, segment), 'wb') as fout:
+            for entry in self.entries:
+                if id(entry) not in live:
+                    continue
+                data = self.read_member(entry)
+                entry = dict(entry, segment=segment, offset=fout.tell(), length=len(data))
+                fout.write(data)
+                entries.append(entry)
+            fout.flush()
+            os.fsync(fout.fileno())
+        write_atomic(self.index_filename, b''.join(json.dumps(entry).encode('utf-8') + b'\n' for entry in entries))
+
+        for entry in pages:
+            os.remove(os.path.join(self.directory, entry['file']))
+        for name in segments:
+            os.remove(os.path.join(self.directory, name))
+
+        self.entries = list()
+        self.pages = dict()
+        self.sieges = dict()
+        self.cache = (None, None)
+        for entry in entries:
+            self.add_entry(entry)
+
+        self.logger.info('  journal %s compacted: %d pages in %d bytes', self.directory, len(entries),
+                         os.path.getsize(os.path.join(self.directory, segment)))
+
+    @staticmethod
+    def purge(logger, retention, directory=JOURNAL_DIRECTORY):
+        """Delete the journals that have not been written for more than retention days."""
+        if not os.path.isdir(directory):
+            return
+        limit = time.time() - retention * 86400
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path) and os.path.getmtime(path) < limit:
+                shutil.rmtree(path)
+                logger.info('  journal of %s deleted by the retention of %d days', name, retention)
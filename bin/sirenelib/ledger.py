@@ -0,0 +1,85 @@
+# coding: utf-8
+"""
+    Ledger of the days harvested by insee.
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+from datetime import date, datetime, timedelta
+from splunklib.searchcommands import environment
+from sirenelib.export import write_atomic
+
+
+LEDGER_FILENAME = os.path.join(environment.splunk_home, 'var', 'run', 'splunk', 'insee', 'ledger.json')
+
+
+class Ledger(object):
+    """
+        Days harvested from the API and exported completely, and number of requests sent to the API each calendar day.
+
+        The ledger is a single JSON file rewritten atomically after each harvest. It is read by catchup=true to
+        find the days that are missing and to keep the catch-up within the daily quota.
+    """
+    # Requests of a day and of a page when the ledger has no history yet
+    default_cost = 50
+    default_requests_per_page = 2.0
+
+    def __init__(self, logger, filename=LEDGER_FILENAME):
+        self.logger = logger
+        self.filename = filename
+        self.days = dict()
+        self.requests = dict()
+        try:
+            with open(self.filename, 'r') as fd:
+                ledger = json.load(fd)
+            self.days = ledger['days']
+            self.requests = ledger['requests']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def __contains__(self, dtr):
+        return dtr in self.days
+
+    def add(self, dtr, records, pages, requests, filename=None):
+        """Record a day exported completely and the requests it has used."""
+        self.days[dtr] = {'records': records, 'pages': pages, 'requests': requests, 'file': filename,
+                          'completed': datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}
+        self.count(requests)
+
+    def count(self, requests):
+        """Record the requests used by a harvest that does not complete an export, they count in the quota."""
+        today = date.today().strftime('%Y-%m-%d')
+        self.requests[today] = self.requests.get(today, 0) + requests
+        # Only the recent request counters are useful
+        limit = (date.today() - timedelta(7)).strftime('%Y-%m-%d')
+        self.requests = dict((k, v) for k, v in self.requests.items() if k >= limit)
+        if not os.path.isdir(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        write_atomic(self.filename, json.dumps({'days': self.days, 'requests': self.requests},
+                                               sort_keys=True).encode('utf-8'))
+
+    def used_today(self):
+        return self.requests.get(date.today().strftime('%Y-%m-%d'), 0)
+
+    def cost(self):
+        """Average number of requests of a day harvested from the API."""
+        costs = [d['requests'] for d in self.days.values() if d['requests']]
+        if not costs:
+            return self.default_cost
+        return int(round(float(sum(costs)) / len(costs)))
+
+    def requests_per_page(self):
+        """Average number of requests of a page of updated siret, headquarters included."""
+        days = [d for d in self.days.values() if d['requests'] and d['pages']]
+        if not days:
+            return self.default_requests_per_page
+        return float(sum(d['requests'] for d in days)) / sum(d['pages'] for d in days)
+
+    def missing(self, first, last):
+        """Return the days between first and last, both included, that are not in the ledger, oldest first."""
+        start = datetime.strptime(first, '%Y-%m-%d').date()
+        end = datetime.strptime(last, '%Y-%m-%d').date()
+        days = [(start + timedelta(i)).strftime('%Y-%m-%d') for i in range((end - start).days + 1)]
+        return [day for day in days if day not in self.days]
@@ -0,0 +1,76 @@
+# coding: utf-8
+"""
+    Timings and counters of the stages of a command, reported in the Job Inspector.
+"""
+
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from splunklib.searchcommands import SearchMetric
+
+
+class StageMetrics(object):
+    """
+        Elapsed seconds, invocations, input and output counts of each stage of a command.
+
+        The values of a stage add up as a SearchMetric, the 4-tuple that write_metric() hands to the Job Inspector.
+        Stages are timed by the fetch threads as well as by the main thread, so the values are updated under a lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()
+        self.start = time.time()
+
+    def add(self, stage, elapsed=0.0, invocations=1, input_count=0, output_count=0):
+        with self.lock:
+            values = self.stages.get(stage)
+            if values is None:
+                values = self.stages[stage] = [0.0, 0, 0, 0]
+            values[0] += elapsed
+            values[1] += invocations
+            values[2] += input_count
+            values[3] += output_count
+
+    @contextmanager
+    def timer(self, stage, input_count=0, output_count=0):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start, 1, input_count, output_count)
+
+    def sleep(self, stage, seconds):
+        """Wait for seconds, accounted to a stage, and return them."""
+        time.sleep(seconds)
+        self.add(stage, seconds)
+        return seconds
+
+    def write(self, command):
+        """Add the metrics of each stage to the inspector of the next chunk of the command."""
+        # Only the chunked protocol has an inspector
+        if command.protocol_version != 2:
+            return
+        with self.lock:
+            for stage, values in self.stages.items():
+                command.write_metric(stage, SearchMetric(round(values[0], 3), *values[1:]))
+
+    def log(self, logger):
+        with self.lock:
+            for stage, values in self.stages.items():
+                logger.info('  stage %s: %.3f s, %d invocations, %d in, %d out', stage, *values)
+
+    def summary(self, records):
+        """Return the summary event of the command: the values of each stage and the throughput of the records."""
+        elapsed = time.time() - self.start
+        summary = OrderedDict([('_time', time.time()), ('elapsed', round(elapsed, 3)), ('records', records),
+                               ('records_per_second', round(records / elapsed, 1) if elapsed else 0)])
+        with self.lock:
+            for stage, values in self.stages.items():
+                summary[stage + '_seconds'] = round(values[0], 3)
+                summary[stage + '_invocations'] = values[1]
+                summary[stage + '_input'] = values[2]
+                summary[stage + '_output'] = values[3]
+        return summary
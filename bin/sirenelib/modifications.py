@@ -0,0 +1,179 @@
+# coding: utf-8
+"""
+    Snapshot of the exported establishments used to set the XL2 modification indicators.
+"""
+
+from __future__ import absolute_import
+
+import mmap
+import os
+import struct
+from datetime import date, datetime
+from splunklib import six
+from splunklib.searchcommands import environment
+from sirenelib.export import MODIFICATIONS, checksum
+
+
+MODIFICATIONS_FILENAME = os.path.join(environment.splunk_home, 'var', 'run', 'splunk', 'insee', 'modifications.bin')
+
+# Header: magic, version, number of slots, number of establishments
+HEADER = struct.Struct('<4sIQQ')
+# Slot: SIRET as an integer (0 for a free slot), day of the last version, its indicators and a CRC32 per group of
+# columns of MODIFICATIONS
+SLOT = struct.Struct('<QHH%dI' % len(MODIFICATIONS))
+# Key of a slot and the bytes that follow it, and number of slots read at once by grow()
+KEY = 'Q%dx' % (SLOT.size - 8)
+GROW_BATCH = 4096
+MAGIC = b'XL2M'
+VERSION = 1
+EPOCH = date(2000, 1, 1)
+
+
+class ExceptionModifications(Exception):
+    pass
+
+
+def day_number(dtr):
+    return (datetime.strptime(dtr, '%Y-%m-%d').date() - EPOCH).days
+
+
+def group_hashes(record):
+    """Return the CRC32 of the values of each group of columns of MODIFICATIONS."""
+    hashes = list()
+    for _, columns in MODIFICATIONS:
+        value = u'\x1f'.join(six.text_type(record[c]) if not isinstance(record[c], bytes) else
+                             record[c].decode('utf-8') for c in columns)
+        hashes.append(checksum(value.encode('utf-8')))
+    return hashes
+
+
+class ModificationSnapshot(object):
+    """
+        Fixed-width record of the last exported version of each SIRET, in a memory mapped hash table.
+
+        Each slot holds the SIRET, the day of its last version, the indicators computed for that day and a CRC32 of
+        each group of columns covered by an indicator, so a lookup costs a single probe in most cases and the memory
+        used is the pages of the file touched by the day. The table is open addressed with linear probing. It is sized
+        by reserve() for the establishments of a day before they are applied, and rebuilt with twice the slots when it
+        is more than load_factor full all the same.
+    """
+    load_factor = 0.7
+    # 2^20 slots, 56 MB, the file is sparse until the slots are written
+    initial_bits = 20
+
+    def __init__(self, logger, filename=MODIFICATIONS_FILENAME):
+        self.logger = logger
+        self.filename = filename
+        self.fd = None
+        self.mm = None
+        if not os.path.isdir(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        if not os.path.exists(self.filename):
+            self.create(self.filename, self.initial_bits)
+        self.open()
+
+    @staticmethod
+    def create(filename, bits):
+        with open(filename, 'wb') as fd:
+            fd.write(HEADER.pack(MAGIC, VERSION, 1 << bits, 0))
+            fd.truncate(HEADER.size + SLOT.size * (1 << bits))
+
+    def open(self):
+        self.fd = open(self.filename, 'r+b')
+        self.mm = mmap.mmap(self.fd.fileno(), 0)
+        magic, version, self.slots, self.count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION or len(self.mm) != HEADER.size + SLOT.size * self.slots:
+            self.close()
+            self.logger.error('  modification snapshot %s is not valid', self.filename)
+            raise ExceptionModifications('Invalid modification snapshot')
+        self.bits = self.slots.bit_length() - 1
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def flush(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.slots, self.count)
+        self.mm.flush()
+
+    def position(self, key):
+        """Return the offset of the slot of a SIRET, or of the free slot where it is inserted."""
+        # Fibonacci hashing spreads the consecutive NIC of a SIREN over the table
+        index = ((key * 11400714819323198485) & 0xffffffffffffffff) >> (64 - self.bits)
+        while True:
+            offset = HEADER.size + index * SLOT.size
+            stored = struct.unpack_from('<Q', self.mm, offset)[0]
+            if stored == key or stored == 0:
+                return offset, stored
+            index = (index + 1) & (self.slots - 1)
+
+    def reserve(self, expected):
+        """Grow the table once so that expected new establishments fit in it without any further growth."""
+        bits = self.bits
+        while self.count + expected > (1 << bits) * self.load_factor:
+            bits += 1
+        if bits > self.bits:
+            self.grow(bits)
+
+    def grow(self, bits=None):
+        filename = self.filename + '.tmp'
+        bits = bits or self.bits + 1
+        self.create(filename, bits)
+        previous = self.mm
+        slots = self.slots
+        with open(filename, 'r+b') as fd:
+            self.mm = mmap.mmap(fd.fileno(), 0)
+            self.slots = 1 << bits
+            self.bits = bits
+            # The keys of a batch of slots are unpacked at once, only the used slots are moved
+            for first in range(0, slots, GROW_BATCH):
+                count = min(GROW_BATCH, slots - first)
+                start = HEADER.size + first * SLOT.size
+                keys = struct.unpack_from('<' + KEY * count, previous, start)
+                for index in [i for i, key in enumerate(keys) if key]:
+                    offset, _ = self.position(keys[index])
+                    self.mm[offset:offset + SLOT.size] = previous[start + index * SLOT.size:
+                                                                  start + (index + 1) * SLOT.size]
+            self.flush()
+            self.mm.close()
+        previous.close()
+        self.fd.close()
+        os.rename(filename, self.filename)
+        self.open()
+        self.logger.info('  modification snapshot grown to %d slots for %d establishments', self.slots, self.count)
+
+    def apply(self, record, dtr):
+        """Set the modification indicators of an XL2 record and store its version of the day."""
+        key = int(record['SIREN'] + record['NIC'])
+        day = day_number(dtr)
+        hashes = group_hashes(record)
+        offset, stored = self.position(key)
+        flags = 0
+        if stored:
+            values = SLOT.unpack_from(self.mm, offset)
+            if values[1] == day:
+                # The day is exported again: the indicators computed the first time are kept
+                flags = values[2]
+            else:
+                for i, value in enumerate(values[3:]):
+                    if value != hashes[i]:
+                        flags |= 1 << i
+                # A day older than the stored version does not replace it
+                if values[1] < day:
+                    SLOT.pack_into(self.mm, offset, key, day, flags, *hashes)
+        else:
+            # A new establishment has no indicator
+            SLOT.pack_into(self.mm, offset, key, day, 0, *hashes)
+            self.count += 1
+
+        for i, (flag, _) in enumerate(MODIFICATIONS):
+            record[flag] = '1' if flags & (1 << i) else ''
+
+        if self.count > self.slots * self.load_factor:
+            self.grow()
+        return record
@@ -0,0 +1,68 @@
+# coding: utf-8
+"""
+    Estimate of the requests and duration of a harvest.
+"""
+
+from __future__ import absolute_import
+
+from datetime import datetime, timedelta
+
+
+# Establishments in a page of the API cursor
+PAGE_SIZE = 1000
+
+
+class HarvestPlan(object):
+    """
+        Partitions of a harvest with their number of establishments, pages, requests and duration.
+
+        The number of establishments of each partition comes from a facet of the API. Each page of the cursor costs
+        requests_per_page requests, headquarters included. The duration is bound by the rate limit shared by the
+        workers and by the latency of the requests, which are sent one after the other on each cursor. Entries are
+        cumulative so that the partition where the daily quota is exhausted is visible.
+    """
+    # Average duration of a request of the API, in seconds
+    latency = 2.0
+
+    def __init__(self, per_minute, workers=1, requests_per_page=1.0, daily_quota=None, used_today=0):
+        self.per_minute = per_minute
+        self.workers = workers
+        self.requests_per_page = requests_per_page
+        self.daily_quota = daily_quota
+        self.used_today = used_today
+        self.entries = list()
+
+    def minutes(self, requests):
+        return max(float(requests) / self.per_minute, requests * self.latency / 60 / self.workers)
+
+    def add(self, partition, records, facet=True):
+        """Add a partition of records establishments, facet is False when the count is an estimate."""
+        pages = max(1, -(-records // PAGE_SIZE))
+        requests = int(round(pages * self.requests_per_page))
+        total = requests + (self.entries[-1]['cumulative_requests'] if self.entries else 0)
+        entry = {'partition': partition,
+                 'records': records,
+                 'pages': pages,
+                 'requests': requests,
+                 'cumulative_requests': total,
+                 'minutes': round(self.minutes(requests), 1),
+                 'cumulative_minutes': round(self.minutes(total), 1),
+                 'facet': facet,
+                 'within_quota': not self.daily_quota or self.used_today + total <= self.daily_quota}
+        self.entries.append(entry)
+        return entry
+
+    def summary(self):
+        requests = self.entries[-1]['cumulative_requests'] if self.entries else 0
+        minutes = self.minutes(requests)
+        return {'partition': 'total',
+                'records': sum(e['records'] for e in self.entries),
+                'pages': sum(e['pages'] for e in self.entries),
+                'requests': requests,
+                'minutes': round(minutes, 1),
+                'estimated_end': (datetime.now() + timedelta(minutes=minutes)).strftime('%Y-%m-%dT%H:%M:%S'),
+                'workers': self.workers,
+                'rate_limit': self.per_minute,
+                'daily_quota': self.daily_quota,
+                'used_today': self.used_today,
+                'within_quota': not self.daily_quota or self.used_today + requests <= self.daily_quota}
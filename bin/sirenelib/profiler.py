@@ -0,0 +1,95 @@
+# coding: utf-8
+"""
+    CPU and memory profile of a command, enabled by its profile option.
+"""
+
+from __future__ import absolute_import
+
+import cProfile
+import functools
+import os
+import pstats
+import re
+import resource
+from splunklib.searchcommands import environment
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 only has the peak RSS of the process
+    tracemalloc = None
+
+
+PROFILE_DIRECTORY = os.path.join(environment.splunk_home, 'var', 'log', 'splunk')
+
+
+class CommandProfiler(object):
+    """
+        cProfile of a phase of a command, dumped next to insee.log and summed up in the messages of the job.
+
+        The profile is enabled in the thread of the command while its records are produced, so the time spent by the
+        search command protocol to write the records is included, the fetch threads and the worker processes are not.
+        With memory the allocations are traced by tracemalloc, when the version of Python provides it.
+    """
+    # Functions reported in the messages of the job
+    top = 5
+
+    def __init__(self, command, phase, memory=False, directory=PROFILE_DIRECTORY):
+        self.command = command
+        self.memory = memory and tracemalloc is not None
+        name = type(command).__name__.replace('Command', '').lower()
+        sid = re.sub(r'[^\w.-]', '_', command._metadata.searchinfo.sid)
+        self.filename = os.path.join(directory, '%s_%s_%s.prof' % (name, phase, sid))
+        self.profile = cProfile.Profile()
+
+    def run(self, records):
+        """Yield the records of a phase of the command while it is profiled."""
+        if self.memory:
+            tracemalloc.start()
+        self.profile.enable()
+        try:
+            for record in records:
+                yield record
+        finally:
+            self.profile.disable()
+            self.report()
+
+    def hotspots(self):
+        """Return the functions with the most time spent in their own code: seconds, calls and function."""
+        stats = pstats.Stats(self.profile).stats
+        entries = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:self.top]
+        return [(tt, nc, '%s:%d(%s)' % (os.path.basename(filename), line, function))
+                for (filename, line, function), (_, nc, tt, _, _) in entries]
+
+    def report(self):
+        if not os.path.isdir(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        self.profile.dump_stats(self.filename)
+        messages = ['%.3f s in %s, %d calls' % (tt, function, nc) for tt, nc, function in self.hotspots()]
+
+        # ru_maxrss is in kilobytes on Linux
+        messages.append('peak RSS %.1f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            snapshot.dump(self.filename + '.tracemalloc')
+            messages.append('peak traced memory %.1f MB' % (peak / 1024.0 / 1024.0))
+            for statistic in snapshot.statistics('lineno')[:self.top]:
+                messages.append('%.1f MB allocated at %s' % (statistic.size / 1024.0 / 1024.0, statistic.traceback))
+
+        self.command.logger.info('  profile written to %s', self.filename)
+        for message in messages:
+            self.command.logger.info('  profile: %s', message)
+            self.command.write_info('profile: {0}', message)
+
+
+def profiled(method):
+    """Profile the records of generate(), map() or reduce() when the profile option of the command is set."""
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        records = method(self, *args)
+        if not self.profile:
+            return records
+        return CommandProfiler(self, method.__name__, self.profile_memory).run(records)
+    return wrapper
@@ -0,0 +1,92 @@
+# coding: utf-8
+"""
+    Snapshot of the prospects harvested by pnaf.
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+from datetime import datetime, timedelta
+from splunklib.searchcommands import environment
+from sirenelib.export import checksum, write_atomic
+
+
+SNAPSHOT_FILENAME = os.path.join(environment.splunk_home, 'var', 'run', 'splunk', 'insee', 'prospects.json')
+
+
+class ProspectSnapshot(object):
+    """
+        Prospects known after the last harvest: a CRC32 of the event of each SIRET, the NAF codes of the
+        configuration and the day of the last delta applied.
+
+        A full harvest rebuilds the snapshot, mode=delta updates it from the establishments updated on a day.
+    """
+    def __init__(self, logger, filename=SNAPSHOT_FILENAME):
+        self.logger = logger
+        self.filename = filename
+        self.prospects = dict()
+        self.naf = None
+        self.dtr = None
+        self.loaded = False
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as fd:
+                snapshot = json.load(fd)
+        except (IOError, ValueError):
+            return False
+        self.prospects = snapshot['prospects']
+        self.naf = snapshot['naf']
+        self.dtr = snapshot['dtr']
+        self.loaded = True
+        self.logger.info('  prospect snapshot loaded: %d siret, last delta %s', len(self.prospects), self.dtr)
+        return True
+
+    @staticmethod
+    def fingerprint(raw):
+        if not isinstance(raw, bytes):
+            raw = raw.encode('utf-8')
+        return checksum(raw)
+
+    def compare(self, siret, raw):
+        """Return 'nouveau', 'modifie' or None when the prospect is unchanged, and update the snapshot."""
+        value = self.fingerprint(raw)
+        previous = self.prospects.get(siret)
+        self.prospects[siret] = value
+        if previous is None:
+            return 'nouveau'
+        if previous != value:
+            return 'modifie'
+        return None
+
+    def remove(self, siret):
+        """Return True when the SIRET was a prospect."""
+        return self.prospects.pop(siret, None) is not None
+
+    def mouvement(self, siret, raw=None):
+        """
+            Return the movement of an establishment updated on the day of a delta and update the snapshot: raw is its
+            event when it is an active prospect, None otherwise. A prospect that is no longer one is 'ferme'.
+        """
+        if raw is not None:
+            return self.compare(siret, raw)
+        return 'ferme' if self.remove(siret) else None
+
+    def missing_days(self, day):
+        """Return in order the days after the last delta applied until day, none when day is already applied."""
+        if self.dtr is None:
+            return [day]
+        first = datetime.strptime(self.dtr, '%Y-%m-%d') + timedelta(1)
+        days = (datetime.strptime(day, '%Y-%m-%d') - first).days + 1
+        return [(first + timedelta(i)).strftime('%Y-%m-%d') for i in range(days)]
+
+    def save(self, naf, dtr=None):
+        self.naf = sorted(naf)
+        self.dtr = dtr
+        if not os.path.isdir(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        write_atomic(self.filename, json.dumps({'naf': self.naf, 'dtr': self.dtr, 'prospects': self.prospects,
+                                                'updated': datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}
+                                               ).encode('utf-8'))
+        self.logger.info('  prospect snapshot saved: %d siret', len(self.prospects))
@@ -0,0 +1,35 @@
+# coding: utf-8
+"""
+    Request budget of the Sirene API.
+"""
+
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import deque
+
+
+class RateBudget(object):
+    """
+        Number of requests allowed in any window of 60 seconds, shared by all the threads of a command.
+
+        acquire() blocks until a request can be sent without going over the budget, so that parallel workers wait
+        for each other instead of receiving HTTP 429 answers.
+    """
+    def __init__(self, per_minute=30):
+        self.per_minute = per_minute
+        self.lock = threading.Lock()
+        self.calls = deque()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                while self.calls and self.calls[0] <= now - 60:
+                    self.calls.popleft()
+                if len(self.calls) < self.per_minute:
+                    self.calls.append(now)
+                    return
+                wait = self.calls[0] + 60 - now
+            time.sleep(wait)
@@ -0,0 +1,145 @@
+# coding: utf-8
+"""
+    Import of the monthly stock files of INSEE in the local Sirene store.
+"""
+
+from __future__ import absolute_import
+
+import csv
+import io
+import json
+import os
+import time
+from zipfile import ZipFile
+from splunklib import six
+from sirenelib.export import write_atomic
+from sirenelib.store import etablissement_row, unite_legale_row
+
+
+# Columns of StockEtablissement grouped as in the objects of the API
+ADRESSE_COLUMNS = ['complementAdresse', 'numeroVoie', 'indiceRepetition', 'typeVoie', 'libelleVoie', 'codePostal',
+                   'libelleCommune', 'libelleCommuneEtranger', 'distributionSpeciale', 'codeCommune', 'codeCedex',
+                   'libelleCedex', 'codePaysEtranger', 'libellePaysEtranger']
+ADRESSE = set(x + 'Etablissement' for x in ADRESSE_COLUMNS)
+ADRESSE2 = set(x + '2Etablissement' for x in ADRESSE_COLUMNS)
+PERIODE = set(['dateDebut', 'etatAdministratifEtablissement', 'enseigne1Etablissement', 'enseigne2Etablissement',
+               'enseigne3Etablissement', 'denominationUsuelleEtablissement', 'activitePrincipaleEtablissement',
+               'nomenclatureActivitePrincipaleEtablissement', 'caractereEmployeurEtablissement'])
+
+
+class ExceptionStock(Exception):
+    pass
+
+
+def etablissement_from_stock(row):
+    """Return the object of the API for a row of StockEtablissement, empty values become None."""
+    etablissement = dict()
+    adresse = dict()
+    adresse2 = dict()
+    periode = {'dateFin': None}
+    for key, value in row.items():
+        value = value or None
+        # enseigne2Etablissement also ends with 2Etablissement but belongs to the period
+        if key in ADRESSE2:
+            adresse2[key] = value
+        elif key in ADRESSE:
+            adresse[key] = value
+        elif key in PERIODE:
+            periode[key] = value
+        else:
+            etablissement[key] = value
+    etablissement['etablissementSiege'] = etablissement.get('etablissementSiege') == 'true'
+    etablissement['adresseEtablissement'] = adresse
+    etablissement['adresse2Etablissement'] = adresse2
+    etablissement['periodesEtablissement'] = [periode]
+    return etablissement
+
+
+class StockImporter(object):
+    """
+        Streams a zipped stock file in the store.
+
+        The CSV is read from the zip file without extracting it and loaded by batches of rows, each in its own
+        transaction. The secondary indexes are dropped during the import and built at the end. After each batch the
+        number of rows loaded is saved in <store>.import.json, an interrupted import of the same file skips them.
+    """
+    def __init__(self, sirene_store, logger, batch=50000):
+        self.sirene_store = sirene_store
+        self.logger = logger
+        self.batch = batch
+        self.checkpoint_filename = sirene_store.filename + '.import.json'
+
+    def read_checkpoint(self, filename):
+        try:
+            with open(self.checkpoint_filename, 'r') as fd:
+                checkpoint = json.load(fd)
+        except (IOError, ValueError):
+            return 0
+        if checkpoint['file'] != os.path.abspath(filename) or checkpoint['size'] != os.path.getsize(filename):
+            return 0
+        return checkpoint['rows']
+
+    def save_checkpoint(self, filename, rows):
+        write_atomic(self.checkpoint_filename, json.dumps({'file': os.path.abspath(filename), 'rows': rows,
+                                                           'size': os.path.getsize(filename)}).encode('utf-8'))
+
+    @staticmethod
+    def reader(fd):
+        # The csv module of Python 2 reads bytes, the one of Python 3 reads text
+        if six.PY2:
+            for row in csv.reader(fd):
+                yield [value.decode('utf-8') for value in row]
+        else:
+            for row in csv.reader(io.TextIOWrapper(fd, encoding='utf-8', newline='')):
+                yield row
+
+    def run(self, filename):
+        """Import a StockEtablissement or StockUniteLegale zip file and return a summary of the import."""
+        start = time.time()
+        skip = self.read_checkpoint(filename)
+        with ZipFile(filename) as zip_file:
+            members = [name for name in zip_file.namelist() if name.lower().endswith('.csv')]
+            if len(members) != 1:
+                self.logger.error('  %s must contain a single CSV file', filename)
+                raise ExceptionStock('The stock file must contain a single CSV file')
+
+            with zip_file.open(members[0]) as fd:
+                rows = self.reader(fd)
+                header = next(rows)
+                if 'siret' in header:
+                    table = 'etablissements'
+                    convert = lambda r: etablissement_row(etablissement_from_stock(r))
+                elif 'siren' in header:
+                    table = 'unites_legales'
+                    convert = lambda r: unite_legale_row(r['siren'], dict((k, v or None) for k, v in r.items()))
+                else:
+                    self.logger.error('  %s is not a stock file of INSEE', members[0])
+                    raise ExceptionStock('Unknown stock file')
+
+                self.logger.info('  import %s in table %s, %d rows already loaded', members[0], table, skip)
+                self.sirene_store.drop_indexes()
+
+                count = 0
+                batch = list()
+                for row in rows:
+                    count += 1
+                    if count <= skip:
+                        continue
+                    batch.append(convert(dict(zip(header, row))))
+                    if len(batch) == self.batch:
+                        self.sirene_store.load(table, batch)
+                        self.save_checkpoint(filename, count)
+                        self.logger.info('  %d rows loaded', count)
+                        batch = list()
+                if batch:
+                    self.sirene_store.load(table, batch)
+                    self.save_checkpoint(filename, count)
+
+        self.logger.info('  build the indexes of the store')
+        self.sirene_store.create_indexes()
+        if os.path.exists(self.checkpoint_filename):
+            os.remove(self.checkpoint_filename)
+        self.logger.info('  %d rows of %s imported in %d seconds', count - skip, members[0], time.time() - start)
+
+        return {'file': filename, 'table': table, 'rows': count, 'imported': count - skip,
+                'seconds': int(time.time() - start)}
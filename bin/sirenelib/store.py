@@ -0,0 +1,169 @@
+# coding: utf-8
+"""
+    Local mirror of the Sirene establishments and legal units.
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import sqlite3
+import threading
+from splunklib.searchcommands import environment
+from sirenelib.fields import etablissement_fields
+
+
+STORE_FILENAME = os.path.join(environment.splunk_home, 'var', 'run', 'splunk', 'insee', 'sirene.db')
+
+TABLES = ['CREATE TABLE IF NOT EXISTS etablissements (siret TEXT PRIMARY KEY, siren TEXT NOT NULL, nic TEXT NOT NULL, '
+          'etablissement_siege INTEGER, activite_principale TEXT, code_commune TEXT, code_pays TEXT, '
+          'etat_administratif TEXT, date_dernier_traitement TEXT, data TEXT)',
+          'CREATE TABLE IF NOT EXISTS unites_legales (siren TEXT PRIMARY KEY, nic_siege TEXT, categorie_juridique TEXT, '
+          'activite_principale TEXT, etat_administratif TEXT, date_dernier_traitement TEXT, data TEXT)']
+
+INDEXES = [('etablissements_siren', 'etablissements (siren)'),
+           ('etablissements_naf', 'etablissements (activite_principale, etat_administratif)'),
+           ('etablissements_commune', 'etablissements (code_commune)'),
+           ('etablissements_etat', 'etablissements (etat_administratif)'),
+           ('unites_legales_naf', 'unites_legales (activite_principale)')]
+
+# A row of a bulk load or of upsert() replaces the stored one unless the stored one has been processed later by INSEE
+LOAD = {'etablissements': 'INSERT OR REPLACE INTO etablissements SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS '
+                          '(SELECT 1 FROM etablissements WHERE siret = ? AND date_dernier_traitement > ?)',
+        'unites_legales': 'INSERT OR REPLACE INTO unites_legales SELECT ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS '
+                          '(SELECT 1 FROM unites_legales WHERE siren = ? AND date_dernier_traitement > ?)'}
+
+# Position of the date_dernier_traitement column in the rows of each table
+LOAD_DATE = {'etablissements': 8, 'unites_legales': 5}
+
+# Filters accepted by find(): option name and column of the etablissements table
+FILTERS = [('siret', 'siret'), ('siren', 'siren'), ('naf', 'activite_principale'), ('commune', 'code_commune'),
+           ('etat', 'etat_administratif')]
+
+
+def etablissement_row(etablissement):
+    # Fields left out by masquerValeursNulles read as None
+    _, _, a, _, p = etablissement_fields(etablissement)
+    data = dict((k, v) for k, v in etablissement.items() if k != 'uniteLegale')
+    return (etablissement['siret'], etablissement['siren'], etablissement['nic'],
+            1 if etablissement['etablissementSiege'] else 0, p['activitePrincipaleEtablissement'],
+            a['codeCommuneEtablissement'], a['codePaysEtrangerEtablissement'], p['etatAdministratifEtablissement'],
+            etablissement['dateDernierTraitementEtablissement'], json.dumps(data))
+
+
+def unite_legale_row(siren, unite_legale):
+    return (siren, unite_legale.get('nicSiegeUniteLegale'), unite_legale.get('categorieJuridiqueUniteLegale'),
+            unite_legale.get('activitePrincipaleUniteLegale'), unite_legale.get('etatAdministratifUniteLegale'),
+            unite_legale.get('dateDernierTraitementUniteLegale'), json.dumps(unite_legale))
+
+
+def guarded_rows(table, rows):
+    # Parameters of the LOAD statement of a table: the row, then its key and its date for the guard
+    position = LOAD_DATE[table]
+    return [row + (row[0], row[position]) for row in rows]
+
+
+class SireneStore(object):
+    """
+        SQLite database of the establishments received from the API, with their legal unit.
+
+        Each establishment is stored with the columns used by the lookups and its JSON object without the legal unit,
+        which is stored once per SIREN. find() rebuilds the objects as returned by the API. Each thread has its own
+        connection and the database uses WAL so that the workers read while the main thread writes.
+    """
+    # Number of values in a single IN () of a query
+    batch = 500
+
+    def __init__(self, logger, filename=STORE_FILENAME, indexes=True):
+        self.logger = logger
+        self.filename = filename
+        self.local = threading.local()
+        if not os.path.isdir(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        with self.connection() as connection:
+            for statement in TABLES:
+                connection.execute(statement)
+        if indexes:
+            self.create_indexes()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename, timeout=60)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def upsert(self, etablissements):
+        """Store establishments received from the API and their legal unit in a single transaction, as load() does."""
+        rows = list()
+        unites_legales = dict()
+        for etablissement in etablissements:
+            rows.append(etablissement_row(etablissement))
+            if etablissement.get('uniteLegale'):
+                unites_legales[etablissement['siren']] = etablissement['uniteLegale']
+        with self.connection() as connection:
+            connection.executemany(LOAD['etablissements'], guarded_rows('etablissements', rows))
+            connection.executemany(LOAD['unites_legales'], guarded_rows(
+                'unites_legales', [unite_legale_row(siren, u) for siren, u in unites_legales.items()]))
+
+    def create_indexes(self):
+        with self.connection() as connection:
+            for name, definition in INDEXES:
+                connection.execute('CREATE INDEX IF NOT EXISTS %s ON %s' % (name, definition))
+
+    def drop_indexes(self):
+        """Drop the secondary indexes, a bulk load is faster without them."""
+        with self.connection() as connection:
+            for name, _ in INDEXES:
+                connection.execute('DROP INDEX IF EXISTS %s' % name)
+
+    def load(self, table, rows):
+        """Bulk load rows built by etablissement_row() or unite_legale_row() in a single transaction."""
+        with self.connection() as connection:
+            connection.executemany(LOAD[table], guarded_rows(table, rows))
+
+    def get_sieges(self, sirets):
+        """Return the address codes of the headquarters found in the store, as kept by the checkpoints."""
+        sieges = dict()
+        for i in range(0, len(sirets), self.batch):
+            chunk = sirets[i:i + self.batch]
+            cursor = self.connection().execute(
+                'SELECT siret, code_commune, code_pays FROM etablissements WHERE siret IN (%s)' %
+                ', '.join('?' * len(chunk)), chunk)
+            for siret, code_commune, code_pays in cursor:
+                sieges[siret] = {'adresseEtablissement': {'codeCommuneEtablissement': code_commune,
+                                                          'codePaysEtrangerEtablissement': code_pays}}
+        return sieges
+
+    def find(self, limit=None, naf_list=None, **filters):
+        """Yield the establishments matching the filters of FILTERS, and the NAF codes of naf_list if given."""
+        where = list()
+        parameters = list()
+        for name, column in FILTERS:
+            if filters.get(name):
+                where.append('e.%s = ?' % column)
+                parameters.append(filters[name])
+        if naf_list:
+            where.append('e.activite_principale IN (%s)' % ', '.join('?' * len(naf_list)))
+            parameters.extend(naf_list)
+        query = 'SELECT e.data, u.data FROM etablissements e LEFT JOIN unites_legales u ON u.siren = e.siren'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY e.siret'
+        if limit:
+            query += ' LIMIT %d' % limit
+        for data, unite_legale in self.connection().execute(query, parameters):
+            etablissement = json.loads(data)
+            etablissement['uniteLegale'] = json.loads(unite_legale) if unite_legale else None
+            yield etablissement
+
+    def count(self):
+        return self.connection().execute('SELECT COUNT(*) FROM etablissements').fetchone()[0]
@@ -0,0 +1,66 @@
+# coding: utf-8
+"""
+    Generators run in background threads.
+"""
+
+from __future__ import absolute_import
+
+import threading
+from collections import deque
+from splunklib.six.moves.queue import Queue
+
+
+# Put in the queue when a generator is exhausted
+_DONE = object()
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+def _run(generator, queue):
+    # An error is handed over to the thread that reads the queue, which raises it
+    try:
+        for item in generator:
+            queue.put(item)
+    except Exception as e:
+        queue.put(_Failure(e))
+        return
+    queue.put(_DONE)
+
+
+def _start(generator, queue):
+    thread = threading.Thread(target=_run, args=(generator, queue))
+    thread.daemon = True
+    thread.start()
+
+
+def _items(queue, waiting, running):
+    while running:
+        item = queue.get()
+        if item is _DONE:
+            running -= 1
+            if waiting:
+                _start(waiting.popleft(), queue)
+                running += 1
+        elif isinstance(item, _Failure):
+            raise item.error
+        else:
+            yield item
+
+
+def threaded(generators, size, workers=1):
+    """
+        Run generators in daemon threads, workers at a time, and return an iterator on their items as they come.
+
+        The threads are started at once and stay at most size items ahead of the caller. The first error of a
+        generator is raised by the iterator, the threads still running are left blocked on the queue.
+    """
+    queue = Queue(maxsize=size)
+    waiting = deque(generators)
+    running = 0
+    while waiting and running < workers:
+        _start(waiting.popleft(), queue)
+        running += 1
+    return _items(queue, waiting, running)
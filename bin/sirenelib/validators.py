@@ -0,0 +1,30 @@
+# coding: utf-8
+"""
+    Validators of the options of the search commands.
+"""
+
+from __future__ import absolute_import
+
+from datetime import datetime
+from splunklib import six
+from splunklib.searchcommands import validators
+
+
+class Date(validators.Validator):
+    """
+        Validates Date option values.
+    """
+    def __call__(self, value):
+        if value is None:
+            return None
+
+        try:
+            datetime.strptime(value, '%Y-%m-%d')
+            return value
+        except ValueError:
+            raise ValueError('Unrecognized date value: {0}. Should be AAAA-MM-JJ'.format(value))
+
+    def format(self, value):
+        if value is None:
+            return None
+        return six.text_type(value)
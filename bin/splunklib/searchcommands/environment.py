@@ -20,6 +20,7 @@ from logging import getLogger, root, StreamHandler
 from logging.config import fileConfig
 from os import chdir, environ, path
 from splunklib.six.moves import getcwd
+from splunklib.six.moves.configparser import RawConfigParser
 
 import sys
 
@@ -113,6 +114,24 @@ def configure_logging(logger_name, filename=None):
 
 _current_logging_configuration_file = None
 
+
+def command_settings(name):
+    """ Returns the settings of the stanza of a command in the commands.conf files of the app.
+
+    Settings in local/commands.conf override those in default/commands.conf.
+
+    :param name: Command name
+    :type name: bytes, unicode
+
+    :returns: A dictionary of setting values, empty if the command has no stanza.
+    :rtype: dict
+
+    """
+    parser = RawConfigParser()
+    parser.optionxform = str
+    parser.read([path.join(app_root, conf, 'commands.conf') for conf in ('default', 'local')])
+    return dict(parser.items(name)) if parser.has_section(name) else {}
+
 splunk_home = path.abspath(path.join(getcwd(), environ.get('SPLUNK_HOME', '')))
 app_file = getattr(sys.modules['__main__'], '__file__', sys.executable)
 app_root = path.dirname(path.abspath(path.dirname(app_file)))
@@ -120,4 +139,4 @@ app_root = path.dirname(path.abspath(path.dirname(app_file)))
 splunklib_logger, logging_configuration = configure_logging('splunklib')
 
 
-__all__ = ['app_file', 'app_root', 'logging_configuration', 'splunk_home', 'splunklib_logger']
+__all__ = ['app_file', 'app_root', 'command_settings', 'logging_configuration', 'splunk_home', 'splunklib_logger']
@@ -174,6 +174,16 @@ class GeneratingCommand(SearchCommand):
         streaming = false
 
     """
+    # region Properties
+
+    #: Under SCP 2, the records of :meth:`generate` are sent to splunkd as partial chunks every 2 seconds or 4 MB,
+    #: without waiting for `maxresultrows` records, so that previews and the commands downstream start working while a
+    #: long running generator is still producing records. See the `flush_interval` and `flush_size` options.
+    default_flush_interval = 2
+    default_flush_size = 4 * 1024 * 1024
+
+    # endregion
+
     # region Methods
 
     def generate(self):
@@ -184,6 +194,18 @@ class GeneratingCommand(SearchCommand):
         """
         raise NotImplementedError('GeneratingCommand.generate(self)')
 
+    def flush_partial(self):
+        """ Sends the records generated so far to splunkd as a partial chunk, under SCP 2.
+
+        Call this from :meth:`generate` before waiting for more input, such as the next page of a remote API, so that
+        `flush_interval` bounds the time the records already generated wait in the output buffer.
+
+        :return: :const:`None`
+
+        """
+        if self._protocol_version == 2:
+            self._record_writer.flush_partial()
+
     def _execute(self, ifile, process):
         """ Execution loop
 
@@ -205,6 +227,9 @@ class GeneratingCommand(SearchCommand):
             if action != 'execute':
                 raise RuntimeError('Expected execute action, not {}'.format(action))
 
+            # The chunks flushed on time or size tell splunkd that more records follow
+            self._record_writer.mark_partial = True
+
         self._record_writer.write_records(self.generate())
         self.finish()
 
@@ -27,6 +27,7 @@ from itertools import chain
 from splunklib.six.moves import map as imap
 from json import JSONDecoder, JSONEncoder
 from json.encoder import encode_basestring_ascii as json_encode_string
+from operator import itemgetter
 from splunklib.six.moves import urllib
 
 import csv
@@ -34,6 +35,7 @@ import gzip
 import os
 import re
 import sys
+import time
 
 from . import environment
 
@@ -332,6 +334,50 @@ class ConfigurationSettingsType(type):
             supporting_protocols=[2])}
 
 
+class CompactRecord(object):
+    """ Read-only record of a chunk, backed by the list of its values and the field index shared by the chunk.
+
+    Compared to an :class:`OrderedDict` per record, a record costs one small object on top of the values parsed by
+    the :class:`csv.reader`. Fields are looked up by name and iterated in the order of the chunk, like a dictionary.
+
+    """
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __getitem__(self, name):
+        return self._values[self._index[name]]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return 'CompactRecord(' + repr(self.items()) + ')'
+
+    def get(self, name, default=None):
+        position = self._index.get(name)
+        return default if position is None else self._values[position]
+
+    def items(self):
+        values = self._values
+        return [(name, values[position]) for name, position in six.iteritems(self._index)]
+
+    def keys(self):
+        return list(self._index)
+
+    def values(self):
+        values = self._values
+        return [values[position] for position in six.itervalues(self._index)]
+
+
 class CsvDialect(csv.Dialect):
     """ Describes the properties of Splunk CSV streams """
     delimiter = ','
@@ -448,6 +494,13 @@ class Recorder(object):
         self._recording.flush()
         return value
 
+    def readinto(self, buffer):
+        count = self._file.readinto(buffer)
+        if count:
+            self._recording.write(memoryview(buffer)[:count].tobytes())
+            self._recording.flush()
+        return count
+
     def readline(self, size=None):
         value = self._file.readline() if size is None else self._file.readline(size)
         if len(value) > 0:
@@ -470,8 +523,20 @@ class RecordWriter(object):
     def __init__(self, ofile, maxresultrows=None):
         self._maxresultrows = 50000 if maxresultrows is None else maxresultrows
 
+        # Partial flush policy: a chunk is also flushed when it has been open for flush_interval seconds or has grown to
+        # flush_size bytes, so that the records of a slow generator reach splunkd before maxresultrows are buffered
+        self.flush_interval = None
+        self.flush_size = None
+        self._chunk_time = time.time()
+
+        # The chunks flushed by the policy carry partial: true only when this is set, by GeneratingCommand. Other
+        # chunks keep the metadata of SCP 2 as documented, without the partial field (See DVPL-6448)
+        self.mark_partial = False
+        self._policy_flush = False
+
         self._ofile = ofile
         self._fieldnames = None
+        self._schema = None
         self._buffer = StringIO()
 
         self._writer = csv.writer(self._buffer, dialect=CsvDialect)
@@ -515,6 +580,18 @@ class RecordWriter(object):
         self._ensure_validity()
         self._write_record(record)
 
+    def flush_partial(self):
+        """ Flushes the records buffered so far as a partial chunk, when the flush policy has a `flush_interval`.
+
+        The policy is otherwise evaluated as records are written. A generator calls this before it blocks, on the next
+        page of an API for instance, so that the records it has produced do not wait for the next one.
+
+        """
+        self._ensure_validity()
+        if self.flush_interval is not None and self._record_count > 0:
+            self._policy_flush = True
+            self.flush(partial=True)
+
     def write_records(self, records):
         self._ensure_validity()
         write_record = self._write_record
@@ -527,6 +604,8 @@ class RecordWriter(object):
         self._inspector.clear()
         self._record_count = 0
         self._flushed = False
+        self._chunk_time = time.time()
+        self._policy_flush = False
 
     def _ensure_validity(self):
         if self._finished is True:
@@ -535,12 +614,98 @@ class RecordWriter(object):
 
     def _write_record(self, record):
 
+        # The records buffered since flush_interval go out before this one, which starts the next chunk
+        if self._record_count > 0 and self._flush_due():
+            self._policy_flush = True
+            self.flush(partial=True)
+
         fieldnames = self._fieldnames
 
         if fieldnames is None:
             self._fieldnames = fieldnames = list(record.keys())
             value_list = imap(lambda fn: (str(fn), str('__mv_') + str(fn)), fieldnames)
             self._writerow(list(chain.from_iterable(value_list)))
+            self._schema = self._flat_schema(record, fieldnames)
+
+        schema = self._schema
+
+        if schema is not None:
+            # Fast path: the record has the fields and the value types of the first record of the chunk
+            types, get_values, converters, template = schema
+            try:
+                values = get_values(record)
+            except KeyError:
+                values = None
+            if values is not None and tuple(imap(type, values)) == types:
+                self._buffer.write(template % tuple([convert(value) for convert, value in zip(converters, values)]))
+            else:
+                self._writerow(self._format_values(record, fieldnames))
+        else:
+            self._writerow(self._format_values(record, fieldnames))
+
+        self._record_count += 1
+
+        if self._record_count >= self._maxresultrows:
+            self.flush(partial=True)
+        elif self.flush_size is not None and self._buffer.tell() >= self.flush_size:
+            self._policy_flush = True
+            self.flush(partial=True)
+
+    def _flush_due(self):
+        if self.flush_size is not None and self._buffer.tell() >= self.flush_size:
+            return True
+        if self.flush_interval is not None and time.time() - self._chunk_time >= self.flush_interval:
+            return True
+        return False
+
+    @staticmethod
+    def _flat_schema(record, fieldnames):
+        """ Returns the serializer of the records with the same fields and scalar value types as :param:`record`.
+
+        Generating commands typically yield records with the same fields and value types. Such a record is written as
+        a whole row by a format string and a converter per field, instead of going through the type dispatch of
+        :meth:`_format_values` and the :class:`csv.writer`. Returns :const:`None` when a value of :param:`record` is
+        missing or is not a scalar.
+
+        """
+        converters = RecordWriter._flat_converters
+        try:
+            types = tuple(type(record[fieldname]) for fieldname in fieldnames)
+        except KeyError:
+            return None
+        if not all(value_t in converters for value_t in types):
+            return None
+        if len(fieldnames) == 1:
+            get_value = itemgetter(fieldnames[0])
+            get_values = lambda record: (get_value(record),)
+        else:
+            get_values = itemgetter(*fieldnames)
+        # Each value is followed by its empty __mv_ field
+        template = str(',,'.join(['%s'] * len(fieldnames)) + ',' + CsvDialect.lineterminator)
+        return types, get_values, [converters[value_t] for value_t in types], template
+
+    @staticmethod
+    def _quote(value):
+        # Quoting of csv.QUOTE_MINIMAL with the CsvDialect
+        if RecordWriter._special_characters(value):
+            return '"' + value.replace('"', '""') + '"'
+        return value
+
+    _special_characters = re.compile(r'[",\r\n]').search
+
+    # Serialization of the scalar values, identical to the one of _format_values followed by the csv.writer
+    _flat_converters = {
+        bool: lambda value: str(value.real),
+        int: str,
+        float: str}
+
+    if six.PY2:
+        _flat_converters[bytes] = _quote.__func__
+        _flat_converters[six.text_type] = lambda value: RecordWriter._quote(value.encode('utf-8'))
+    else:
+        _flat_converters[six.text_type] = _quote.__func__
+
+    def _format_values(self, record, fieldnames):
 
         get_value = record.get
         values = []
@@ -620,11 +785,7 @@ class RecordWriter(object):
 
             values += (repr(value), None)
 
-        self._writerow(values)
-        self._record_count += 1
-
-        if self._record_count >= self._maxresultrows:
-            self.flush(partial=True)
+        return values
 
     try:
         # noinspection PyUnresolvedReferences
@@ -735,6 +896,9 @@ class RecordWriterV2(RecordWriter):
             #     ('inspector', self._inspector if len(self._inspector) else None),
             #     ('finished', finished),
             #     ('partial', partial)]
+            #
+            # Until then partial: true is only sent on the chunks flushed by the policy of a generating command, which
+            # opts in with mark_partial.
 
             if len(inspector) == 0:
                 inspector = None
@@ -743,6 +907,10 @@ class RecordWriterV2(RecordWriter):
                 finished = False
 
             metadata = [item for item in (('inspector', inspector), ('finished', finished))]
+
+            if self.mark_partial and self._policy_flush:
+                metadata.append(('partial', True))
+
             self._write_chunk(metadata, self._buffer.getvalue())
             self._clear()
 
@@ -766,6 +934,7 @@ class RecordWriterV2(RecordWriter):
     def _clear(self):
         RecordWriter._clear(self)
         self._fieldnames = None
+        self._schema = None
 
     def _write_chunk(self, metadata, body):
 
@@ -27,7 +27,7 @@ try:
 except ImportError:
     from ..ordereddict import OrderedDict
 from copy import deepcopy
-from splunklib.six.moves import StringIO
+from splunklib.six.moves import cStringIO, StringIO
 from itertools import chain, islice
 from splunklib.six.moves import filter as ifilter, map as imap, zip as izip
 from splunklib import six
@@ -57,6 +57,7 @@ import traceback
 
 from .internals import (
     CommandLineParser,
+    CompactRecord,
     CsvDialect,
     InputHeader,
     Message,
@@ -68,7 +69,7 @@ from .internals import (
     RecordWriterV2,
     json_encode_string)
 
-from . import Boolean, Option, environment
+from . import Boolean, Duration, Integer, Option, environment
 from ..client import Service
 
 
@@ -186,10 +187,36 @@ class SearchCommand(object):
 
         ''', default=False, validate=Boolean())
 
+    flush_interval = Option(doc='''
+        **Syntax:** flush_interval=<duration>
+
+        **Description:** Under SCP 2, buffered records are sent to splunkd as a partial chunk once the chunk has been
+        open for this number of seconds. `0` disables the time based flush. Defaults to the `flush_interval` setting of
+        the command in commands.conf, then to the default of the command type.
+
+        ''', validate=Duration())
+
+    flush_size = Option(doc='''
+        **Syntax:** flush_size=<int>
+
+        **Description:** Under SCP 2, buffered records are sent to splunkd as a partial chunk once they take this number
+        of bytes. `0` disables the size based flush. Defaults to the `flush_size` setting of the command in
+        commands.conf, then to the default of the command type.
+
+        ''', validate=Integer(minimum=0, maximum=256 * 1024 * 1024))
+
     # endregion
 
     # region Properties
 
+    #: Default seconds and bytes after which records are flushed as a partial chunk, :const:`None` if not bounded
+    default_flush_interval = None
+    default_flush_size = None
+
+    #: When :const:`True`, the records received under SCP 2 are :class:`CompactRecord` objects sharing the field index of
+    #: their chunk instead of an :class:`OrderedDict` per record. They are read-only.
+    compact_records = False
+
     @property
     def configuration(self):
         """ Returns the configuration settings for this command.
@@ -540,6 +567,29 @@ class SearchCommand(object):
 
         return ifile  # wrapped, if self.record is True
 
+    def _set_flush_policy(self):
+        """ Sets the limits of the chunks of the record writer from the options, commands.conf or the class defaults.
+
+        The records are flushed as a partial chunk when they reach either limit, or `maxresultrows`, so that the size
+        of the output buffer stays bounded whatever the size of the records.
+
+        """
+        settings = environment.command_settings(type(self).name)
+        record_writer = self._record_writer
+
+        for name, default in ('flush_interval', self.default_flush_interval), ('flush_size', self.default_flush_size):
+            value = getattr(self, name)
+            if value is None and name in settings:
+                try:
+                    value = self.options[name].validator(settings[name])
+                except ValueError as error:
+                    self.logger.warning('Ignoring %s = %s in commands.conf: %s', name, settings[name], error)
+            if value is None:
+                value = default
+            setattr(record_writer, name, value if value else None)
+
+        self.logger.debug('  flush_interval=%r, flush_size=%r', record_writer.flush_interval, record_writer.flush_size)
+
     def _prepare_recording(self, argv, ifile, ofile):
 
         # Create the recordings directory, if it doesn't already exist
@@ -650,6 +700,7 @@ class SearchCommand(object):
 
         debug('%s.process started under protocol_version=2', class_name)
         self._protocol_version = 2
+        ifile = self._open_input(ifile)
 
         # Read search command metadata from splunkd
         # noinspection PyBroadException
@@ -734,6 +785,8 @@ class SearchCommand(object):
             if error_count > 0:
                 exit(1)
 
+            self._set_flush_policy()
+
             debug('  command: %s', six.text_type(self))
 
             debug('Preparing for execution')
@@ -848,6 +901,20 @@ class SearchCommand(object):
         self._record_writer.write_records(process(self._records(ifile)))
         self.finish()
 
+    @staticmethod
+    def _open_input(ifile):
+        """ Returns a binary reader with a large buffer over the input file, when it has a file descriptor.
+
+        Chunk lengths are in bytes, so the chunks are read from the binary stream, not from the text stream that
+        `sys.stdin` is under Python 3. Other input files, like the recorder, are returned as they are.
+
+        """
+        try:
+            fileno = ifile.fileno()
+        except (AttributeError, IOError, ValueError):
+            return getattr(ifile, 'buffer', ifile)
+        return io.open(fileno, 'rb', buffering=SearchCommand._input_buffer_size, closefd=False)
+
     @staticmethod
     def _read_chunk(ifile):
         # noinspection PyBroadException
@@ -859,6 +926,10 @@ class SearchCommand(object):
         if not header:
             return None
 
+        if not isinstance(header, bytes):
+            # Text input file, whose lengths are in characters, only valid for ASCII chunks
+            header = header.encode('utf-8')
+
         match = SearchCommand._header.match(header)
 
         if match is None:
@@ -873,26 +944,52 @@ class SearchCommand(object):
         except Exception as error:
             raise RuntimeError('Failed to read metadata of length {}: {}'.format(metadata_length, error))
 
-        decoder = MetadataDecoder()
-
         try:
-            metadata = decoder.decode(metadata)
+            if isinstance(metadata, bytes):
+                metadata = metadata.decode('utf-8')
+            metadata = SearchCommand._metadata_decoder.decode(metadata)
         except Exception as error:
             raise RuntimeError('Failed to parse metadata of length {}: {}'.format(metadata_length, error))
 
-        # if body_length <= 0:
-        #     return metadata, ''
-
-        body = ""
+        body = b''
         try:
             if body_length > 0:
-                body = ifile.read(body_length)
+                body = SearchCommand._read_body(ifile, body_length)
         except Exception as error:
             raise RuntimeError('Failed to read body of length {}: {}'.format(body_length, error))
 
         return metadata, body
 
-    _header = re.compile(r'chunked\s+1.0\s*,\s*(\d+)\s*,\s*(\d+)\s*\n')
+    @staticmethod
+    def _read_body(ifile, body_length):
+        """ Returns the body of a chunk as a memoryview of a buffer the input file reads into, without copy. """
+        readinto = getattr(ifile, 'readinto', None)
+
+        if readinto is None:
+            return ifile.read(body_length)
+
+        body = memoryview(bytearray(body_length))
+        position = 0
+
+        while position < body_length:
+            count = readinto(body[position:])
+            if not count:
+                raise EOFError('Read {} bytes out of {}'.format(position, body_length))
+            position += count
+
+        return body
+
+    @staticmethod
+    def _body_input(body):
+        """ Returns the file read by the CSV parser over the body of a chunk. """
+        # The cStringIO of Python 2 reads the memoryview of the body in place, the csv module of Python 3 reads text
+        if not six.PY2 and not isinstance(body, six.text_type):
+            body = six.text_type(body, 'utf-8')
+        return cStringIO(body)
+
+    _header = re.compile(br'chunked\s+1.0\s*,\s*(\d+)\s*,\s*(\d+)\s*\n')
+    _input_buffer_size = 1024 * 1024
+    _metadata_decoder = MetadataDecoder()
 
     def _records_protocol_v1(self, ifile):
 
@@ -920,8 +1017,12 @@ class SearchCommand(object):
                     record[fieldname] = value
             yield record
 
-    def _records_protocol_v2(self, ifile):
+    def _chunks_protocol_v2(self, ifile):
+        """ Yields the body of each chunk of records received under SCP 2.
+
+        The response to a chunk is flushed when the next one is requested, after the consumer is done with its body.
 
+        """
         while True:
             result = self._read_chunk(ifile)
 
@@ -938,33 +1039,52 @@ class SearchCommand(object):
             self._record_writer.is_flushed = False
 
             if len(body) > 0:
-                reader = csv.reader(StringIO(body), dialect=CsvDialect)
+                yield body
 
-                try:
-                    fieldnames = next(reader)
-                except StopIteration:
-                    return
+            if finished:
+                return
 
-                mv_fieldnames = dict([(name, name[len('__mv_'):]) for name in fieldnames if name.startswith('__mv_')])
+            self.flush()
 
-                if len(mv_fieldnames) == 0:
-                    for values in reader:
-                        yield OrderedDict(izip(fieldnames, values))
-                else:
-                    for values in reader:
-                        record = OrderedDict()
-                        for fieldname, value in izip(fieldnames, values):
-                            if fieldname.startswith('__mv_'):
-                                if len(value) > 0:
-                                    record[mv_fieldnames[fieldname]] = self._decode_list(value)
-                            elif fieldname not in record:
-                                record[fieldname] = value
-                        yield record
+    def _records_protocol_v2(self, ifile):
 
-            if finished:
+        for body in self._chunks_protocol_v2(ifile):
+            reader = csv.reader(self._body_input(body), dialect=CsvDialect)
+
+            try:
+                fieldnames = next(reader)
+            except StopIteration:
                 return
 
-            self.flush()
+            mv_fieldnames = dict([(name, name[len('__mv_'):]) for name in fieldnames if name.startswith('__mv_')])
+
+            if self.compact_records:
+                index = OrderedDict()
+                for position, fieldname in enumerate(fieldnames):
+                    if fieldname not in mv_fieldnames:
+                        index.setdefault(fieldname, position)
+                # A multivalue replaces the value of its field, or stands for it when the field is not in the chunk
+                mv_positions = [(position, index.setdefault(mv_fieldnames[fieldname], position))
+                                for position, fieldname in enumerate(fieldnames) if fieldname in mv_fieldnames]
+                decode_list = self._decode_list
+                for values in reader:
+                    for mv_position, position in mv_positions:
+                        if len(values[mv_position]) > 0:
+                            values[position] = decode_list(values[mv_position])
+                    yield CompactRecord(index, values)
+            elif len(mv_fieldnames) == 0:
+                for values in reader:
+                    yield OrderedDict(izip(fieldnames, values))
+            else:
+                for values in reader:
+                    record = OrderedDict()
+                    for fieldname, value in izip(fieldnames, values):
+                        if fieldname.startswith('__mv_'):
+                            if len(value) > 0:
+                                record[mv_fieldnames[fieldname]] = self._decode_list(value)
+                        elif fieldname not in record:
+                            record[fieldname] = value
+                    yield record
 
     def _report_unexpected_error(self):
 
@@ -1,39 +1,19 @@
 #!/usr/bin/env python
 
 import sys
-from splunklib import six
+import multiprocessing
+import time
 from splunklib.searchcommands import dispatch, ReportingCommand, Configuration, Option, validators
-import os
+from sirenelib.export import HEADER, XL2Export, format_header, render_chunk
+from sirenelib.metrics import StageMetrics
+from sirenelib.profiler import profiled
+from sirenelib.threads import threaded
+from sirenelib.validators import Date
 from datetime import date, timedelta, datetime
-import stat
-from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
-import time
-try:
-    import zlib
-    compression = ZIP_DEFLATED
-except:
-    compression = ZIP_STORED
-
 
-class Date(validators.Validator):
-    """ Validates Date option values.
 
-    """
-
-    def __call__(self, value):
-        if value is None:
-            return None
-
-        try:
-            datetime.strptime(value, '%Y-%m-%d')
-            return value
-        except ValueError:
-            raise ValueError('Unrecognized date value: {0}. Should be AAAA-MM-JJ'.format(value))
-
-    def format(self, value):
-        if value is None:
-            return None
-        return six.text_type(value)
+class ExceptionDateParameter(Exception):
+    pass
 
 
 @Configuration(requires_preop=True, run_in_preview=False)
@@ -42,62 +22,110 @@ class XL2Command(ReportingCommand):
 
     ##Syntax
 
-    xl2
+    xl2 [dtr=date_to_retrieve] [dtr_start=first_date dtr_end=last_date] [workers=n]
+    [profile=true [profile_memory=true]]
 
     ##Description
 
     This command writes events to CSV file
 
+    With dtr_start and dtr_end the events are split by the day of their DATEMAJ field and a file is written for each
+    day of the range
+
+    With more than one worker, the chunks of events received by map() are parsed and formatted by a pool of worker
+    processes while the rows are written in the order of the chunks
+
+    The time spent and the counts of the reading, formatting, writing and commits of the events are reported in the
+    Job Inspector
+
+    With profile=true each of map() and reduce() gets a profile of its own, profile_memory=true as for insee
+
     """
     dtr = Option(require=False, validate=Date())
-    header = ['SIREN','NIC','L1_NORMALISEE','L2_NORMALISEE','L3_NORMALISEE','L4_NORMALISEE','L5_NORMALISEE',
-              'L6_NORMALISEE','L7_NORMALISEE','L1_DECLAREE','L2_DECLAREE','L3_DECLAREE','L4_DECLAREE',
-              'L5_DECLAREE','L6_DECLAREE','L7_DECLAREE','NUMVOIE','INDREP','TYPVOIE','LIBVOIE','CODPOS','CEDEX',
-              'RPET','LIBREG','DEPET','ARRONET','CTONET','COMET','LIBCOM','DU','TU','UU','EPCI','TCD','ZEMET',
-              'SIEGE','ENSEIGNE','IND_PUBLIPO','DIFFCOM','AMINTRET','NATETAB','LIBNATETAB','APET700','LIBAPET',
-              'DAPET','TEFET','LIBTEFET','EFETCENT','DEFET','ORIGINE','DCRET','DDEBACT','ACTIVNAT','LIEUACT',
-              'ACTISURF','SAISONAT','MODET','PRODET','PRODPART','AUXILT','NOMEN_LONG','SIGLE','NOM','PRENOM',
-              'CIVILITE','RNA','NICSIEGE','RPEN','DEPCOMEN','ADR_MAIL','NJ','LIBNJ','APEN700','LIBAPEN','DAPEN',
-              'APRM','ESS','DATEESS','TEFEN','LIBTEFEN','EFENCENT','DEFEN','CATEGORIE','DCREN','AMINTREN',
-              'MONOACT','MODEN','PRODEN','ESAANN','TCA','ESAAPEN','ESASEC1N','ESASEC2N','ESASEC3N','ESASEC4N',
-              'VMAJ','VMAJ1','VMAJ2','VMAJ3','DATEMAJ','EVE','DATEVE','TYPCREH','DREACTET','DREACTEN',
-              'MADRESSE','MENSEIGNE','MAPET','MPRODET','MAUXILT','MNOMEN','MSIGLE','MNICSIEGE','MNJ','MAPEN',
-              'MPRODEN','SIRETPS','TEL']
+    dtr_start = Option(require=False, validate=Date())
+    dtr_end = Option(require=False, validate=Date())
+    workers = Option(require=False, validate=validators.Integer(minimum=1, maximum=8), default=1)
+    profile = Option(require=False, validate=validators.Boolean())
+    profile_memory = Option(require=False, validate=validators.Boolean())
+    header = HEADER
+    # The events of 130 columns are only read, the values of an event with the field index of its chunk use less memory
+    # than a dictionary per event
+    compact_records = True
+    # Number of events between two commits of the export manifest
+    commit_interval = 10000
+    # Chunks dispatched to the workers and not written yet, per worker
+    queue_size = 4
 
     def return_header(self):
-        return ''.join(map(lambda x: '"%s";' % x, self.header))[:-1]
+        return format_header()
+
+    def get_days(self):
+        # A range of days has been set
+        if self.dtr_start or self.dtr_end:
+            if not self.dtr_start or not self.dtr_end or self.dtr:
+                self.logger.error('  dtr_start and dtr_end must be set together and without dtr')
+                raise ExceptionDateParameter('dtr_start and dtr_end must be set together and without dtr')
+            start = datetime.strptime(self.dtr_start, '%Y-%m-%d').date()
+            end = datetime.strptime(self.dtr_end, '%Y-%m-%d').date()
+            if end < start:
+                self.logger.error('  dtr_end %s is before dtr_start %s', self.dtr_end, self.dtr_start)
+                raise ExceptionDateParameter('dtr_end is before dtr_start')
+            return [(start + timedelta(i)).strftime('%Y-%m-%d') for i in xrange((end - start).days + 1)]
+        if self.dtr:
+            return [self.dtr]
+        return [(date.today() - timedelta(1)).strftime('%Y-%m-%d')]
+
+    def get_export(self, exports, dtr, sid):
+        xl2_export = exports.get(dtr)
+        if xl2_export is None:
+            xl2_export = XL2Export(dtr, self.logger)
+            manifest = xl2_export.read_manifest()
+            if manifest and manifest['sid'] == sid:
+                xl2_export.resume(manifest)
+            else:
+                xl2_export.start(sid)
+            exports[dtr] = xl2_export
+        return xl2_export
+
+    def _execute(self, ifile, process):
+        # With several workers map() receives the chunks of events instead of the events
+        if self.phase == 'map' and self.workers > 1 and self._protocol_version == 2:
+            self._record_writer.write_records(self.map(self._chunks_protocol_v2(ifile)))
+            self.finish()
+            return
+        ReportingCommand._execute(self, ifile, process)
 
     @Configuration()
+    @profiled
     def map(self, events):
         try:
-            if self.dtr:
-                filename = self.dtr + '_'
-            else:
-                filename = (date.today() - timedelta(1)).strftime('%Y-%m-%d') + '_'
+            self.stage_metrics = StageMetrics()
+            days = self.get_days()
 
             # Log the requested date to help debugging
-            self.logger.info('  Function map() - dtr: %s', filename[:-1].encode('utf-8'))
+            self.logger.info('  Function map() - dtr: %s', ' '.join(days).encode('utf-8'))
             # Log the username to help debugging
             self.logger.info('  Function map() - Splunk username: %s',
                              self._metadata.searchinfo.username.encode('utf-8'))
 
-            csv_filename = '/data_out/insee/sirc-%s.csv' % filename
+            # map() can be called several times by the same search and then appends to the export
+            # Another search sends all the events again so the export starts over instead of appending to a stale file
+            sid = self._metadata.searchinfo.sid
+            exports = dict()
+
+            if self.workers > 1 and self._protocol_version == 2:
+                skipped = self.map_chunks(events, days, sid, exports)
+            else:
+                skipped = self.map_events(events, days, sid, exports)
+
+            for xl2_export in exports.values():
+                xl2_export.suspend()
 
-            first = True
+            if skipped:
+                self.logger.info('  Function map() - %d events outside of the days to export', skipped)
 
-            for event in events:
-                if first:
-                    self.logger.info('  Function map() - handle events')
-                    first = False
-                with open(csv_filename, 'a') as fd:
-                    first = True
-                    for e in self.header:
-                        if not first:
-                            fd.write(';')
-                        fd.write('"' + event[e] + '"')
-                        first = False
-                    fd.write('\n')
-                    fd.flush()
+            self.stage_metrics.log(self.logger)
+            self.stage_metrics.write(self)
 
         # This is a bad practise, but we want a specific message in log file
         # This case means that the code is missing an Exception handling
@@ -107,68 +135,110 @@ class XL2Command(ReportingCommand):
 
         yield {'dummy': 0}
 
+    def map_events(self, events, days, sid, exports):
+        skipped = 0
+        first = True
+        # Time spent waiting for the events, parsed from the chunks of Splunk, and writing them
+        reading = 0.0
+        writing = 0.0
+        written = 0
+
+        clock = time.time()
+        for event in events:
+            now = time.time()
+            reading += now - clock
+            clock = now
+            if first:
+                self.logger.info('  Function map() - handle events')
+                first = False
+            # A single day receives all the events, a range dispatches them by their DATEMAJ
+            dtr = days[0] if len(days) == 1 else event['DATEMAJ'][:10]
+            xl2_export = exports.get(dtr)
+            if xl2_export is None:
+                if dtr not in days:
+                    skipped += 1
+                    continue
+                xl2_export = self.get_export(exports, dtr, sid)
+            xl2_export.write(event)
+            written += 1
+            if xl2_export.records % self.commit_interval == 0:
+                with self.stage_metrics.timer('commit'):
+                    xl2_export.commit()
+            clock = time.time()
+            writing += clock - now
+
+        self.stage_metrics.add('read', reading, written + skipped, 0, written + skipped)
+        self.stage_metrics.add('write', writing, written, written, written)
+        return skipped
+
+    def map_chunks(self, chunks, days, sid, exports):
+        """
+            Format the chunks of events on a pool of workers and write their rows in the order of the chunks.
+
+            A thread reads the chunks and hands them to the pool, the main thread writes the rows of each chunk so that
+            the reading, formatting and writing of the chunks overlap. At most queue_size chunks per worker are in
+            progress.
+        """
+        self.logger.info('  Function map() - handle chunks of events with %d workers', self.workers)
+        # The pool is forked before the reading thread is started
+        pool = multiprocessing.Pool(self.workers)
+        skipped = 0
+        try:
+            for result in threaded([self.submit_chunks(pool, chunks, days)], self.queue_size * self.workers):
+                # The chunk is formatted by the pool, this is the time the writer waits for it
+                with self.stage_metrics.timer('render'):
+                    rows, chunk_skipped = result.get()
+                skipped += chunk_skipped
+                for dtr, data, count, last_siret in rows:
+                    xl2_export = self.get_export(exports, dtr, sid)
+                    committed = xl2_export.records // self.commit_interval
+                    with self.stage_metrics.timer('write', count, len(data)):
+                        xl2_export.write_rows(data, count, last_siret)
+                    if xl2_export.records // self.commit_interval != committed:
+                        with self.stage_metrics.timer('commit'):
+                            xl2_export.commit()
+        finally:
+            pool.terminate()
+            pool.join()
+        return skipped
+
+    def submit_chunks(self, pool, chunks, days):
+        """Yield the results of the chunks handed to the pool, in the order of the chunks."""
+        clock = time.time()
+        for body in chunks:
+            if isinstance(body, memoryview):
+                body = body.tobytes()
+            self.stage_metrics.add('read', time.time() - clock, output_count=len(body))
+            yield pool.apply_async(render_chunk, (body, days))
+            clock = time.time()
+
+    @profiled
     def reduce(self, records):
-        zip_filename = 'Not ZIP file generated. Error during creation.'
-        counter = 0
+        zip_filenames = dict()
+        counters = dict()
         try:
-            if self.dtr:
-                filename = self.dtr + '_' + datetime.now().strftime('%Y%m%d%H%M%S')
-                old_filename = self.dtr + '_'
-            else:
-                filename = (date.today() - timedelta(1)).strftime('%Y-%m-%d') + '_' + \
-                           datetime.now().strftime('%Y%m%d%H%M%S')
-                old_filename = (date.today() - timedelta(1)).strftime('%Y-%m-%d') + '_'
+            self.stage_metrics = StageMetrics()
+            days = self.get_days()
 
             # Log the requested date to help debugging
-            self.logger.info('  Function reduce() - dtr: %s', old_filename[:-1].encode('utf-8'))
+            self.logger.info('  Function reduce() - dtr: %s', ' '.join(days).encode('utf-8'))
             # Log the username to help debugging
             self.logger.info('  Function reduce() - Splunk username: %s',
                              self._metadata.searchinfo.username.encode('utf-8'))
 
-            csv_filename = '/data_out/insee/sirc-%s.csv' % filename
-            old_csv_filename = '/data_out/insee/sirc-%s.csv' % old_filename
+            exports = [XL2Export(dtr, self.logger) for dtr in days]
 
             for _ in records:
-                if os.path.exists(old_csv_filename):
-                    with open(old_csv_filename, 'r') as fin:
-                        with open(csv_filename, 'w') as fout:
-                            self.logger.info('  Function reduce() - copy to filename: %s',
-                                             csv_filename.encode('utf-8'))
-                            fout.write(self.return_header())
-                            fout.write('\n')
-                            for line in fin.readlines():
-                                fout.write(line)
-                                counter += 1
-
-                    time.sleep(1)
-
-                    # Delete the first CSV file
-                    if os.path.exists(old_csv_filename):
-                        os.remove(old_csv_filename)
-                        self.logger.info('  Function reduce() - delete filename: %s',
-                                         old_csv_filename.encode('utf-8'))
-
-                    if self.dtr:
-                        zip_filename = '/data_out/insee/' + 'sirene_' + ''.join(self.dtr.split('-')) + '.zip'
-                    else:
-                        zip_filename = '/data_out/insee/' + 'sirene_' + (date.today() - timedelta(1)).strftime('%Y%m%d') + '.zip'
-
-                    if os.path.exists(csv_filename):
-                        # ZIP the file
-                        with ZipFile(zip_filename, mode='w', compression=compression, allowZip64=True) as zip_file:
-                            self.logger.info('  Function reduce() - zip filename creation: %s',
-                                             zip_filename.encode('utf-8'))
-                            zip_file.write(csv_filename, arcname='sirc-%s.csv' % filename)
-
-                        time.sleep(1)
-
-                        # Give RW to the UNIX group
-                        os.chmod(zip_filename, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP)
-
-                        # Delete the CSV file
-                        os.remove(csv_filename)
-                        self.logger.info('  Function reduce() - delete filename: %s',
-                                         csv_filename.encode('utf-8'))
+                for xl2_export in exports:
+                    manifest = xl2_export.read_manifest()
+                    if manifest and manifest['sid'] == self._metadata.searchinfo.sid:
+                        xl2_export.resume(manifest)
+                        with self.stage_metrics.timer('close', xl2_export.records, 1):
+                            zip_filenames[xl2_export.dtr] = xl2_export.close()
+                        counters[xl2_export.dtr] = xl2_export.records
+
+            self.stage_metrics.log(self.logger)
+            self.stage_metrics.write(self)
 
         # This is a bad practise, but we want a specific message in log file
         # This case means that the code is missing an Exception handling
@@ -176,9 +246,12 @@ class XL2Command(ReportingCommand):
             self.logger.error('  unhandled exception has occurred. Traceback is in splunklib.log: %s', e.message)
             raise
 
-        self.logger.info('  wrote %d records in file', counter)
-
-        yield {'dtr': old_filename[:-1], 'file': zip_filename, 'records': counter}
+        # One result per day, in date order
+        for dtr in days:
+            counter = counters.get(dtr, 0)
+            self.logger.info('  wrote %d records in file', counter)
+            yield {'dtr': dtr, 'file': zip_filenames.get(dtr, 'Not ZIP file generated. Error during creation.'),
+                   'records': counter}
 
 
 dispatch(XL2Command, sys.argv, sys.stdin, sys.stdout, __name__)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import sys
+import json
+import os
+import time
+from splunklib.searchcommands import dispatch, GeneratingCommand, Configuration, Option, validators
+from sirenelib.diff import ExceptionDiff, XL2Diff, modification_flags
+from sirenelib.export import OUTPUT_DIRECTORY, output_path
+
+
+class ExceptionFile(Exception):
+    pass
+
+
+@Configuration(type='events')
+class XL2DIFFCommand(GeneratingCommand):
+    """ Synopsis
+
+    ##Syntax
+
+    | xl2diff old=sirene_20190101.zip new=sirene_20200101.zip [partitions=n]
+
+    ##Description
+
+    Compare two XL2 files, zipped or CSV, and return an event for each added, removed or changed establishment. The
+    files are named relative to the output directory of the exports
+
+    Both files are spread by SIRET over partitions on disk and compared one partition at a time, so that memory stays
+    bounded whatever the size of the files. Changed establishments carry the M* indicators of the XL2 format
+
+    """
+    old = Option(require=True)
+    new = Option(require=True)
+    partitions = Option(require=False, validate=validators.Integer(minimum=1, maximum=4096))
+
+    def generate(self):
+        try:
+            # Log the username to help debugging
+            self.logger.info('  Splunk username: %s', self._metadata.searchinfo.username.encode('utf-8'))
+
+            filenames = list()
+            for name in (self.old, self.new):
+                filename = output_path(name)
+                if filename is None:
+                    self.logger.error('  file %s is not in %s', name, OUTPUT_DIRECTORY)
+                    raise ExceptionFile('File {0} must be a relative path in {1}'.format(name, OUTPUT_DIRECTORY))
+                if not os.path.isfile(filename):
+                    self.logger.error('  file %s does not exist', filename)
+                    raise ExceptionFile('File {0} does not exist'.format(name))
+                filenames.append(filename)
+
+            event = 1
+            diff = XL2Diff(self.logger, partitions=self.partitions)
+            for mouvement, siret, old_row, new_row, changed in diff.run(*filenames):
+                record = {'_time': time.time(), 'event_no': event, 'SIRET': siret, 'MOUVEMENT': mouvement}
+                if mouvement == 'modification':
+                    columns = sorted(changed)
+                    record['COLONNES'] = ','.join(columns)
+                    record.update(modification_flags(changed))
+                    record['_raw'] = json.dumps({'avant': dict((c, old_row[c]) for c in columns),
+                                                 'apres': dict((c, new_row[c]) for c in columns)}, sort_keys=True)
+                else:
+                    record['_raw'] = json.dumps(new_row or old_row, sort_keys=True)
+                yield record
+                event += 1
+
+            self.logger.info('  generated %d events', event-1)
+
+        except (ExceptionFile, ExceptionDiff):
+            raise
+
+        # This is a bad practise, but we want a specific message in log file
+        # This case means that the code is missing an Exception handling
+        except Exception as e:
+            self.logger.error('  unhandled exception has occurred. Traceback is in splunklib.log: %s', e.message)
+            raise
+
+
+dispatch(XL2DIFFCommand, sys.argv, sys.stdin, sys.stdout, __name__)
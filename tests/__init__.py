@@ -0,0 +1,14 @@
+# coding: utf-8
+"""
+    Tests of the search commands of the app and of their libraries, run from the root of the app with:
+
+        python -m unittest discover -s tests -t .
+"""
+
+import os
+import sys
+import tempfile
+
+# The modules of bin/ compute their default directories from SPLUNK_HOME when they are imported
+os.environ.setdefault('SPLUNK_HOME', tempfile.mkdtemp())
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin'))
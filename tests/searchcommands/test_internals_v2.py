@@ -0,0 +1,155 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import csv
+import json
+import re
+import time
+from unittest import TestCase, main
+
+from splunklib.six import StringIO
+from splunklib.searchcommands.internals import CompactRecord, CsvDialect, RecordWriterV2
+
+
+def read_chunks(output):
+    """Return the metadata and the number of records of each chunk written by a RecordWriterV2."""
+    chunks = list()
+    data = output.getvalue()
+    position = 0
+    header = re.compile(r'chunked 1\.0,(\d+),(\d+)\n')
+    while position < len(data):
+        match = header.match(data, position)
+        position = match.end()
+        metadata_length, body_length = int(match.group(1)), int(match.group(2))
+        metadata = json.loads(data[position:position + metadata_length]) if metadata_length else dict()
+        body = data[position + metadata_length:position + metadata_length + body_length]
+        position += metadata_length + body_length
+        # The first line of a body holds the field names
+        chunks.append((metadata, max(len(body.splitlines()) - 1, 0)))
+    return chunks
+
+
+class TestCompactRecord(TestCase):
+
+    def setUp(self):
+        self.record = CompactRecord({'_time': 0, 'siret': 1, 'nic': 2}, ['1555149600', '12345678900011', '00011'])
+
+    def test_lookup(self):
+        self.assertEqual(self.record['siret'], '12345678900011')
+        self.assertIn('nic', self.record)
+        self.assertNotIn('siren', self.record)
+        self.assertEqual(self.record.get('siren', ''), '')
+        self.assertRaises(KeyError, self.record.__getitem__, 'siren')
+
+    def test_iteration(self):
+        self.assertEqual(len(self.record), 3)
+        self.assertEqual(sorted(self.record.keys()), ['_time', 'nic', 'siret'])
+        self.assertEqual(dict(self.record.items()), {'_time': '1555149600', 'siret': '12345678900011',
+                                                     'nic': '00011'})
+        self.assertEqual(sorted(self.record.values()), sorted(['1555149600', '12345678900011', '00011']))
+
+    def test_shared_index(self):
+        index = {'siret': 0}
+        records = [CompactRecord(index, [siret]) for siret in ('12345678900011', '12345678900012')]
+        self.assertEqual([record['siret'] for record in records], ['12345678900011', '12345678900012'])
+
+
+class TestFlushPolicy(TestCase):
+
+    def writer(self, maxresultrows=None, mark_partial=False, **policy):
+        self.output = StringIO()
+        writer = RecordWriterV2(self.output, maxresultrows)
+        writer.mark_partial = mark_partial
+        for name, value in policy.items():
+            setattr(writer, name, value)
+        return writer
+
+    def test_flush_size(self):
+        writer = self.writer(mark_partial=True, flush_size=100)
+        for i in range(10):
+            writer.write_record({'siret': '123456789%05d' % i, 'nic': '%05d' % i})
+        writer.flush(finished=True)
+        chunks = read_chunks(self.output)
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(sum(count for _, count in chunks), 10)
+        self.assertTrue(all(metadata.get('partial') for metadata, _ in chunks[:-1]))
+        self.assertNotIn('partial', chunks[-1][0])
+        self.assertTrue(chunks[-1][0]['finished'])
+
+    def test_partial_is_only_sent_by_generating_commands(self):
+        writer = self.writer(flush_size=100)
+        for i in range(10):
+            writer.write_record({'siret': '123456789%05d' % i})
+        writer.flush(finished=True)
+        self.assertFalse(any('partial' in metadata for metadata, _ in read_chunks(self.output)))
+
+    def test_maxresultrows_is_not_marked_partial(self):
+        writer = self.writer(maxresultrows=2, mark_partial=True)
+        for i in range(5):
+            writer.write_record({'siret': '123456789%05d' % i})
+        writer.flush(finished=True)
+        chunks = read_chunks(self.output)
+        self.assertEqual([count for _, count in chunks], [2, 2, 1])
+        self.assertFalse(any('partial' in metadata for metadata, _ in chunks))
+
+    def test_flush_interval(self):
+        writer = self.writer(mark_partial=True, flush_interval=0.05)
+        writer.write_record({'siret': '12345678900011'})
+        time.sleep(0.1)
+        # The record buffered before the wait goes out before the next one is written
+        writer.write_record({'siret': '12345678900012'})
+        self.assertEqual(read_chunks(self.output), [({'finished': False, 'partial': True}, 1)])
+        writer.flush(finished=True)
+        self.assertEqual(read_chunks(self.output)[1:], [({'finished': True}, 1)])
+
+    def test_flush_partial(self):
+        writer = self.writer(mark_partial=True)
+        writer.write_record({'siret': '12345678900011'})
+        # Without flush_interval the records wait for the end of the chunk
+        writer.flush_partial()
+        self.assertEqual(self.output.getvalue(), '')
+
+        writer.flush_interval = 60
+        writer.flush_partial()
+        self.assertEqual(read_chunks(self.output), [({'finished': False, 'partial': True}, 1)])
+        writer.flush_partial()
+        self.assertEqual(len(read_chunks(self.output)), 1)
+
+
+class TestFlatRecords(TestCase):
+
+    def assertSameRows(self, records):
+        """The rows of the fast path are the ones of _format_values followed by the csv.writer."""
+        writer = RecordWriterV2(StringIO())
+        writer.write_records(records)
+        expected = StringIO()
+        rows = csv.writer(expected, dialect=CsvDialect)
+        fieldnames = list(records[0].keys())
+        rows.writerow([name for fieldname in fieldnames for name in (fieldname, '__mv_' + fieldname)])
+        for record in records:
+            rows.writerow(writer._format_values(record, fieldnames))
+        self.assertEqual(writer._buffer.getvalue(), expected.getvalue())
+        return writer
+
+    def test_scalars(self):
+        records = [{'siret': '12345678900011', 'ENSEIGNE': u'Café', 'EFFECTIF': 3, 'LATITUDE': 48.85, 'SIEGE': True}]
+        for value in ('Le "Comptoir"', 'a,b', 'ligne 1\nligne 2', 'ligne 1\rligne 2', u'Crêperie « Ker-Is »', '',
+                      u'\u2019', ' espaces '):
+            records.append({'siret': '12345678900012', 'ENSEIGNE': value, 'EFFECTIF': -1, 'LATITUDE': 1e-7,
+                            'SIEGE': False})
+        self.assertIsNotNone(self.assertSameRows(records)._schema)
+
+    def test_records_unlike_the_first_one(self):
+        self.assertSameRows([{'siret': '12345678900011', 'ENSEIGNE': 'A', 'EFFECTIF': 3},
+                             {'siret': '12345678900012', 'ENSEIGNE': None, 'EFFECTIF': 3},
+                             {'siret': '12345678900013', 'ENSEIGNE': True, 'EFFECTIF': '3'},
+                             {'siret': '12345678900014', 'ENSEIGNE': ['A', 'B'], 'EFFECTIF': 3.5},
+                             {'siret': '12345678900015', 'EFFECTIF': 3},
+                             {'siret': '12345678900016', 'ENSEIGNE': u'Café "Le Comptoir"', 'EFFECTIF': 3}])
+        # Without a fast path when the first record has a value that is not a scalar
+        self.assertSameRows([{'siret': '12345678900011', 'ENSEIGNE': None},
+                             {'siret': '12345678900012', 'ENSEIGNE': 'A,B'}])
+
+
+if __name__ == '__main__':
+    main()
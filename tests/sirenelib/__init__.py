@@ -0,0 +1,32 @@
+# coding: utf-8
+"""
+    Fixtures shared by the tests of sirenelib.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sirenelib.export import HEADER
+
+
+def xl2_record(nic, **values):
+    """Return the XL2 record of the establishment 123456789<nic>, empty but for the values given."""
+    record = dict((column, '') for column in HEADER)
+    record.update(SIREN='123456789', NIC='%05d' % nic)
+    record.update(values)
+    return record
+
+
+class DirectoryTestCase(TestCase):
+    """Test case writing its files in a temporary directory, removed at the end of each test."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.logger = logging.getLogger('test')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
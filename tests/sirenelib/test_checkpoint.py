@@ -0,0 +1,50 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+from unittest import main
+
+from sirenelib.checkpoint import Checkpoint
+from tests.sirenelib import DirectoryTestCase
+
+
+class TestCheckpoint(DirectoryTestCase):
+
+    def siege(self, code_commune):
+        return {'siret': '12345678900000', 'adresseEtablissement': {'codeCommuneEtablissement': code_commune,
+                                                                    'codePaysEtrangerEtablissement': None}}
+
+    def test_round_trip(self):
+        checkpoint = Checkpoint('insee_2019-04-13', self.logger, self.directory)
+        self.assertIsNone(checkpoint.load())
+        checkpoint.start()
+        checkpoint.add_sieges({'12345678900000': self.siege('75102')})
+        checkpoint.save(curseur='A', pages=1, events=10)
+        # Headquarters added after the last save are dropped on load
+        checkpoint.add_sieges({'98765432100000': self.siege('69123')})
+        checkpoint.fd.flush()
+
+        checkpoint = Checkpoint('insee_2019-04-13', self.logger, self.directory)
+        state = checkpoint.load()
+        self.assertEqual((state['curseur'], state['pages'], state['events']), ('A', 1, 10))
+        self.assertEqual(list(checkpoint.sieges), ['12345678900000'])
+        self.assertEqual(checkpoint.sieges['12345678900000']['adresseEtablissement']['codeCommuneEtablissement'],
+                         '75102')
+
+        checkpoint.remove()
+        self.assertIsNone(Checkpoint('insee_2019-04-13', self.logger, self.directory).load())
+
+    def test_last_sieges_reloaded(self):
+        checkpoint = Checkpoint('insee_2019-04-13', self.logger, self.directory, sieges_size=2)
+        checkpoint.start()
+        for siret in ('12345678900000', '23456789100000', '34567891200000', '12345678900000'):
+            checkpoint.add_sieges({siret: self.siege('75102')})
+        self.assertEqual(checkpoint.sieges, {})
+        checkpoint.save(curseur='A', pages=3, events=30)
+
+        checkpoint = Checkpoint('insee_2019-04-13', self.logger, self.directory, sieges_size=2)
+        checkpoint.load()
+        self.assertEqual(list(checkpoint.sieges), ['34567891200000', '12345678900000'])
+
+
+if __name__ == '__main__':
+    main()
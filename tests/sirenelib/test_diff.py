@@ -0,0 +1,55 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import csv
+import os
+from unittest import main
+
+from sirenelib.diff import ExceptionDiff, XL2Diff, open_csv
+from sirenelib.export import HEADER
+from tests.sirenelib import DirectoryTestCase, xl2_record
+
+
+class TestXL2Diff(DirectoryTestCase):
+
+    def xl2_file(self, name, records):
+        filename = os.path.join(self.directory, name)
+        with open_csv(filename, 'w') as fd:
+            writer = csv.writer(fd, delimiter=';', quotechar='"')
+            writer.writerow(HEADER)
+            for record in records:
+                writer.writerow([record[column] for column in HEADER])
+        return filename
+
+    def diff(self, old, new):
+        diff = XL2Diff(self.logger, partitions=4, directory=self.directory)
+        old = self.xl2_file('old.csv', old)
+        new = self.xl2_file('new.csv', new)
+        return diff, dict((siret, (mouvement, changed)) for mouvement, siret, _, _, changed in diff.run(old, new))
+
+    def test_differences(self):
+        old = [xl2_record(nic, ENSEIGNE='A', AMINTRET='201901') for nic in range(1, 21)]
+        new = [xl2_record(nic, ENSEIGNE='A', AMINTRET='202001') for nic in range(3, 23)]
+        # Changed columns, and only the computed columns and M* flags of the file
+        new[0].update(ENSEIGNE='B', APET700='5610A')
+        new[1].update(AMINTREN='202001', MENSEIGNE='1', MADRESSE='1')
+
+        diff, differences = self.diff(old, new)
+        self.assertEqual(differences, {'12345678900001': ('suppression', set()),
+                                       '12345678900002': ('suppression', set()),
+                                       '12345678900003': ('modification', set(['ENSEIGNE', 'APET700'])),
+                                       '12345678900021': ('ajout', set()),
+                                       '12345678900022': ('ajout', set())})
+        self.assertEqual(diff.counters, {'ajout': 2, 'suppression': 2, 'modification': 1, 'identique': 17})
+        # Work files are removed
+        self.assertEqual(sorted(os.listdir(self.directory)), ['new.csv', 'old.csv'])
+
+    def test_duplicated_siret(self):
+        for old, new in (([xl2_record(1), xl2_record(1)], [xl2_record(1)]),
+                         ([xl2_record(1)], [xl2_record(1), xl2_record(2), xl2_record(1, ENSEIGNE='B')])):
+            with self.assertRaises(ExceptionDiff):
+                self.diff(old, new)
+
+
+if __name__ == '__main__':
+    main()
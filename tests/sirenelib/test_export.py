@@ -0,0 +1,76 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import json
+import os
+from unittest import main
+from zipfile import ZipFile
+
+from sirenelib.export import XL2Export, output_path
+from tests.sirenelib import DirectoryTestCase, xl2_record
+
+
+class TestXL2Export(DirectoryTestCase):
+
+    def export(self):
+        return XL2Export('2019-04-13', self.logger, self.directory)
+
+    def test_resume_drops_the_rows_after_the_last_commit(self):
+        export = self.export()
+        export.start(sid='1')
+        export.write(xl2_record(1))
+        export.write(xl2_record(2))
+        export.commit(curseur='A')
+        # Written but never committed, as when the search is stopped
+        export.write(xl2_record(3))
+        export.fd.close()
+
+        export = self.export()
+        manifest = export.read_manifest()
+        self.assertEqual((manifest['records'], manifest['last_siret'], manifest['curseur']),
+                         (2, '12345678900002', 'A'))
+        export.resume(manifest, sid='2')
+        export.write(xl2_record(4))
+        filename = export.close()
+
+        self.assertEqual(filename, os.path.join(self.directory, 'sirene_20190413.zip'))
+        with ZipFile(filename) as zip_file:
+            lines = zip_file.read(zip_file.namelist()[0]).decode('utf-8').splitlines()
+        self.assertEqual([line.split(';')[1] for line in lines[1:]], ['"00001"', '"00002"', '"00004"'])
+        self.assertEqual(sorted(os.listdir(self.directory)), ['sirene_20190413.zip'])
+
+    def test_manifest_of_a_corrupted_file(self):
+        export = self.export()
+        export.start()
+        export.write(xl2_record(1))
+        export.commit()
+        export.fd.close()
+        with open(export.part_filename, 'r+b') as fd:
+            fd.write(b'X')
+        self.assertIsNone(self.export().read_manifest())
+
+    def test_manifest_of_another_day(self):
+        export = self.export()
+        export.start()
+        export.commit()
+        export.fd.close()
+        with open(export.manifest_filename, 'r') as fd:
+            manifest = json.load(fd)
+        manifest['dtr'] = '2019-04-14'
+        with open(export.manifest_filename, 'w') as fd:
+            json.dump(manifest, fd)
+        self.assertIsNone(self.export().read_manifest())
+
+
+class TestOutputPath(DirectoryTestCase):
+
+    def test_paths(self):
+        os.symlink('/etc', os.path.join(self.directory, 'etc'))
+        self.assertEqual(output_path('sirene_20190413.zip', self.directory),
+                         os.path.join(os.path.realpath(self.directory), 'sirene_20190413.zip'))
+        for name in ('', '/etc/passwd', '../sirene_20190413.zip', 'a/../../sirene_20190413.zip', 'etc/passwd'):
+            self.assertIsNone(output_path(name, self.directory), name)
+
+
+if __name__ == '__main__':
+    main()
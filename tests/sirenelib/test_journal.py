@@ -0,0 +1,58 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import json
+import os
+from unittest import main
+
+from sirenelib.journal import Journal
+from tests.sirenelib import DirectoryTestCase
+
+
+def page(curseur, *sirets):
+    return json.dumps({'header': {'curseur': curseur},
+                       'etablissements': [{'siret': siret} for siret in sirets]}).encode('utf-8')
+
+
+class TestJournal(DirectoryTestCase):
+
+    def test_round_trip(self):
+        journal = Journal('2019-04-13', self.logger, self.directory)
+        journal.record(page('*', '12345678900011'), 'siret', key='*')
+        journal.record(page('A', '12345678900012'), 'siret', key='A')
+        journal.record(page(None, '12345678900000'), 'siege', sirets=['12345678900000'])
+
+        journal = Journal('2019-04-13', self.logger, self.directory)
+        self.assertEqual(len(journal), 3)
+        self.assertEqual(journal.read_page('A')['etablissements'], [{'siret': '12345678900012'}])
+        self.assertIsNone(journal.read_page('B'))
+        self.assertEqual(list(journal.read_sieges(['12345678900000', '99999999900000'])), ['12345678900000'])
+        self.assertFalse(journal.complete)
+
+    def test_compact(self):
+        journal = Journal('2019-04-13', self.logger, self.directory)
+        journal.record(page('*', '12345678900011'), 'siret', key='*')
+        # A page fetched again for the same cursor replaces the previous one
+        journal.record(page('*', '12345678900012'), 'siret', key='*')
+        journal.record(page(None, '12345678900000'), 'siege', sirets=['12345678900000'])
+        journal.compact()
+
+        journal = Journal('2019-04-13', self.logger, self.directory)
+        self.assertTrue(journal.complete)
+        self.assertEqual(len(journal), 2)
+        self.assertEqual(journal.read_page('*')['etablissements'], [{'siret': '12345678900012'}])
+        self.assertIn('12345678900000', journal.read_sieges(['12345678900000']))
+        self.assertEqual([f for f in os.listdir(journal.directory) if f.endswith('.json.gz')], [])
+
+    def test_line_cut_by_a_crash(self):
+        journal = Journal('2019-04-13', self.logger, self.directory)
+        journal.record(page('*', '12345678900011'), 'siret', key='*')
+        with open(journal.index_filename, 'ab') as fd:
+            fd.write(b'{"kind": "siret", "ke')
+
+        journal = Journal('2019-04-13', self.logger, self.directory)
+        self.assertEqual(len(journal), 1)
+
+
+if __name__ == '__main__':
+    main()
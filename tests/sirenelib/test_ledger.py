@@ -0,0 +1,40 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import os
+from unittest import main
+
+from sirenelib.ledger import Ledger
+from tests.sirenelib import DirectoryTestCase
+
+
+class TestLedger(DirectoryTestCase):
+
+    def setUp(self):
+        DirectoryTestCase.setUp(self)
+        self.filename = os.path.join(self.directory, 'insee', 'ledger.json')
+
+    def test_round_trip(self):
+        ledger = Ledger(self.logger, self.filename)
+        ledger.add('2019-04-13', records=2500, pages=3, requests=6, filename='sirene_20190413.zip')
+        ledger.count(4)
+
+        ledger = Ledger(self.logger, self.filename)
+        self.assertIn('2019-04-13', ledger)
+        self.assertNotIn('2019-04-14', ledger)
+        self.assertEqual(ledger.used_today(), 10)
+        self.assertEqual(ledger.cost(), 6)
+        self.assertEqual(ledger.requests_per_page(), 2.0)
+        self.assertEqual(ledger.missing('2019-04-12', '2019-04-14'), ['2019-04-12', '2019-04-14'])
+
+    def test_count_does_not_record_a_day(self):
+        ledger = Ledger(self.logger, self.filename)
+        ledger.count(5)
+        ledger = Ledger(self.logger, self.filename)
+        self.assertEqual(ledger.days, {})
+        self.assertEqual(ledger.used_today(), 5)
+        self.assertEqual(ledger.cost(), Ledger.default_cost)
+
+
+if __name__ == '__main__':
+    main()
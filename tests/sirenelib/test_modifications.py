@@ -0,0 +1,51 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import os
+from unittest import main
+
+from sirenelib.modifications import ModificationSnapshot
+from tests.sirenelib import DirectoryTestCase, xl2_record
+
+
+class Snapshot(ModificationSnapshot):
+    initial_bits = 4
+
+
+class TestModificationSnapshot(DirectoryTestCase):
+
+    def setUp(self):
+        DirectoryTestCase.setUp(self)
+        self.snapshot = Snapshot(self.logger, os.path.join(self.directory, 'modifications.bin'))
+
+    def tearDown(self):
+        self.snapshot.close()
+        DirectoryTestCase.tearDown(self)
+
+    def test_indicators(self):
+        self.assertEqual(self.snapshot.apply(xl2_record(1, APET700='56.10A'), '2019-04-13')['MAPET'], '')
+        self.assertEqual(self.snapshot.apply(xl2_record(1, APET700='47.11A'), '2019-04-14')['MAPET'], '1')
+        # A day exported again keeps the indicators computed the first time
+        self.assertEqual(self.snapshot.apply(xl2_record(1, APET700='47.11A'), '2019-04-14')['MAPET'], '1')
+        self.assertEqual(self.snapshot.apply(xl2_record(1, APET700='47.11A'), '2019-04-15')['MAPET'], '')
+
+    def test_reserve_grows_once(self):
+        self.snapshot.apply(xl2_record(1, APET700='56.10A'), '2019-04-13')
+        self.snapshot.reserve(100)
+        self.assertEqual(self.snapshot.slots, 256)
+        for nic in range(2, 101):
+            self.snapshot.apply(xl2_record(nic, APET700='56.10A'), '2019-04-13')
+        self.assertEqual((self.snapshot.slots, self.snapshot.count), (256, 100))
+
+    def test_grow_keeps_the_versions(self):
+        for nic in range(1, 101):
+            self.snapshot.apply(xl2_record(nic, APET700='56.10A'), '2019-04-13')
+        self.assertGreater(self.snapshot.slots, 16)
+        flags = [self.snapshot.apply(xl2_record(nic, APET700='47.11A' if nic % 2 else '56.10A'), '2019-04-14')['MAPET']
+                 for nic in range(1, 101)]
+        self.assertEqual(flags, ['1', ''] * 50)
+        self.assertEqual(self.snapshot.count, 100)
+
+
+if __name__ == '__main__':
+    main()
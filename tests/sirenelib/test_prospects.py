@@ -0,0 +1,58 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import os
+from unittest import main
+
+from sirenelib.prospects import ProspectSnapshot
+from tests.sirenelib import DirectoryTestCase
+
+
+class TestProspectSnapshot(DirectoryTestCase):
+
+    def snapshot(self):
+        return ProspectSnapshot(self.logger, os.path.join(self.directory, 'insee', 'prospects.json'))
+
+    def test_compare_and_remove(self):
+        snapshot = self.snapshot()
+        self.assertEqual(snapshot.compare('12345678900011', 'Code_NAF="5610A" '), 'nouveau')
+        self.assertIsNone(snapshot.compare('12345678900011', 'Code_NAF="5610A" '))
+        self.assertEqual(snapshot.compare('12345678900011', u'Code_NAF="5610A" Enseigne="Café" '), 'modifie')
+        self.assertTrue(snapshot.remove('12345678900011'))
+        self.assertFalse(snapshot.remove('12345678900011'))
+
+    def test_mouvement(self):
+        snapshot = self.snapshot()
+        snapshot.compare('12345678900011', 'Code_NAF="5610A" ')
+        snapshot.compare('12345678900012', 'Code_NAF="5610A" ')
+        # An active prospect, a new one, one closed and an establishment that never was a prospect
+        self.assertEqual(snapshot.mouvement('12345678900011', 'Code_NAF="5610C" '), 'modifie')
+        self.assertEqual(snapshot.mouvement('12345678900013', 'Code_NAF="5610A" '), 'nouveau')
+        self.assertEqual(snapshot.mouvement('12345678900012'), 'ferme')
+        self.assertIsNone(snapshot.mouvement('12345678900014'))
+        self.assertEqual(sorted(snapshot.prospects), ['12345678900011', '12345678900013'])
+
+    def test_save_and_load(self):
+        snapshot = self.snapshot()
+        self.assertFalse(snapshot.load())
+        snapshot.compare('12345678900011', 'Code_NAF="5610A" ')
+        snapshot.save(['56.10C', '56.10A'], '2019-04-13')
+
+        snapshot = self.snapshot()
+        self.assertTrue(snapshot.load())
+        self.assertEqual((snapshot.naf, snapshot.dtr), (['56.10A', '56.10C'], '2019-04-13'))
+        self.assertIsNone(snapshot.compare('12345678900011', 'Code_NAF="5610A" '))
+
+    def test_missing_days(self):
+        snapshot = self.snapshot()
+        self.assertEqual(snapshot.missing_days('2019-04-13'), ['2019-04-13'])
+        snapshot.dtr = '2019-04-13'
+        self.assertEqual(snapshot.missing_days('2019-04-14'), ['2019-04-14'])
+        self.assertEqual(snapshot.missing_days('2019-05-02'), ['2019-04-%d' % d for d in range(14, 31)] +
+                         ['2019-05-01', '2019-05-02'])
+        self.assertEqual(snapshot.missing_days('2019-04-13'), [])
+        self.assertEqual(snapshot.missing_days('2019-04-01'), [])
+
+
+if __name__ == '__main__':
+    main()
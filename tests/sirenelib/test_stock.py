@@ -0,0 +1,90 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import csv
+import io
+import os
+from unittest import main
+from zipfile import ZipFile
+
+from splunklib import six
+from sirenelib.stock import ExceptionStock, StockImporter, etablissement_from_stock
+from sirenelib.store import SireneStore
+from tests.sirenelib import DirectoryTestCase
+
+HEADER = ['siren', 'nic', 'siret', 'etablissementSiege', 'dateDernierTraitementEtablissement', 'dateDebut',
+          'etatAdministratifEtablissement', 'enseigne1Etablissement', 'enseigne2Etablissement',
+          'activitePrincipaleEtablissement', 'libelleVoieEtablissement', 'codeCommuneEtablissement',
+          'codePaysEtrangerEtablissement', 'libelleVoie2Etablissement', 'codeCommune2Etablissement']
+
+
+def stock_row(nic, commune='75102'):
+    return ['123456789', '%05d' % nic, '123456789%05d' % nic, 'true' if nic == 11 else 'false',
+            '2019-04-13T10:00:00', '2019-01-01', 'A', u'Café', 'Le Comptoir', '56.10A', 'de Rivoli', commune, '',
+            'des Halles', '75101']
+
+
+class TestStock(DirectoryTestCase):
+
+    def setUp(self):
+        DirectoryTestCase.setUp(self)
+        self.store = SireneStore(self.logger, os.path.join(self.directory, 'sirene.db'))
+
+    def tearDown(self):
+        self.store.close()
+        DirectoryTestCase.tearDown(self)
+
+    def zip_file(self, rows, header=HEADER, members=('StockEtablissement_utf8.csv',)):
+        fd = six.BytesIO() if six.PY2 else io.StringIO(newline='')
+        writer = csv.writer(fd)
+        for row in [header] + rows:
+            writer.writerow([value.encode('utf-8') for value in row] if six.PY2 else row)
+        filename = os.path.join(self.directory, 'StockEtablissement_utf8.zip')
+        with ZipFile(filename, 'w') as zip_file:
+            for member in members:
+                zip_file.writestr(member, fd.getvalue() if six.PY2 else fd.getvalue().encode('utf-8'))
+        return filename
+
+    def test_etablissement_from_stock(self):
+        etablissement = etablissement_from_stock(dict(zip(HEADER, stock_row(11))))
+        self.assertTrue(etablissement['etablissementSiege'])
+        self.assertEqual(etablissement['adresseEtablissement'],
+                         {'libelleVoieEtablissement': 'de Rivoli', 'codeCommuneEtablissement': '75102',
+                          'codePaysEtrangerEtablissement': None})
+        self.assertEqual(etablissement['adresse2Etablissement'],
+                         {'libelleVoie2Etablissement': 'des Halles', 'codeCommune2Etablissement': '75101'})
+        self.assertEqual(etablissement['periodesEtablissement'],
+                         [{'dateFin': None, 'dateDebut': '2019-01-01', 'etatAdministratifEtablissement': 'A',
+                           'enseigne1Etablissement': u'Café', 'enseigne2Etablissement': 'Le Comptoir',
+                           'activitePrincipaleEtablissement': '56.10A'}])
+        self.assertEqual(etablissement['siret'], '12345678900011')
+
+    def test_import(self):
+        filename = self.zip_file([stock_row(nic) for nic in (11, 12, 13)])
+        summary = StockImporter(self.store, self.logger, batch=2).run(filename)
+        self.assertEqual((summary['table'], summary['rows'], summary['imported']), ('etablissements', 3, 3))
+        self.assertEqual(self.store.count(), 3)
+        self.assertFalse(os.path.exists(self.store.filename + '.import.json'))
+
+        etablissement = next(self.store.find(siret='12345678900011'))
+        self.assertEqual(etablissement['periodesEtablissement'][0]['enseigne1Etablissement'], u'Café')
+
+    def test_resume(self):
+        filename = self.zip_file([stock_row(nic) for nic in (11, 12, 13)])
+        importer = StockImporter(self.store, self.logger)
+        # As if the import had been stopped after the first row
+        importer.save_checkpoint(filename, 1)
+        summary = importer.run(filename)
+        self.assertEqual((summary['rows'], summary['imported']), (3, 2))
+        self.assertEqual([e['siret'] for e in self.store.find()], ['12345678900012', '12345678900013'])
+
+    def test_invalid_files(self):
+        importer = StockImporter(self.store, self.logger)
+        with self.assertRaises(ExceptionStock):
+            importer.run(self.zip_file([], members=('a.csv', 'b.csv')))
+        with self.assertRaises(ExceptionStock):
+            importer.run(self.zip_file([['1']], header=['x']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import os
+from unittest import main
+
+from sirenelib.store import SireneStore, etablissement_row
+from tests.sirenelib import DirectoryTestCase
+
+
+def etablissement(date, commune='75102'):
+    return {'siret': '12345678900011', 'siren': '123456789', 'nic': '00011', 'etablissementSiege': False,
+            'dateDernierTraitementEtablissement': date,
+            'adresseEtablissement': {'codeCommuneEtablissement': commune, 'codePaysEtrangerEtablissement': None},
+            'periodesEtablissement': [{'activitePrincipaleEtablissement': '56.10A',
+                                       'etatAdministratifEtablissement': 'A'}],
+            'uniteLegale': {'nicSiegeUniteLegale': '00000', 'dateDernierTraitementUniteLegale': date}}
+
+
+class TestSireneStore(DirectoryTestCase):
+
+    def setUp(self):
+        DirectoryTestCase.setUp(self)
+        self.store = SireneStore(self.logger, os.path.join(self.directory, 'sirene.db'))
+
+    def tearDown(self):
+        self.store.close()
+        DirectoryTestCase.tearDown(self)
+
+    def stored(self):
+        return self.store.connection().execute('SELECT date_dernier_traitement, code_commune '
+                                               'FROM etablissements').fetchall()
+
+    def test_upsert_keeps_the_newest_version(self):
+        self.store.upsert([etablissement('2019-04-15T10:00:00', '75102')])
+        self.store.upsert([etablissement('2019-04-10T10:00:00', '69123')])
+        self.assertEqual(self.stored(), [('2019-04-15T10:00:00', '75102')])
+
+        self.store.upsert([etablissement('2019-04-16T10:00:00', '69123')])
+        self.assertEqual(self.stored(), [('2019-04-16T10:00:00', '69123')])
+        self.assertEqual(self.store.count(), 1)
+
+    def test_load_keeps_the_newest_version(self):
+        self.store.upsert([etablissement('2019-04-15T10:00:00', '75102')])
+        self.store.load('etablissements', [etablissement_row(etablissement('2019-01-01T00:00:00', '69123'))])
+        self.assertEqual(self.stored(), [('2019-04-15T10:00:00', '75102')])
+
+    def test_get_sieges(self):
+        self.store.upsert([etablissement('2019-04-15T10:00:00')])
+        sieges = self.store.get_sieges(['12345678900011', '98765432100000'])
+        self.assertEqual(sieges, {'12345678900011': {'adresseEtablissement': {
+            'codeCommuneEtablissement': '75102', 'codePaysEtrangerEtablissement': None}}})
+
+
+if __name__ == '__main__':
+    main()
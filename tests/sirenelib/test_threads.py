@@ -0,0 +1,45 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import threading
+from unittest import TestCase, main
+
+from sirenelib.threads import threaded
+
+
+def numbers(start, count, error=None):
+    for i in range(start, start + count):
+        yield i
+    if error:
+        raise error
+
+
+class TestThreaded(TestCase):
+
+    def test_items_in_order(self):
+        self.assertEqual(list(threaded([numbers(0, 100)], 4)), list(range(100)))
+
+    def test_generators_merged(self):
+        items = list(threaded([numbers(i * 100, 100) for i in range(5)], 4, workers=2))
+        self.assertEqual(sorted(items), list(range(500)))
+
+    def test_started_at_once(self):
+        started = threading.Event()
+
+        def generator():
+            started.set()
+            yield 1
+
+        items = threaded([generator()], 1)
+        self.assertTrue(started.wait(5))
+        self.assertEqual(list(items), [1])
+
+    def test_error_raised(self):
+        items = threaded([numbers(0, 3, ValueError('page'))], 4)
+        self.assertEqual([next(items) for _ in range(3)], [0, 1, 2])
+        with self.assertRaises(ValueError):
+            next(items)
+
+
+if __name__ == '__main__':
+    main()